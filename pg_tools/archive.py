@@ -0,0 +1,883 @@
+""" native reader for pg_dump custom (-Fc) and directory (-Fd) archives """
+import os
+import re
+import codecs
+import gzip
+import mmap
+import zlib
+import struct
+from collections import namedtuple
+
+from .utils import NotYetImplementedException
+from .utils import ParseDumpFileException
+
+##
+# The archive starts with a header:
+#
+#   "PGDMP" vmaj vmin vrev intSize offSize format
+#   compression (an int before 1.15, an algorithm byte since)
+#   creation date (7 ints), dbname, server version, pg_dump version
+#
+# then the TOC: an int count of entries, then for each entry a list of ints
+# and strings (see ReadToc in pg_backup_archiver.c), followed by the format
+# specific part: data offset for custom, data file name for directory.
+#
+# Ints are a sign byte followed by intSize bytes, little endian. Strings are
+# an int length (-1 for NULL) followed by the bytes. Offsets are a flag byte
+# followed by offSize bytes, little endian.
+#
+# In a custom archive, data blocks follow the TOC. A block is a type byte,
+# the int dumpId, then chunks of an int size followed by as many
+# (compressed) bytes, until a zero size chunk. Directory archives have a
+# data file per TOC entry instead.
+#
+# Large objects blocks (BLOBS entries) hold, for each object, its int oid
+# followed by its chunks, and end with a zero oid. In directory archives
+# the entry file, blobs.toc, lists "oid filename" lines.
+
+MAGIC = b"PGDMP"
+
+FMT_CUSTOM = 1
+FMT_DIRECTORY = 5
+
+
+def make_version(major, minor, rev=0):
+    """ MAKE_ARCHIVE_VERSION """
+    return (major * 256 + minor) * 256 + rev
+
+
+K_VERS_MIN = make_version(1, 11)
+K_VERS_MAX = make_version(1, 16)
+
+# sign byte then the value, little endian, by intSize
+INT_FORMATS = {4: "<BI", 8: "<BQ"}
+
+# data offset flags
+K_OFFSET_POS_NOT_SET = 1
+K_OFFSET_POS_SET = 2
+K_OFFSET_NO_DATA = 3
+
+# data block types
+BLK_DATA = 1
+BLK_BLOBS = 3
+
+SECTIONS = {1: "NONE", 2: "PRE-DATA", 3: "DATA", 4: "POST-DATA"}
+COMPRESSIONS = {0: "none", 1: "gzip", 2: "lz4", 3: "zstd"}
+
+# pg_restore -l doesn't list those, they're handled specially
+SPECIAL_DESCS = ("ENCODING", "STDSTRINGS", "SEARCHPATH", "DATABASE", "DATABASE PROPERTIES")
+
+ArchiveEntry = namedtuple(
+    "ArchiveEntry",
+    [
+        "dump_id",
+        "had_dumper",
+        "table_oid",
+        "oid",
+        "tag",
+        "desc",
+        "section",
+        "defn",
+        "drop_stmt",
+        "copy_stmt",
+        "namespace",
+        "tablespace",
+        "tableam",
+        "relkind",
+        "owner",
+        "dependencies",
+        "data_state",
+        "data_offset",
+        "filename",
+    ],
+)
+
+
+def toc_path(filename):
+    """ directory archives keep their TOC in toc.dat """
+
+    if os.path.isdir(filename):
+        return os.path.join(filename, "toc.dat")
+    return filename
+
+
+def readable(filename):
+    """ is filename an archive we know how to read? """
+
+    path = toc_path(filename)
+
+    try:
+        with open(path, "rb") as f:
+            head = f.read(len(MAGIC) + 6)
+    except (IOError, OSError):
+        return False
+
+    if not head.startswith(MAGIC) or len(head) < len(MAGIC) + 6:
+        return False
+
+    vmaj, vmin, vrev, fmt = head[5], head[6], head[7], head[10]
+    version = make_version(vmaj, vmin, vrev)
+
+    return (
+        fmt in (FMT_CUSTOM, FMT_DIRECTORY) and K_VERS_MIN <= version <= K_VERS_MAX
+    )
+
+
+class Archive:
+    """Memory mapped pg_dump archive, reading its header at once and its TOC
+    entries on demand"""
+
+    def __init__(self, filename):
+        """ filename is a custom format file or a directory archive """
+
+        self.filename = filename
+        self.path = toc_path(filename)
+        self.fd = open(self.path, "rb")
+
+        try:
+            self.buf = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.fd.close()
+            raise ParseDumpFileException(f"Error: empty archive '{self.path}'")
+
+        self.pos = 0
+        self.data_start = None
+
+        try:
+            self.read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ unmap and close the archive file """
+
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def error(self, mesg):
+        """ raise a parse error at current position """
+
+        mesg = f"Error: {self.path}: {mesg}"
+        mesg += f"\nDetail: at offset {self.pos}"
+        raise ParseDumpFileException(mesg)
+
+    def read_byte(self):
+        """ read a single byte """
+
+        b = self.buf[self.pos]
+        self.pos += 1
+        return b
+
+    def read_int(self):
+        """ sign byte and intSize bytes, little endian """
+
+        sign, value = self.int_struct.unpack_from(self.buf, self.pos)
+        self.pos += self.int_struct.size
+
+        if sign:
+            return -value
+        return value
+
+    def read_str(self):
+        """ int length then bytes, None for a -1 length """
+
+        length = self.read_int()
+
+        if length < 0:
+            return None
+
+        pos = self.pos
+        self.pos = pos + length
+        return self.buf[pos: self.pos].decode("utf-8", "replace")
+
+    def read_offset(self):
+        """ flag byte then offSize bytes, little endian """
+
+        flag = self.read_byte()
+        pos = self.pos
+        self.pos = pos + self.off_size
+
+        if flag not in (K_OFFSET_POS_NOT_SET, K_OFFSET_POS_SET, K_OFFSET_NO_DATA):
+            self.error(f"unexpected data offset flag {flag}")
+
+        return flag, int.from_bytes(self.buf[pos: self.pos], "little")
+
+    def read_header(self):
+        """ see ReadHead in pg_backup_archiver.c """
+
+        if self.buf[: len(MAGIC)] != MAGIC:
+            self.error("not a pg_dump custom or directory archive")
+
+        self.pos = len(MAGIC)
+        vmaj, vmin, vrev = self.read_byte(), self.read_byte(), self.read_byte()
+        self.version = make_version(vmaj, vmin, vrev)
+        self.version_string = f"{vmaj}.{vmin}-{vrev}"
+
+        if not K_VERS_MIN <= self.version <= K_VERS_MAX:
+            self.error(f"unsupported archive version {self.version_string}")
+
+        self.int_size = self.read_byte()
+        self.off_size = self.read_byte()
+
+        if self.int_size not in INT_FORMATS:
+            self.error(f"unsupported integer size {self.int_size}")
+
+        self.int_struct = struct.Struct(INT_FORMATS[self.int_size])
+        self.format = self.read_byte()
+
+        if self.format not in (FMT_CUSTOM, FMT_DIRECTORY):
+            self.error(f"unsupported archive format {self.format}")
+
+        if self.version >= make_version(1, 15):
+            algorithm = self.read_byte()
+            self.compression = COMPRESSIONS.get(algorithm, str(algorithm))
+            self.compression_level = None
+        else:
+            level = self.read_int()
+            self.compression = "none" if level == 0 else "gzip"
+            self.compression_level = level
+
+        # sec, min, hour, mday, mon, year, isdst
+        tm = [self.read_int() for _ in range(7)]
+        self.created = "%04d-%02d-%02d %02d:%02d:%02d" % (
+            tm[5] + 1900,
+            tm[4] + 1,
+            tm[3],
+            tm[2],
+            tm[1],
+            tm[0],
+        )
+
+        self.dbname = self.read_str()
+        self.remote_version = self.read_str()
+        self.dump_version = self.read_str()
+
+        self.toc_count = self.read_int()
+        self.toc_start = self.pos
+
+    def entries(self):
+        """ iterate over the TOC entries, see ReadToc """
+
+        # this is the hot loop on 1M entries archives: fields are read in
+        # straight line code with local names only, a loop over a per field
+        # layout costing about twice as much
+        buf = self.buf
+        pos = self.toc_start
+        unpack = self.int_struct.unpack_from
+        size = self.int_struct.size
+        unpack_two = struct.Struct("<" + self.int_struct.format[1:] * 2).unpack_from
+        decode = bytes.decode
+        off_size = self.off_size
+        custom = self.format == FMT_CUSTOM
+        has_tableam = self.version >= make_version(1, 14)
+        has_relkind = self.version >= make_version(1, 16)
+        sections = SECTIONS
+        make = ArchiveEntry._make
+        tableam = relkind = None
+
+        for _ in range(self.toc_count):
+            sign, dump_id, sign2, had_dumper = unpack_two(buf, pos)
+            pos += 2 * size
+
+            if sign or dump_id <= 0:
+                self.pos = pos
+                self.error(f"entry ID {-dump_id if sign else dump_id} out of range")
+            if sign2:
+                had_dumper = -had_dumper
+
+            # table_oid and oid are numbers, as strings
+            sign, n = unpack(buf, pos)
+            pos += size
+            table_oid = 0
+            if not sign:
+                if n:
+                    table_oid = int(buf[pos: pos + n])
+                pos += n
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            oid = 0
+            if not sign:
+                if n:
+                    oid = int(buf[pos: pos + n])
+                pos += n
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            tag = None
+            if not sign:
+                tag = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            desc = None
+            if not sign:
+                desc = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            sign, section = unpack(buf, pos)
+            pos += size
+            section = sections.get(-section if sign else section)
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            defn = None
+            if not sign:
+                defn = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            drop_stmt = None
+            if not sign:
+                drop_stmt = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            copy_stmt = None
+            if not sign:
+                copy_stmt = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            namespace = None
+            if not sign:
+                namespace = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            tablespace = None
+            if not sign:
+                tablespace = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            if has_tableam:
+                sign, n = unpack(buf, pos)
+                pos += size
+                tableam = None
+                if not sign:
+                    tableam = decode(buf[pos: pos + n], "utf-8", "replace")
+                    pos += n
+
+            if has_relkind:
+                sign, relkind = unpack(buf, pos)
+                pos += size
+                if sign:
+                    relkind = -relkind
+
+            sign, n = unpack(buf, pos)
+            pos += size
+            owner = None
+            if not sign:
+                owner = decode(buf[pos: pos + n], "utf-8", "replace")
+                pos += n
+
+            # with_oids, skipped
+            sign, n = unpack(buf, pos)
+            pos += size
+            if not sign:
+                pos += n
+
+            dependencies = []
+            while True:
+                sign, n = unpack(buf, pos)
+                pos += size
+                if sign:
+                    break
+                dependencies.append(int(buf[pos: pos + n]))
+                pos += n
+
+            if custom:
+                data_state = buf[pos]
+                if data_state not in (K_OFFSET_POS_NOT_SET, K_OFFSET_POS_SET, K_OFFSET_NO_DATA):
+                    self.pos = pos
+                    self.error(f"unexpected data offset flag {data_state}")
+                end = pos + 1 + off_size
+                data_offset = int.from_bytes(buf[pos + 1: end], "little")
+                filename = None
+                pos = end
+            else:
+                data_state = data_offset = filename = None
+                sign, n = unpack(buf, pos)
+                pos += size
+                if not sign:
+                    filename = decode(buf[pos: pos + n], "utf-8", "replace")
+                    pos += n
+
+            yield make(
+                (
+                    dump_id,
+                    had_dumper,
+                    table_oid,
+                    oid,
+                    tag,
+                    desc,
+                    section,
+                    defn,
+                    drop_stmt,
+                    copy_stmt,
+                    namespace,
+                    tablespace,
+                    tableam,
+                    relkind,
+                    owner,
+                    dependencies,
+                    data_state,
+                    data_offset,
+                    filename,
+                )
+            )
+
+        self.pos = self.data_start = pos
+
+    def find(self, desc, namespace, tag):
+        """ return the first entry matching, or None """
+
+        for e in self.entries():
+            if e.desc == desc and e.namespace == namespace and e.tag == tag:
+                return e
+
+        return None
+
+    def encoding(self):
+        """ the client_encoding of the data, from the ENCODING entry """
+
+        e = self.find("ENCODING", None, "ENCODING")
+
+        if e is not None and e.defn:
+            m = RE_ENCODING.search(e.defn)
+            if m:
+                return m.group(1)
+
+        return "UTF8"
+
+    def skip_block(self, block_type=BLK_DATA):
+        """skip the block at current position, a large objects block being
+        an oid then chunks for each object, until a zero oid"""
+
+        while True:
+            if block_type == BLK_BLOBS and self.read_int() == 0:
+                return
+
+            while True:
+                size = self.read_int()
+                if size <= 0:
+                    break
+                self.pos += size
+
+            if block_type != BLK_BLOBS:
+                return
+
+    def seek_block(self, entry):
+        """move to the data block of entry in a custom archive, seeking
+        directly to it when the offset is known and walking through the
+        blocks otherwise, and return its type"""
+
+        if entry.data_state == K_OFFSET_POS_SET:
+            self.pos = entry.data_offset
+        else:
+            # pg_dump wrote to a pipe and couldn't go back to set offsets
+            if self.data_start is None:
+                for _ in self.entries():
+                    pass
+            self.pos = self.data_start
+
+        while self.pos < len(self.buf):
+            block_type = self.read_byte()
+            dump_id = self.read_int()
+
+            if block_type not in (BLK_DATA, BLK_BLOBS):
+                self.error(f"unrecognized data block type {block_type}")
+
+            if dump_id == entry.dump_id:
+                return block_type
+
+            if entry.data_state == K_OFFSET_POS_SET:
+                self.error(f"found data for entry {dump_id} instead of {entry.dump_id}")
+
+            self.skip_block(block_type)
+
+        self.error(f"could not find data block of entry {entry.dump_id}")
+
+    def read_chunks(self):
+        """ iterate over the chunks at current position, until a zero size """
+
+        while True:
+            size = self.read_int()
+            if size <= 0:
+                return
+
+            pos = self.pos
+            self.pos = pos + size
+            yield self.buf[pos: self.pos]
+
+    def chunks(self, entry):
+        """iterate over the raw, still compressed, data chunks of entry in a
+        custom archive"""
+
+        if entry.data_state == K_OFFSET_NO_DATA:
+            return
+
+        self.seek_block(entry)
+
+        for chunk in self.read_chunks():
+            yield chunk
+
+    def find_file(self, name):
+        """ path of data file name in a directory archive, compressed or not """
+
+        for suffix in ("", ".gz", ".lz4", ".zst"):
+            path = os.path.join(self.filename, name + suffix)
+            if os.path.exists(path):
+                return path
+
+        self.error(f"could not find data file {name}")
+
+    def data_file(self, entry):
+        """ path of the data file of entry in a directory archive """
+        return self.find_file(entry.filename)
+
+    def blobs(self, entry):
+        """iterate over (oid, data) of the large objects of a BLOBS entry,
+        each object data decompressed in memory"""
+
+        if self.format == FMT_CUSTOM:
+            if entry.data_state == K_OFFSET_NO_DATA:
+                return
+
+            self.seek_block(entry)
+
+            while True:
+                oid = self.read_int()
+                if oid == 0:
+                    return
+
+                # each object is compressed on its own
+                d = decompressor(self.compression)
+                data = b"".join(
+                    d.decompress(chunk) if d is not None else chunk
+                    for chunk in self.read_chunks()
+                )
+
+                pos = self.pos
+                yield oid, data
+                self.pos = pos
+
+        elif entry.filename is not None:
+            # blobs.toc lines are "oid blob_oid.dat"
+            with open(os.path.join(self.filename, entry.filename)) as toc:
+                for line in toc:
+                    if line.strip():
+                        oid, name = line.split()
+                        yield int(oid), read_data_file(self.find_file(name))
+
+    def data(self, entry, bufsize=8 * 1024 * 1024):
+        """ iterate over the decompressed COPY data of given entry """
+
+        if self.format == FMT_CUSTOM:
+            chunks = self.chunks(entry)
+            compression = self.compression
+        elif entry.filename is None:
+            return
+        else:
+            path = self.data_file(entry)
+
+            if path.endswith(".gz"):
+                with gzip.open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(bufsize), b""):
+                        yield chunk
+                return
+
+            compression = {".lz4": "lz4", ".zst": "zstd"}.get(
+                os.path.splitext(path)[1], "none"
+            )
+            chunks = read_file(path, bufsize)
+
+        d = decompressor(compression)
+
+        for chunk in chunks:
+            if d is not None:
+                chunk = d.decompress(chunk)
+            if chunk:
+                yield chunk
+
+
+RE_ENCODING = re.compile(r"client_encoding = '([^']+)'")
+
+
+def python_encoding(encoding):
+    """ python codec name for a PostgreSQL encoding name """
+
+    name = {"SQL_ASCII": "latin-1"}.get(encoding, encoding.replace("WIN", "cp"))
+
+    try:
+        codecs.lookup(name)
+    except LookupError:
+        return "utf-8"
+
+    return name
+
+
+def read_file(path, bufsize):
+    """ iterate over the content of path """
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(bufsize), b""):
+            yield chunk
+
+
+def read_data_file(path):
+    """ the decompressed content of a directory archive data file """
+
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+
+    compression = {".lz4": "lz4", ".zst": "zstd"}.get(os.path.splitext(path)[1], "none")
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    d = decompressor(compression)
+    return d.decompress(data) if d is not None else data
+
+
+def decompressor(compression):
+    """return an object with a decompress(data) method for the archive
+    compression, None when the archive isn't compressed"""
+
+    if compression == "none":
+        return None
+
+    if compression == "gzip":
+        return zlib.decompressobj()
+
+    mesg = f"Error: can't decompress {compression} archive data"
+
+    try:
+        if compression == "lz4":
+            import lz4.frame
+
+            return lz4.frame.LZ4FrameDecompressor()
+
+        if compression == "zstd":
+            import zstandard
+
+            return zstandard.ZstdDecompressor().decompressobj()
+    except ImportError as exp:
+        mesg += f"\nDetail: {exp}"
+        mesg += f"\nHint: pip install pg_tools[{compression}]"
+
+    raise NotYetImplementedException(mesg)
+
+
+class DataReader:
+    """file like object over Archive.data(), for cursor.copy_expert and
+    friends"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = b""
+        self.pos = 0
+        self.size = 0
+
+    def fill(self):
+        """ append the next chunk to the buffer, False at the end """
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+
+        # only keep what's not been read yet
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def consume(self, end):
+        """ return the buffer up to end and move past it """
+
+        out = self.buf[self.pos: end]
+        self.pos = end
+        self.size += len(out)
+        return out
+
+    def read(self, size=-1):
+        """ return up to size bytes, b'' at the end of the data """
+
+        while size < 0 or len(self.buf) - self.pos < size:
+            if not self.fill():
+                break
+
+        if size < 0:
+            return self.consume(len(self.buf))
+        return self.consume(min(self.pos + size, len(self.buf)))
+
+    def readline(self, size=-1):
+        """ return the next line """
+
+        start = self.pos
+        while True:
+            end = self.buf.find(b"\n", start)
+            if end > -1:
+                return self.consume(end + 1)
+
+            start = len(self.buf) - self.pos
+            if not self.fill():
+                return self.consume(len(self.buf))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+COPY_ESCAPES = {
+    b"b": b"\b",
+    b"f": b"\f",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+}
+RE_COPY_ESCAPE = re.compile(rb"\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)")
+RE_CSV_QUOTE = re.compile(r'[,"\r\n]')
+
+
+def copy_unescape(m):
+    """ replace a COPY text format backslash sequence """
+
+    seq = m.group(1)
+
+    if seq[:1] == b"x" and len(seq) > 1:
+        return bytes([int(seq[1:], 16)])
+    if seq[:1].isdigit():
+        return bytes([int(seq, 8) & 0xFF])
+    return COPY_ESCAPES.get(seq, seq)
+
+
+def csv_field(value):
+    """quote value as COPY ... CSV does: NULL is an empty unquoted field,
+    the empty string is quoted"""
+
+    if value is None:
+        return ""
+
+    if value == "" or RE_CSV_QUOTE.search(value):
+        return '"%s"' % value.replace('"', '""')
+
+    return value
+
+
+def copy_to_csv(reader, out, encoding="utf-8"):
+    """convert COPY text format lines from reader to CSV written to out,
+    and return the number of rows"""
+
+    rows = 0
+
+    for line in reader:
+        line = line.rstrip(b"\n")
+
+        if line == b"\\.":
+            break
+
+        row = []
+        for field in line.split(b"\t"):
+            if field == b"\\N":
+                row.append(None)
+                continue
+
+            if b"\\" in field:
+                field = RE_COPY_ESCAPE.sub(copy_unescape, field)
+
+            row.append(field.decode(encoding))
+
+        out.write(",".join(csv_field(x) for x in row))
+        out.write("\n")
+        rows += 1
+
+    return rows
+
+
+def sanitize(value):
+    """ as pg_restore -l does, one line per entry """
+
+    if not value:
+        return "-"
+    return value.replace("\n", " ")
+
+
+def listing(filename):
+    """ return the same catalog as pg_restore -l """
+
+    lines = []
+
+    with Archive(filename) as archive:
+        lines.append(";")
+        lines.append(f"; Archive created at {archive.created}")
+        lines.append(f";     dbname: {archive.dbname}")
+        lines.append(f";     TOC Entries: {archive.toc_count}")
+        lines.append(f";     Compression: {archive.compression}")
+        lines.append(f";     Dump Version: {archive.version_string}")
+        lines.append(";")
+
+        for e in archive.entries():
+            if e.desc in SPECIAL_DESCS:
+                continue
+
+            lines.append(
+                "%d; %d %d %s %s %s %s"
+                % (
+                    e.dump_id,
+                    e.table_oid,
+                    e.oid,
+                    e.desc,
+                    sanitize(e.namespace),
+                    sanitize(e.tag),
+                    sanitize(e.owner),
+                )
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+RE_CREATE_TRIGGER = re.compile(r"CREATE (?:CONSTRAINT )?TRIGGER\s+(\S+)")
+RE_EXECUTE = re.compile(r"EXECUTE (?:PROCEDURE|FUNCTION)\s+([^(\s]+)\s*\(")
+
+
+def trigger_funcs(filename):
+    """ same as PGRestore.get_trigger_funcs, from the TRIGGER entries """
+
+    triggers = {}
+
+    with Archive(filename) as archive:
+        for e in archive.entries():
+            if e.desc != "TRIGGER" or not e.defn:
+                continue
+
+            schema = e.namespace or "public"
+            m = RE_CREATE_TRIGGER.search(e.defn)
+            name = m.group(1) if m else e.tag
+
+            funcs = triggers.setdefault(schema, {}).setdefault(name, [])
+
+            for pname in RE_EXECUTE.findall(e.defn):
+                if pname.find(".") == -1:
+                    pname = f"{schema}.{pname}"
+
+                if pname not in funcs:
+                    funcs.append(pname)
+
+    return triggers
@@ -0,0 +1,161 @@
+""" parsing of the pg_restore -l catalog listing """
+from collections import namedtuple
+
+##
+# A catalog line looks like:
+#
+# 3385; 1259 123008 TABLE londiste subscriber_table payment
+# 6662; 0 788811 TABLE DATA payment abocb_code payment
+# 142; 1255 122813 FUNCTION public txid_visible_in_snapshot(bigint, txid_snapshot) postgres
+#
+# that is: dumpId; tableoid oid desc schema tag owner
+#
+# The desc might be several words long and the tag might contain spaces, so
+# we match desc against the list of known pg_dump object descriptions,
+# longest first, and the owner is always the last word of the line.
+
+TOC_DESCS = sorted(
+    [
+        "ACCESS METHOD",
+        "ACL",
+        "AGGREGATE",
+        "BLOB",
+        "BLOB METADATA",
+        "BLOBS",
+        "CAST",
+        "CHECK CONSTRAINT",
+        "COLLATION",
+        "COMMENT",
+        "CONSTRAINT",
+        "CONVERSION",
+        "DATABASE",
+        "DATABASE PROPERTIES",
+        "DEFAULT",
+        "DEFAULT ACL",
+        "DOMAIN",
+        "ENCODING",
+        "EVENT TRIGGER",
+        "EXTENSION",
+        "FK CONSTRAINT",
+        "FOREIGN DATA WRAPPER",
+        "FOREIGN SERVER",
+        "FOREIGN TABLE",
+        "FUNCTION",
+        "INDEX",
+        "INDEX ATTACH",
+        "LARGE OBJECT",
+        "LARGE OBJECTS",
+        "MATERIALIZED VIEW",
+        "MATERIALIZED VIEW DATA",
+        "OPERATOR",
+        "OPERATOR CLASS",
+        "OPERATOR FAMILY",
+        "POLICY",
+        "PROCEDURAL LANGUAGE",
+        "PROCEDURE",
+        "PUBLICATION",
+        "PUBLICATION TABLE",
+        "PUBLICATION TABLES IN SCHEMA",
+        "ROW SECURITY",
+        "RULE",
+        "SCHEMA",
+        "SEARCHPATH",
+        "SECURITY LABEL",
+        "SEQUENCE",
+        "SEQUENCE OWNED BY",
+        "SEQUENCE SET",
+        "SERVER",
+        "SHELL TYPE",
+        "STATISTICS",
+        "STATISTICS DATA",
+        "STDSTRINGS",
+        "SUBSCRIPTION",
+        "TABLE",
+        "TABLE ATTACH",
+        "TABLE DATA",
+        "TEXT SEARCH CONFIGURATION",
+        "TEXT SEARCH DICTIONARY",
+        "TEXT SEARCH PARSER",
+        "TEXT SEARCH TEMPLATE",
+        "TRANSFORM",
+        "TRIGGER",
+        "TYPE",
+        "USER MAPPING",
+        "VIEW",
+    ],
+    key=len,
+    reverse=True,
+)
+
+# entries that contain rows, as opposed to schema definitions
+DATA_DESCS = ("TABLE DATA", "MATERIALIZED VIEW DATA", "BLOBS", "BLOB", "LARGE OBJECTS")
+
+TocEntry = namedtuple(
+    "TocEntry", ["dump_id", "table_oid", "oid", "desc", "schema", "tag", "owner"]
+)
+
+
+def parse_catalog_line(line):
+    """ return a TocEntry for given catalog line, None for comments """
+
+    line = line.strip()
+
+    if line == "" or line.startswith(";"):
+        return None
+
+    try:
+        dump_id, rest = line.split(";", 1)
+        table_oid, oid, rest = rest.split(None, 2)
+        dump_id, table_oid, oid = int(dump_id), int(table_oid), int(oid)
+    except ValueError:
+        return None
+
+    for desc in TOC_DESCS:
+        if rest == desc or rest.startswith(desc + " "):
+            break
+    else:
+        # unknown desc, assume a single word
+        desc = rest.split()[0]
+
+    words = rest[len(desc):].split()
+    if len(words) < 2:
+        return TocEntry(dump_id, table_oid, oid, desc, "-", " ".join(words), "-")
+
+    schema = words[0]
+    owner = words[-1]
+    tag = " ".join(words[1:-1])
+
+    return TocEntry(dump_id, table_oid, oid, desc, schema, tag, owner)
+
+
+def parse_catalog(catalog):
+    """ iterate over TocEntry items of a pg_restore -l listing """
+
+    for line in catalog.split("\n"):
+        entry = parse_catalog_line(line)
+
+        if entry is not None:
+            yield entry
+
+
+def qualified_name(entry):
+    """ schema.tag as printed by pg_restore --verbose """
+
+    if entry.schema in ("", "-"):
+        return entry.tag
+    return f"{entry.schema}.{entry.tag}"
+
+
+def keep_entries(catalog, dump_ids):
+    """ comment out every entry of catalog text not listed in dump_ids """
+
+    lines = []
+    for line in catalog.split("\n"):
+        entry = parse_catalog_line(line)
+
+        if entry is not None and entry.dump_id not in dump_ids:
+            line = f";{line}"
+
+        lines.append(line)
+
+    return "\n".join(lines)
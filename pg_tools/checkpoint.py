@@ -0,0 +1,241 @@
+""" per TOC entry checkpointing of pg_restore runs """
+import os
+import re
+import logging
+
+from .catalog import parse_catalog
+from .catalog import parse_catalog_line
+from .catalog import qualified_name
+from .utils import CheckpointMismatchException
+
+logger = logging.getLogger(__name__)
+
+##
+# pg_restore --verbose tells us what it's doing on stderr, with messages
+# such as:
+#
+# pg_restore: processing item 3385 TABLE subscriber_table
+# pg_restore: launching item 6662 TABLE DATA abocb_code
+# pg_restore: finished item 6662 TABLE DATA abocb_code
+# pg_restore: creating TABLE "londiste.subscriber_table"
+# pg_restore: processing data for table "payment.abocb_code"
+# pg_restore: executing SEQUENCE SET provider_seq_nr_seq
+#
+# Parallel workers report both the start and the end of an item, by dumpId.
+# Serial processing only reports the start of an item, either by dumpId or by
+# name, and we then consider the previous serial item done when the next one
+# starts. Entries pg_restore doesn't talk about are replayed on resume.
+#
+# An entry that fails is never done, whatever comes next: errors name the
+# entry ("from TOC entry 6662; ..."), or else fail the current serial item,
+# or all the running ones in parallel mode. The resumable restore runs with
+# --exit-on-error anyway, so that pg_restore doesn't go on past a failure.
+
+RE_FINISHED = re.compile(r"finished item (\d+) ")
+RE_LAUNCHING = re.compile(r"launching item (\d+) ")
+RE_ITEM = re.compile(r"processing (?:missed )?item (\d+) ")
+RE_CREATING = re.compile(r'creating (.+?) "(.+)"')
+RE_DATA = re.compile(r'processing data for table "(.+)"')
+RE_EXECUTING = re.compile(r"executing (.+?) (\S+)$")
+RE_ERROR_ENTRY = re.compile(r"[Ff]rom TOC entry (\d+);")
+RE_ERROR = re.compile(r"pg_restore: (?:error:|\[archiver \(db\)\])")
+
+
+class RestoreCheckpoint:
+    """Keep track of the TOC entries a pg_restore run has completed, in a
+    local file, so that a failed restore can be resumed"""
+
+    def __init__(self, path, archive, catalog):
+        """ catalog is the pg_restore -l listing of the archive """
+
+        self.path = path
+        self.archive = os.path.abspath(archive)
+        self.entries = {e.dump_id: e for e in parse_catalog(catalog)}
+        self.by_name = {}
+        self.started = set()
+        self.done = set()
+        self.failed = set()
+        self.current = None
+        self.parallel = False
+        self.fd = None
+
+        for e in self.entries.values():
+            self.by_name.setdefault((e.desc, qualified_name(e)), e.dump_id)
+            self.by_name.setdefault((e.desc, e.tag), e.dump_id)
+
+        self.load()
+
+    def fingerprint(self):
+        """ identify the archive file the checkpoint belongs to """
+
+        st = os.stat(self.archive)
+        return f"archive {self.archive} {st.st_size} {int(st.st_mtime)}"
+
+    def load(self):
+        """ read an existing checkpoint file, if any """
+
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            header = f.readline().strip()
+
+            if header != self.fingerprint():
+                mesg = f"Error: checkpoint '{self.path}' belongs to another archive"
+                mesg += f"\nDetail: {header}"
+                raise CheckpointMismatchException(mesg)
+
+            for line in f:
+                try:
+                    event, dump_id = line.split()
+                    dump_id = int(dump_id)
+                except ValueError:
+                    # a partially written last line, ignore
+                    continue
+
+                if event == "start":
+                    self.started.add(dump_id)
+                elif event == "done":
+                    self.done.add(dump_id)
+
+        logger.info(
+            f"Checkpoint {self.path}: {len(self.done)} entries already restored"
+        )
+
+    def in_progress(self):
+        """ entries started by a previous run and never finished """
+
+        return [
+            self.entries[i]
+            for i in sorted(self.started - self.done)
+            if i in self.entries
+        ]
+
+    def filter_catalog(self, catalog):
+        """ comment out entries already restored from given catalog text """
+
+        lines = []
+        for line in catalog.split("\n"):
+            entry = parse_catalog_line(line)
+
+            if entry is not None and entry.dump_id in self.done:
+                line = f";{line}"
+
+            lines.append(line)
+
+        return "\n".join(lines)
+
+    def open(self):
+        """ open the checkpoint file for appending events """
+
+        new = not os.path.exists(self.path)
+        self.fd = open(self.path, "a")
+
+        if new:
+            self.fd.write(f"{self.fingerprint()}\n")
+            self.fd.flush()
+
+    def close(self):
+        """ close the checkpoint file """
+
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def remove(self):
+        """ the restore is complete, we don't need the checkpoint anymore """
+
+        self.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def record(self, event, dump_id):
+        """ append an event to the checkpoint file """
+
+        if event == "start":
+            self.started.add(dump_id)
+        elif dump_id in self.failed:
+            # pg_restore reports failed items as finished too
+            return
+        else:
+            self.done.add(dump_id)
+
+        if self.fd is not None:
+            self.fd.write(f"{event} {dump_id}\n")
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+
+    def lookup(self, desc, name):
+        """ find the dumpId of an entry from its verbose name """
+
+        return self.by_name.get((desc, name))
+
+    def fail(self, dump_id):
+        """ dump_id failed, it must be restored again on resume """
+
+        self.failed.add(dump_id)
+
+        if self.current == dump_id:
+            self.current = None
+
+    def feed(self, line):
+        """ process a line of pg_restore --verbose output """
+
+        m = RE_ERROR_ENTRY.search(line)
+        if m:
+            self.fail(int(m.group(1)))
+            return
+
+        if RE_ERROR.search(line):
+            if self.parallel:
+                for dump_id in self.started - self.done:
+                    self.fail(dump_id)
+            elif self.current is not None:
+                self.fail(self.current)
+            return
+
+        m = RE_FINISHED.search(line)
+        if m:
+            self.record("done", int(m.group(1)))
+            return
+
+        m = RE_LAUNCHING.search(line)
+        if m:
+            # workers are running, the serial pre-data section is over
+            if not self.parallel:
+                self.parallel = True
+                self.finish()
+
+            self.record("start", int(m.group(1)))
+            return
+
+        dump_id = None
+        m = RE_ITEM.search(line)
+        if m:
+            dump_id = int(m.group(1))
+        elif not self.parallel:
+            # workers also print those, only trust them in serial mode
+            m = RE_DATA.search(line)
+            if m:
+                dump_id = self.lookup("TABLE DATA", m.group(1))
+            else:
+                m = RE_CREATING.search(line) or RE_EXECUTING.search(line)
+                if m:
+                    dump_id = self.lookup(m.group(1), m.group(2))
+
+        if dump_id is None or dump_id == self.current:
+            return
+
+        # serial processing: starting a new item means the previous is done
+        if self.current is not None:
+            self.record("done", self.current)
+
+        self.current = dump_id
+        self.record("start", dump_id)
+
+    def finish(self):
+        """ the current serial item is done """
+
+        if self.current is not None:
+            self.record("done", self.current)
+            self.current = None
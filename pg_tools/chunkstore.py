@@ -0,0 +1,370 @@
+""" deduplicating storage of dumps, in content defined chunks """
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+##
+# Dumps are cut into chunks whose boundaries depend on the content only, so
+# that a row inserted in a table only changes the chunk around it and the
+# other chunks of the dump are the same as the day before. Chunks are
+# stored once, compressed, by their sha256:
+#
+# store/chunks/3f/3fa2...e1
+# store/manifests/billing-2021-03-02.json
+#
+# A manifest lists the chunks of a dump in order, or of each file of a
+# directory format dump.
+#
+# Boundaries are at line ends, which COPY data has plenty of: a line ends a
+# chunk when the crc32 of the line has its low MASK bits clear, about every
+# 2048 lines, and the chunk is at least MIN_CHUNK long. Without a boundary
+# within MAX_CHUNK bytes, as in binary parts of the archive, we cut there.
+# Dumps are best stored uncompressed (pg_dump -Z0): compression would make
+# every byte after a change differ.
+#
+# A dump being written has no manifest yet: gc spares the chunks used or
+# stored in the last GRACE secs, storing a chunk we have touches it.
+
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+MASK = 0x7FF
+
+CHUNKS = "chunks"
+MANIFESTS = "manifests"
+
+# unreferenced chunks younger than that may belong to a dump in progress
+GRACE = 24 * 3600
+
+BUFSIZE = 1024 * 1024
+
+
+def manifest_filename(name):
+    """ a file name for the manifest of name, whatever its characters """
+
+    return re.sub(r"[^\w.-]", lambda m: "%%%02X" % ord(m.group(0)), name) + ".json"
+
+
+class Chunker:
+    """Cut a stream of bytes in content defined chunks"""
+
+    def __init__(self, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask=MASK):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+
+        self.rest = b""
+        self.pos = 0
+
+    def feed(self, data):
+        """ return the chunks completed by data """
+
+        buf = self.rest + data
+        view = memoryview(buf)
+        chunks = []
+
+        # start of the current chunk, and of the line we look at
+        start = 0
+        pos = self.pos
+
+        while True:
+            nl = buf.find(b"\n", pos, start + self.max_size)
+
+            if nl == -1:
+                if len(buf) - start < self.max_size:
+                    break
+
+                chunks.append(buf[start: start + self.max_size])
+                start = pos = start + self.max_size
+                continue
+
+            end = nl + 1
+
+            if end - start >= self.min_size and zlib.crc32(view[pos:end]) & self.mask == 0:
+                chunks.append(buf[start:end])
+                start = end
+
+            pos = end
+
+        view.release()
+
+        self.rest = buf[start:]
+        self.pos = pos - start
+
+        return chunks
+
+    def flush(self):
+        """ the last chunk, if any """
+
+        chunks = [self.rest] if self.rest else []
+        self.rest, self.pos = b"", 0
+
+        return chunks
+
+
+class ChunkStore:
+    """Chunks by sha256, and the manifests of the dumps made of them"""
+
+    def __init__(self, path):
+        self.path = path
+
+        os.makedirs(os.path.join(path, CHUNKS), exist_ok=True)
+        os.makedirs(os.path.join(path, MANIFESTS), exist_ok=True)
+
+    def chunk_path(self, digest):
+        """ where chunk digest lives """
+        return os.path.join(self.path, CHUNKS, digest[:2], digest)
+
+    def manifest_path(self, name):
+        """ where the manifest of dump name lives """
+        return os.path.join(self.path, MANIFESTS, manifest_filename(name))
+
+    def put_chunk(self, data):
+        """ store data unless we have it already, return (digest, bytes written) """
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+
+        if os.path.exists(path):
+            try:
+                # a dump in progress uses it, gc must see it as recent
+                os.utime(path)
+                return digest, 0
+            except FileNotFoundError:
+                # gc removed it meanwhile, store it again
+                pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        compressed = zlib.compress(data, 6)
+        tmp = f"{path}.{os.getpid()}.tmp"
+
+        with open(tmp, "wb") as f:
+            f.write(compressed)
+        os.rename(tmp, path)
+
+        return digest, len(compressed)
+
+    def get_chunk(self, digest):
+        """ the content of chunk digest, checked """
+
+        with open(self.chunk_path(digest), "rb") as f:
+            data = zlib.decompress(f.read())
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Error: chunk {digest} is corrupted")
+
+        return data
+
+    def read_manifest(self, name):
+        """ the manifest of dump name """
+
+        with open(self.manifest_path(name)) as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest):
+        """ write the manifest of a dump, last, so that it's complete """
+
+        path = self.manifest_path(manifest["name"])
+
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(f"{path}.tmp", path)
+
+    def manifests(self):
+        """ all the manifests, oldest first """
+
+        manifests = []
+        directory = os.path.join(self.path, MANIFESTS)
+
+        for filename in os.listdir(directory):
+            if filename.endswith(".json"):
+                with open(os.path.join(directory, filename)) as f:
+                    manifests.append(json.load(f))
+
+        return sorted(manifests, key=lambda m: m["created"])
+
+    def writer(self, name):
+        """ a file like object storing a dump as it's written """
+        return ChunkWriter(self, name)
+
+    def reader(self, name, filename=None):
+        """a file like object reading a dump back, or one of its files for a
+        directory dump"""
+
+        manifest = self.read_manifest(name)
+        chunks = manifest["files"][filename] if filename else manifest["chunks"]
+
+        return ChunkReader(self, chunks)
+
+    def put_directory(self, name, directory):
+        """ store the files of a directory format dump """
+
+        manifest = {"name": name, "created": time.time(), "files": {}}
+        stats = {"size": 0, "count": 0, "written": 0}
+
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            if not os.path.isfile(path):
+                continue
+
+            writer = ChunkWriter(self, name)
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(BUFSIZE), b""):
+                    writer.write(data)
+            writer.flush()
+
+            manifest["files"][filename] = writer.chunks
+            for k in stats:
+                stats[k] += writer.stats[k]
+
+        manifest.update(stats)
+        self.write_manifest(manifest)
+
+        return manifest
+
+    def get_directory(self, name, directory):
+        """ write the files of a directory format dump back to directory """
+
+        os.makedirs(directory, exist_ok=True)
+
+        for filename in self.read_manifest(name)["files"]:
+            reader = self.reader(name, filename)
+            with open(os.path.join(directory, filename), "wb") as f:
+                for data in iter(lambda: reader.read(BUFSIZE), b""):
+                    f.write(data)
+
+    def gc(self, keep=None, keep_days=None, grace=GRACE):
+        """remove the dumps beyond the keep most recent or older than
+        keep_days, then the chunks no dump uses anymore"""
+
+        manifests = self.manifests()
+        now = time.time()
+
+        removed = []
+        for i, m in enumerate(manifests):
+            too_many = keep is not None and i < len(manifests) - keep
+            too_old = keep_days is not None and m["created"] < now - keep_days * 86400
+
+            if too_many or too_old:
+                os.unlink(self.manifest_path(m["name"]))
+                removed.append(m["name"])
+
+        used = set()
+        for m in manifests:
+            if m["name"] in removed:
+                continue
+            for entries in [m.get("chunks", [])] + list(m.get("files", {}).values()):
+                used.update(digest for digest, _ in entries)
+
+        chunks = freed = 0
+        for root, _, filenames in os.walk(os.path.join(self.path, CHUNKS)):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+
+                if filename in used or os.path.getmtime(path) > now - grace:
+                    continue
+
+                freed += os.path.getsize(path)
+                chunks += 1
+                os.unlink(path)
+
+        logger.info(
+            f"gc: removed {len(removed)} dumps, {chunks} chunks, {freed} bytes"
+        )
+
+        return {"dumps": removed, "chunks": chunks, "bytes": freed}
+
+
+class ChunkWriter:
+    """File like object cutting what's written into stored chunks, the
+    manifest is written on close"""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.chunker = Chunker()
+        self.chunks = []
+        self.sha256 = hashlib.sha256()
+        self.stats = {"size": 0, "count": 0, "written": 0}
+
+    def put(self, chunks):
+        """ store chunks, in order """
+
+        for data in chunks:
+            digest, written = self.store.put_chunk(data)
+            self.chunks.append([digest, len(data)])
+
+            self.stats["count"] += 1
+            self.stats["written"] += written
+
+    def write(self, data):
+        """ the pg_dump output, any size """
+
+        self.sha256.update(data)
+        self.stats["size"] += len(data)
+        self.put(self.chunker.feed(bytes(data)))
+
+    def flush(self):
+        """ store the last chunk """
+        self.put(self.chunker.flush())
+
+    def close(self):
+        """ store the last chunk and write the manifest """
+
+        self.flush()
+
+        manifest = {
+            "name": self.name,
+            "created": time.time(),
+            "sha256": self.sha256.hexdigest(),
+            "chunks": self.chunks,
+        }
+        manifest.update(self.stats)
+        self.store.write_manifest(manifest)
+
+        logger.info(
+            f"{self.name}: {self.stats['size']} bytes in {self.stats['count']} chunks, "
+            f"{self.stats['written']} bytes written"
+        )
+
+        return manifest
+
+
+class ChunkReader:
+    """File like object reading chunks back in order, one at a time"""
+
+    def __init__(self, store, chunks):
+        self.store = store
+        self.chunks = iter(chunks)
+        self.buf = b""
+        self.pos = 0
+
+    def read(self, size=-1):
+        """ up to size bytes, all the rest when size is negative """
+
+        out = []
+
+        while size < 0 or size > 0:
+            if self.pos == len(self.buf):
+                digest = next(self.chunks, [None])[0]
+                if digest is None:
+                    break
+                self.buf, self.pos = self.store.get_chunk(digest), 0
+
+            n = len(self.buf) - self.pos if size < 0 else min(size, len(self.buf) - self.pos)
+            out.append(self.buf[self.pos: self.pos + n])
+            self.pos += n
+
+            if size > 0:
+                size -= n
+
+        return b"".join(out)
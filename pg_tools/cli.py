@@ -2,16 +2,528 @@
 import argparse
 import sys
 
+# Keep the imports here light: pg_tools --help and status checks run from
+# cron shouldn't pay for psycopg2 and friends, commands import what they
+# need when they run.
 
-def main():
+DEFAULTS = {
+    "host": "localhost",
+    "port": 5432,
+    "user": "postgres",
+    "owner": None,
+    "maintdb": "postgres",
+    "pg_bin": "/usr/bin",
+    "major": None,
+    "jobs": 1,
+    "schemas": None,
+    "schemas_nodata": None,
+    "relname_nodata": None,
+    "single_transaction": False,
+}
+
+
+def add_connection_args(parser):
+    """ options shared by all the commands """
+
+    parser.add_argument("--host", help="PostgreSQL server host")
+    parser.add_argument("--port", type=int, help="PostgreSQL server port")
+    parser.add_argument("--user", help="connect as this user")
+    parser.add_argument("--owner", help="owner of created databases, default to user")
+    parser.add_argument("--maintdb", help="maintenance database, default postgres")
+    parser.add_argument("--pg-bin", dest="pg_bin", help="PostgreSQL binaries directory")
+    parser.add_argument("-j", "--jobs", type=int, help="pg_restore -j, pg_dump -j")
+    parser.add_argument("--history", metavar="FILENAME",
+                        help="durations history, default ~/.pg_tools/history.json")
+    parser.add_argument("--no-history", dest="history", action="store_const", const=False,
+                        help="don't record the durations")
+
+
+def add_governor_args(parser):
+    """ throttling options of the commands running pg_dump or pg_restore """
+
+    parser.add_argument("--rate", help="max bytes/s on the data pipe, e.g. 20M")
+    parser.add_argument("--rate-file", dest="rate_file",
+                        help="file to change the rate from while running")
+    parser.add_argument("--nice", type=int, help="nice level of the processes")
+    parser.add_argument("--ionice", help="ionice class[:level], e.g. 2:7")
+    parser.add_argument("--cpu-quota", dest="cpu_quota", type=int,
+                        help="CPU percentage, with systemd-run")
+
+
+def add_profile_args(parser):
+    """ server side profiling options """
+
+    parser.add_argument("--profile", metavar="FILENAME",
+                        help="activity timeline, .json or .csv, may use {dbname} and {step}")
+    parser.add_argument("--profile-interval", dest="profile_interval", type=float,
+                        default=1.0, help="secs between samples, default 1")
+
+
+def make_parser():
+    """ return the argparse parser """
+
+    parser = argparse.ArgumentParser(
+        prog="pg_tools", description="PostgreSQL dump, restore and refresh tools"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="debug logging")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings")
+
+    sub = parser.add_subparsers(dest="command", metavar="command")
+    sub.required = True
+
+    p = sub.add_parser("restore", help="restore a dump into a database")
+    add_connection_args(p)
+    add_governor_args(p)
+    add_profile_args(p)
+    p.add_argument("dbname")
+    p.add_argument("dump")
+    p.add_argument("--create", action="store_true", help="createdb first")
+    p.add_argument("--encoding", default="UTF8")
+    p.add_argument("-1", "--single-transaction", dest="single_transaction",
+                   action="store_true", default=None)
+    p.add_argument("-n", "--schema", dest="schemas", action="append")
+    p.add_argument("--schema-nodata", dest="schemas_nodata", action="append")
+    p.add_argument("--relname-nodata", dest="relname_nodata", action="append",
+                   help="regexp of schema.table to restore without data")
+    p.add_argument("--exclude-table-data", dest="exclude_tables", action="append",
+                   help="schema.table to restore without data")
+    p.add_argument("--checkpoint", help="resumable restore, checkpoint file")
+    p.add_argument("--vacuum", action="store_true", help="VACUUM ANALYZE after")
+    p.add_argument("--schedule", action="store_true",
+                   help="spread data and indexes across jobs by size")
+    p.add_argument("--large-objects", dest="large_objects", action="store_true",
+                   default=None, help="keep the large objects ACLs and comments "
+                   "with schema filters")
+    p.add_argument("--no-large-objects", dest="large_objects", action="store_false",
+                   default=None, help="leave the large objects out")
+    p.add_argument("--sample", dest="samples", action="append", metavar="TABLE=RULE",
+                   help="only a sample of schema.table rows, RULE being a "
+                   "percentage, a TABLESAMPLE or WHERE clause")
+    p.add_argument("--source", help="dsn of the database to sample rows from")
+    p.add_argument("--store", metavar="NAME",
+                   help="restore dump NAME of the chunk store directory dump")
+    p.add_argument("--fanout", action="append", metavar="HOST[:PORT]/DBNAME",
+                   help="also restore to this target, reading the dump once")
+    p.add_argument("--buffer-size", dest="buffer_size", default="64M",
+                   help="per target fan-out buffer, default 64M")
+    p.add_argument("--spill-dir", dest="spill_dir",
+                   help="spill slow fan-out targets data here instead of waiting")
+
+    p = sub.add_parser("dump", help="dump a database")
+    add_connection_args(p)
+    add_governor_args(p)
+    p.add_argument("dbname")
+    p.add_argument("filename", help="dump file, or base directory with --incremental")
+    p.add_argument("--format", default="c", help="pg_dump -F, default c")
+    p.add_argument("--force", action="store_true", help="overwrite filename")
+    p.add_argument("--incremental", metavar="NAME",
+                   help="incremental snapshot NAME in directory filename")
+    p.add_argument("--store", metavar="NAME",
+                   help="dump NAME in the chunk store directory filename")
+
+    p = sub.add_parser("dump-cluster", help="dump globals and all databases")
+    add_connection_args(p)
+    add_governor_args(p)
+    p.add_argument("directory")
+    p.add_argument("-c", "--concurrency", type=int, default=4,
+                   help="databases dumped at a time, default 4")
+    p.add_argument("--force", action="store_true", help="overwrite directory")
+
+    p = sub.add_parser("restore-cluster", help="restore a dump-cluster directory")
+    add_connection_args(p)
+    add_governor_args(p)
+    p.add_argument("directory")
+    p.add_argument("-c", "--concurrency", type=int, default=4,
+                   help="databases restored at a time, default 4")
+    p.add_argument("-D", "--database", dest="databases", action="append",
+                   help="only restore this database")
+
+    p = sub.add_parser("gc-store", help="expire dumps and unused chunks of a store")
+    p.add_argument("directory")
+    p.add_argument("--keep", type=int, help="keep that many most recent dumps")
+    p.add_argument("--keep-days", dest="keep_days", type=float,
+                   help="keep the dumps of the last days")
+
+    p = sub.add_parser("vacuum", help="VACUUM ANALYZE a database")
+    add_connection_args(p)
+    add_profile_args(p)
+    p.add_argument("dbname")
+
+    p = sub.add_parser("show", help="show a setting, or dbsize")
+    add_connection_args(p)
+    p.add_argument("dbname")
+    p.add_argument("setting")
+
+    p = sub.add_parser("clone", help="create databases from a template")
+    add_connection_args(p)
+    p.add_argument("template")
+    p.add_argument("targets", nargs="+", metavar="dbname")
+    p.add_argument("--dump", help="(re)build the template from this dump")
+    p.add_argument("--encoding", default="UTF8")
+    p.add_argument("--strategy", choices=["FILE_COPY", "WAL_LOG"])
+
+    p = sub.add_parser("estimate", help="estimate a dump or restore duration")
+    add_connection_args(p)
+    p.add_argument("dbname")
+    p.add_argument("dump", nargs="?", help="estimate restoring this dump")
+    p.add_argument("--schedule", action="store_true",
+                   help="for pg_tools restore --schedule")
+    p.add_argument("--no-vacuum", dest="vacuum", action="store_false", default=None)
+
+    p = sub.add_parser("run", help="run the jobs of a YAML or JSON manifest")
+    p.add_argument("manifest")
+    p.add_argument("-c", "--concurrency", type=int, help="max jobs at a time")
+
+    return parser
+
+
+def pgrestore(job):
+    """ a PGRestore instance for the job """
+
+    import os
+    from .pg_tools import PGRestore
+
+    pg = PGRestore(
+        job["dbname"],
+        job["user"],
+        job["host"],
+        job["port"],
+        job["owner"] or job["user"],
+        job["maintdb"],
+        job["major"],
+        restore_cmd=os.path.join(job["pg_bin"], "pg_restore"),
+        st=job["single_transaction"],
+        schemas=job["schemas"],
+        schemas_nodata=job["schemas_nodata"],
+        relname_nodata=job["relname_nodata"],
+    )
+    pg.restore_jobs = job["jobs"]
+    pg.large_objects = job.get("large_objects")
+    pg.profile = job.get("profile")
+    pg.profile_interval = job.get("profile_interval", 1.0)
+
+    if job.get("history") is not False:
+        from .estimate import HISTORY, History
+
+        pg.history = History(job.get("history") or HISTORY)
+
+    governed = ("rate", "rate_file", "nice", "ionice", "cpu_quota")
+    if any(job.get(k) is not None for k in governed):
+        from .governor import Governor
+
+        pg.governor = Governor(**{k: job.get(k) for k in governed})
+
+    return pg
+
+
+def fanout_target(job, target):
+    """the job for a fan-out target, given as host[:port]/dbname or, in
+    manifests, as a dict of the settings to change"""
+
+    if isinstance(target, dict):
+        return dict(job, **target)
+
+    hostport, dbname = target.rsplit("/", 1)
+    host, _, port = hostport.partition(":")
+
+    return dict(job, host=host or job["host"], port=int(port or job["port"]), dbname=dbname)
+
+
+def throughput(pg, result):
+    """ add the governor report to result """
+
+    if pg.governor is not None:
+        result["throughput"] = pg.governor.report()
+
+    return result
+
+
+def do_restore(job):
+    """ restore command """
+
+    pg = pgrestore(job)
+    result = {}
+
+    targets = [pgrestore(fanout_target(job, t)) for t in job.get("fanout") or []]
+
+    if job.get("create"):
+        for p in [pg] + targets:
+            p.createdb(job.get("encoding", "UTF8"))
+
+    if targets:
+        from .governor import parse_rate
+
+        result["restore"] = pg.pg_restore_fanout(
+            job["dump"],
+            targets,
+            parse_rate(job.get("buffer_size", "64M")),
+            job.get("spill_dir"),
+        )
+    elif job.get("samples"):
+        samples = job["samples"]
+
+        # TABLE=RULE from the command line, a dict in manifests
+        if isinstance(samples, list):
+            samples = dict(s.split("=", 1) for s in samples)
+
+        result["restore"] = pg.pg_restore_subset(job["dump"], job["source"], samples)
+    elif job.get("store"):
+        result["restore"] = pg.pg_restore_store(job["dump"], job["store"])
+    elif job.get("schedule"):
+        result["restore"] = pg.pg_restore_scheduled(job["dump"], job.get("exclude_tables"))
+    else:
+        result["restore"] = pg.pg_restore(
+            job["dump"], job.get("exclude_tables"), checkpoint=job.get("checkpoint")
+        )
+
+    if job.get("vacuum"):
+        result["vacuum"] = pg.vacuumdb()
+
+    return throughput(pg, result)
+
+
+def do_dump(job):
+    """ dump command """
+
+    pg = pgrestore(job)
+
+    result = {}
+
+    if job.get("store"):
+        elapsed, manifest = pg.pg_dump_store(
+            job["filename"],
+            job["store"],
+            fmt=f"-F{job.get('format', 'c')}",
+            force=job.get("force", False),
+        )
+        result["stored"] = manifest["written"]
+    elif job.get("incremental"):
+        elapsed = pg.pg_dump_incremental(
+            job["filename"], job["incremental"], force=job.get("force", False)
+        )
+    else:
+        elapsed = pg.pg_dump(
+            job["filename"], fmt=f"-F{job.get('format', 'c')}", force=job.get("force", False)
+        )
+
+    result["dump"] = elapsed
+
+    return throughput(pg, result)
+
+
+def do_dump_cluster(job):
+    """ dump-cluster command """
+
+    pg = pgrestore(dict(job, dbname=job["maintdb"]))
+    elapsed = pg.pg_dump_cluster(
+        job["directory"], job.get("concurrency", 4), job.get("force", False)
+    )
+
+    return throughput(pg, {"dump": elapsed})
+
+
+def do_restore_cluster(job):
+    """ restore-cluster command """
+
+    pg = pgrestore(dict(job, dbname=job["maintdb"]))
+    result = pg.pg_restore_cluster(
+        job["directory"], job.get("concurrency", 4), job.get("databases")
+    )
+
+    return throughput(pg, result)
+
+
+def do_vacuum(job):
+    """ vacuum command """
+
+    return {"vacuum": pgrestore(job).vacuumdb()}
+
+
+def do_gc_store(job):
+    """ gc-store command, no connection needed """
+
+    from .chunkstore import ChunkStore
+
+    return ChunkStore(job["directory"]).gc(job.get("keep"), job.get("keep_days"))
+
+
+def do_show(job):
+    """ show command, dbsize being the pretty printed database size """
+
+    pg = pgrestore(job)
+
+    if job["setting"] == "dbsize":
+        return {"dbsize": pg.dbsize()[1]}
+
+    return {job["setting"]: pg.show(job["setting"])}
+
+
+def do_clone(job):
+    """ clone command """
+
+    pg = pgrestore(dict(job, dbname=job["template"]))
+
+    if job.get("dump"):
+        return pg.provision(
+            job["dump"],
+            job["template"],
+            job["targets"],
+            job.get("encoding", "UTF8"),
+            job.get("strategy"),
+        )
+
+    return {
+        dbname: pg.clone_database(job["template"], dbname, job.get("strategy"))
+        for dbname in job["targets"]
+    }
+
+
+def do_estimate(job):
+    """ estimate command, returning the estimates per phase """
+
+    from .estimate import report
+
+    pg = pgrestore(job)
+
+    if job.get("dump"):
+        estimates = pg.estimate_restore(
+            job["dump"], job.get("schedule", False), job.get("vacuum", True)
+        )
+    else:
+        estimates = pg.estimate_dump(job["jobs"])
+
+    for line in report(estimates):
+        print(line)
+
+    return {e.phase: e._asdict() for e in estimates}
+
+
+COMMANDS = {
+    "restore": do_restore,
+    "dump": do_dump,
+    "vacuum": do_vacuum,
+    "show": do_show,
+    "clone": do_clone,
+    "dump-cluster": do_dump_cluster,
+    "restore-cluster": do_restore_cluster,
+    "estimate": do_estimate,
+    "gc-store": do_gc_store,
+}
+
+
+def run_job(job):
+    """ run a single job, return its result dict """
+
+    command = job.get("command")
+
+    if command not in COMMANDS:
+        from .utils import UnknownCommandException
+
+        raise UnknownCommandException(f"Error: unknown command '{command}'")
+
+    return COMMANDS[command](job)
+
+
+def load_manifest(path):
+    """return (concurrency, jobs) from a manifest such as:
+
+    concurrency: 4
+    defaults:
+      host: db1
+    jobs:
+      - name: billing
+        command: restore
+        dbname: billing
+        dump: /backups/billing.dump
+    """
+
+    with open(path) as f:
+        if path.endswith((".yml", ".yaml")):
+            try:
+                import yaml
+            except ImportError as exp:
+                from .utils import NotYetImplementedException
+
+                mesg = f"Error: can't read the YAML manifest '{path}'"
+                mesg += f"\nDetail: {exp}"
+                mesg += "\nHint: pip install pg_tools[yaml], or use a JSON manifest"
+                raise NotYetImplementedException(mesg)
+
+            manifest = yaml.safe_load(f)
+        else:
+            import json
+
+            manifest = json.load(f)
+
+    defaults = dict(DEFAULTS, **manifest.get("defaults", {}))
+
+    jobs = []
+    for i, job in enumerate(manifest.get("jobs", [])):
+        job = dict(defaults, **job)
+        job.setdefault("name", f"{job.get('command')}-{i + 1}")
+        jobs.append(job)
+
+    return manifest.get("concurrency", 1), jobs
+
+
+def run_manifest(path, concurrency=None):
+    """ run the manifest jobs, concurrency at a time, return the results """
+
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+
+    logger = logging.getLogger(__name__)
+
+    manifest_concurrency, jobs = load_manifest(path)
+    concurrency = concurrency or manifest_concurrency
+
+    def run(job):
+        logger.info(f"{job['name']}: starting")
+        try:
+            return {"job": job["name"], "status": "ok", "result": run_job(job)}
+        except Exception as exp:
+            logger.error(f"{job['name']}: {exp}")
+            return {"job": job["name"], "status": "error", "error": str(exp)}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(run, jobs))
+
+
+def main(argv=None):
     """Console script for pg_tools."""
-    parser = argparse.ArgumentParser()
-    parser.add_argument('_', nargs='*')
-    args = parser.parse_args()
+    args = make_parser().parse_args(argv)
+
+    import json
+    import logging
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    elif args.quiet:
+        level = logging.WARNING
+
+    logging.basicConfig(
+        level=level, format="%(asctime)s %(threadName)s %(levelname)s %(message)s"
+    )
+
+    if args.command == "run":
+        results = run_manifest(args.manifest, args.concurrency)
+
+        for r in results:
+            print(json.dumps(r, sort_keys=True))
+
+        return 0 if all(r["status"] == "ok" for r in results) else 1
+
+    job = dict(DEFAULTS)
+    job.update({k: v for k, v in vars(args).items() if v is not None})
+
+    result = run_job(job)
+
+    if args.command == "show":
+        print(list(result.values())[0])
+    elif args.command != "estimate":
+        print(json.dumps(result, sort_keys=True))
 
-    print("Arguments: " + str(args._))
-    print("Replace this message by putting your code into "
-          "pg_tools.cli.main")
     return 0
 
 
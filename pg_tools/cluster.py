@@ -0,0 +1,59 @@
+""" whole cluster dumps: globals once, then every database concurrently """
+import os
+import re
+import json
+
+MANIFEST = "cluster.json"
+GLOBALS = "globals.sql"
+
+##
+# A cluster dump is a directory with the roles and tablespaces dumped once
+# by pg_dumpall --globals-only, a custom format dump per database, and a
+# manifest written last:
+#
+# /backups/db1/globals.sql
+# /backups/db1/billing.dump
+# /backups/db1/crm.dump
+# /backups/db1/cluster.json
+#
+# Databases are dumped and restored largest first, a few at a time, so that
+# the whole thing takes about as long as the largest database.
+#
+# As pg_dumpall does, the databases initdb creates are restored into the
+# existing ones of the target cluster: CREATE DATABASE would fail there.
+
+EXISTING = ("postgres", "template1")
+
+DATABASES_SQL = """
+SELECT datname, pg_database_size(datname)
+  FROM pg_database
+ WHERE datallowconn AND NOT datistemplate
+ ORDER BY 2 DESC, 1
+"""
+
+
+def dump_filename(dbname):
+    """ a file name for the dump of dbname, whatever its characters """
+
+    return re.sub(r"[^\w.-]", lambda m: "%%%02X" % ord(m.group(0)), dbname) + ".dump"
+
+
+def read_manifest(directory):
+    """ return the manifest of given cluster dump directory """
+
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    """write the manifest, last, so that its presence means the dump went
+    through all the databases, each one with its status"""
+
+    path = os.path.join(directory, MANIFEST)
+
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(f"{path}.tmp", path)
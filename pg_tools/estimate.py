@@ -0,0 +1,201 @@
+""" dump and restore duration estimates, from sizes and past throughput """
+import os
+import json
+import time
+import logging
+import threading
+from collections import namedtuple
+
+from . import schedule
+
+logger = logging.getLogger(__name__)
+
+##
+# A phase duration is its work, in bytes, divided by the throughput of a
+# worker. With several workers the work is what the busiest one gets: the
+# LPT load for the scheduled restore and pg_dump -j (which dumps the largest
+# tables first), the archive order load for pg_restore -j.
+#
+# Each run records its work and duration in a history file, when given
+# one (the command line uses HISTORY unless --no-history), and the
+# estimates take the 10th, 50th and 90th percentiles of the past worker
+# throughputs of that phase for the high, expected and low durations. With
+# less than MIN_SAMPLES runs, the range is widened around the median, and
+# without any we fall back to DEFAULT_RATES.
+#
+# Phases are dump, restore (pg_restore as a whole), data and index (the
+# scheduled restore phases) and vacuum, whose work is the database size.
+
+HISTORY = os.environ.get(
+    "PG_TOOLS_HISTORY", os.path.join(os.path.expanduser("~"), ".pg_tools", "history.json")
+)
+HISTORY_SIZE = 50
+MIN_SAMPLES = 3
+
+MB = 1024 * 1024
+
+# bytes/s per worker, rough guesses until we have history
+DEFAULT_RATES = {
+    "dump": 40 * MB,
+    "restore": 10 * MB,
+    "data": 20 * MB,
+    "index": 40 * MB,
+    "vacuum": 100 * MB,
+}
+
+# how much bigger a database is than the data in its compressed archive,
+# for the vacuum of a database that doesn't exist yet
+DEFAULT_EXPANSION = 3
+
+Estimate = namedtuple(
+    "Estimate", ["phase", "bytes", "work", "jobs", "low", "expected", "high", "samples"]
+)
+
+
+def percentile(values, pct):
+    """ nearest rank percentile of values """
+
+    values = sorted(values)
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class History:
+    """Past runs work and durations, per phase, in a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ return {phase: [sample, ...]} """
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def record(self, phase, nbytes, work, secs, jobs=1):
+        """add a run of phase, work being the bytes of the busiest worker;
+        failing to save the history never fails the run"""
+
+        if secs <= 0 or work <= 0:
+            return
+
+        sample = {
+            "time": int(time.time()),
+            "bytes": nbytes,
+            "work": work,
+            "secs": secs,
+            "jobs": jobs,
+            "rate": work / secs,
+        }
+
+        with self.lock:
+            history = self.load()
+            samples = history.setdefault(phase, [])
+            samples.append(sample)
+            del samples[:-HISTORY_SIZE]
+
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                tmp = f"{self.path}.{os.getpid()}"
+                with open(tmp, "w") as f:
+                    json.dump(history, f, indent=1)
+                os.replace(tmp, self.path)
+            except (IOError, OSError) as exp:
+                logger.warning(f"Could not save history to {self.path}: {exp}")
+
+        logger.debug(f"history: {phase} {work} bytes in {secs:.1f}s")
+
+    def rates(self, phase):
+        """ per worker throughputs of past runs of phase """
+        return [s["rate"] for s in self.load().get(phase, [])]
+
+
+def predict(phase, nbytes, work, jobs, history):
+    """ return an Estimate for phase, work being the busiest worker bytes """
+
+    rates = history.rates(phase) if history is not None else []
+
+    if len(rates) >= MIN_SAMPLES:
+        fast, rate, slow = (percentile(rates, p) for p in (90, 50, 10))
+    elif rates:
+        rate = percentile(rates, 50)
+        fast, slow = rate * 1.5, rate / 1.5
+    else:
+        rate = DEFAULT_RATES[phase]
+        fast, slow = rate * 2, rate / 2
+
+    return Estimate(
+        phase, nbytes, work, jobs, work / fast, work / rate, work / slow, len(rates)
+    )
+
+
+def restore_work(filename, jobs, scheduled=False):
+    """return {phase: (bytes, work)} for restoring filename with jobs
+    workers, or None when the archive doesn't tell the data sizes"""
+
+    from . import archive
+
+    if not archive.readable(filename):
+        return None
+
+    with archive.Archive(filename) as arch:
+        entries = list(arch.entries())
+        sizes = schedule.data_sizes(arch, entries)
+
+    if not sizes:
+        return None
+
+    phases = schedule.entry_phases(entries)
+    costs = schedule.entry_costs(entries, sizes)
+
+    data = [costs[e.dump_id] for e in entries if phases[e.dump_id] == schedule.DATA]
+    index = [costs[e.dump_id] for e in entries if phases[e.dump_id] == schedule.INDEX]
+
+    def lpt_work(items):
+        return max(schedule.lpt([(c, None) for c in items], jobs)[1] or [0])
+
+    if scheduled:
+        return {
+            "data": (sum(data), lpt_work(data)),
+            "index": (sum(index), lpt_work(index)),
+        }
+
+    work = schedule.makespan(data, jobs) + schedule.makespan(index, jobs)
+    return {"restore": (sum(data), work)}
+
+
+def report(estimates):
+    """ planning report lines, with a total """
+
+    def hms(secs):
+        secs = int(secs)
+        return "%d:%02d:%02d" % (secs // 3600, secs // 60 % 60, secs % 60)
+
+    lines = [
+        "%-8s %12s %4s %9s %9s %9s %7s"
+        % ("phase", "MB", "jobs", "low", "expected", "high", "history")
+    ]
+
+    for e in estimates:
+        lines.append(
+            "%-8s %12.1f %4d %9s %9s %9s %7d"
+            % (e.phase, e.bytes / MB, e.jobs, hms(e.low), hms(e.expected), hms(e.high), e.samples)
+        )
+
+    lines.append(
+        "%-8s %12s %4s %9s %9s %9s"
+        % (
+            "total",
+            "",
+            "",
+            hms(sum(e.low for e in estimates)),
+            hms(sum(e.expected for e in estimates)),
+            hms(sum(e.high for e in estimates)),
+        )
+    )
+
+    return lines
@@ -0,0 +1,201 @@
+""" fan-out restores: read a dump once, feed it to several pg_restore """
+import os
+import time
+import logging
+import tempfile
+import threading
+from collections import deque
+
+from .governor import run_command
+
+logger = logging.getLogger(__name__)
+
+##
+# A reader reads the archive once, through the governor, and appends each
+# block to the buffer of every target. A thread per target feeds its
+# pg_restore stdin from its buffer.
+#
+# Buffers hold at most BUFFER_SIZE bytes in memory. When a target falls
+# behind, with a spill directory its blocks go to a spill file it reads
+# back later, so that the other targets go on at their own pace; without
+# one, the reader waits for the slowest target.
+#
+# A target whose pg_restore fails, or ends early, stops buffering: the
+# reader drops its blocks and the other targets go on.
+
+BUFFER_SIZE = 64 * 1024 * 1024
+BLOCK = 1024 * 1024
+
+
+class Buffer:
+    """Bounded queue of blocks from the reader to a target, spilling to disk
+    when full if given a directory, a file object on the read side"""
+
+    def __init__(self, max_bytes=BUFFER_SIZE, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.cond = threading.Condition()
+
+        self.blocks = deque()
+        self.size = 0
+
+        self.spill = None
+        self.spill_pos = 0
+        self.spilled = 0
+        self.spilled_total = 0
+
+        self.closed = False
+        self.aborted = False
+        self.pending = b""
+
+    def put(self, data):
+        """ queue data, waiting for room unless we can spill """
+
+        with self.cond:
+            if self.aborted:
+                return
+
+            if self.spill_dir is None:
+                # a block bigger than the buffer still goes through, alone
+                while self.size and self.size + len(data) > self.max_bytes:
+                    self.cond.wait()
+                    if self.aborted:
+                        return
+
+            elif self.spilled or self.size + len(data) > self.max_bytes:
+                # once spilling, everything goes to disk until it's read back
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile(
+                        dir=self.spill_dir, prefix="pg_tools_spill_"
+                    )
+
+                self.spill.seek(0, os.SEEK_END)
+                self.spill.write(data)
+                self.spilled += len(data)
+                self.spilled_total += len(data)
+                self.cond.notify_all()
+                return
+
+            self.blocks.append(data)
+            self.size += len(data)
+            self.cond.notify_all()
+
+    def close(self):
+        """ no more data, the reader is done """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        """ the target is gone, drop what we have and what comes next """
+
+        with self.cond:
+            self.aborted = True
+            self.blocks.clear()
+            self.size = 0
+
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+            self.spilled = 0
+
+            self.cond.notify_all()
+
+    def next_block(self):
+        """ the next block, b"" at the end of the stream """
+
+        with self.cond:
+            while not (self.blocks or self.spilled or self.closed or self.aborted):
+                self.cond.wait()
+
+            if self.blocks:
+                data = self.blocks.popleft()
+                self.size -= len(data)
+                self.cond.notify_all()
+                return data
+
+            if self.spilled:
+                self.spill.seek(self.spill_pos)
+                data = self.spill.read(min(self.spilled, BLOCK))
+                self.spill_pos += len(data)
+                self.spilled -= len(data)
+
+                if not self.spilled:
+                    self.spill.seek(0)
+                    self.spill.truncate()
+                    self.spill_pos = 0
+
+                return data
+
+            return b""
+
+    def read(self, size=BLOCK):
+        """ up to size bytes, b"" at the end of the stream """
+
+        if not self.pending:
+            self.pending = self.next_block()
+
+        if size < 0 or size >= len(self.pending):
+            data, self.pending = self.pending, b""
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+
+        return data
+
+
+class Tee:
+    """File object writing to all the buffers"""
+
+    def __init__(self, buffers):
+        self.buffers = buffers
+
+    def write(self, data):
+        """ the same data to every buffer """
+
+        for b in self.buffers:
+            b.put(data)
+
+
+def run(filename, targets, governor, max_bytes=BUFFER_SIZE, spill_dir=None):
+    """run the (command, governor) targets, each fed filename on stdin,
+    reading it once with governor, return (elapsed secs, exception) for
+    each target"""
+
+    buffers = [Buffer(max_bytes, spill_dir) for _ in targets]
+    results = [None] * len(targets)
+
+    def feed(i):
+        cmd, gov = targets[i]
+        t0 = time.time()
+
+        try:
+            run_command(cmd, gov, source=buffers[i])
+            results[i] = (time.time() - t0, None)
+        except Exception as exp:
+            logger.error(f"{' '.join(cmd)}: {exp}")
+            results[i] = (None, exp)
+        finally:
+            buffers[i].abort()
+
+    threads = [
+        threading.Thread(target=feed, args=(i,), name=f"fanout-{i}")
+        for i in range(len(targets))
+    ]
+    for t in threads:
+        t.start()
+
+    try:
+        with open(filename, "rb") as f:
+            governor.copy(f, Tee(buffers))
+    finally:
+        for b in buffers:
+            b.close()
+        for t in threads:
+            t.join()
+
+    for (cmd, _), b in zip(targets, buffers):
+        if b.spilled_total:
+            logger.info(f"{' '.join(cmd)}: {b.spilled_total} bytes spilled to disk")
+
+    return results
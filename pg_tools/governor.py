@@ -0,0 +1,239 @@
+""" throttling of dump and restore subprocesses, to share hosts nicely """
+import os
+import time
+import shlex
+import shutil
+import logging
+import threading
+import subprocess
+
+from .utils import SubprocessException
+
+logger = logging.getLogger(__name__)
+
+##
+# The data pipe of pg_dump output or pg_restore input goes through a token
+# bucket: each chunk costs its size in tokens, refilled at rate bytes per
+# second up to burst. When the bucket is empty the copy sleeps off the debt.
+# A single Governor may be shared by several commands, which then share the
+# bandwidth.
+#
+# The rate can be changed while commands run, with set_rate or by writing a
+# new rate in the rate_file, e.g. echo 50M > /run/pg_tools.rate
+#
+# The processes themselves can be given a lower CPU and IO priority with
+# nice and ionice, and a CPU quota with systemd-run, when available.
+
+CHUNK = 256 * 1024
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(rate):
+    """ bytes per second from 1048576, "512K", "20M" or "1G", None for 0 """
+
+    if rate is None:
+        return None
+
+    rate = str(rate).strip().upper().rstrip("B")
+    unit = rate[-1:] if rate[-1:] in UNITS else ""
+    value = float(rate[: len(rate) - len(unit)]) * UNITS[unit]
+
+    return int(value) or None
+
+
+class Governor:
+    """Token bucket for data pipes, and priorities of the processes"""
+
+    def __init__(
+        self, rate=None, burst=None, nice=None, ionice=None, cpu_quota=None, rate_file=None
+    ):
+        """rate is in bytes per second, None for no limit, ionice is a class
+        and an optional level as in "2:7", cpu_quota a percentage"""
+
+        self.lock = threading.Lock()
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_quota = cpu_quota
+        self.rate_file = rate_file
+        self.rate_mtime = None
+        self.rate_checked = 0
+
+        self.rate = None
+        self.burst = None
+        self.set_rate(rate, burst)
+
+        self.bytes = 0
+        self.started = None
+        self.waited = 0.0
+
+    def set_rate(self, rate, burst=None):
+        """ change the rate, taking effect with the next chunk """
+
+        with self.lock:
+            self.rate = parse_rate(rate)
+            self.burst = parse_rate(burst) or self.rate
+            self.tokens = self.burst or 0
+            self.stamp = time.monotonic()
+
+        logger.info(f"governor: rate {self.rate or 'unlimited'} bytes/s")
+
+    def read_rate_file(self):
+        """ pick up a new rate from rate_file, at most once a second """
+
+        now = time.monotonic()
+
+        if self.rate_file is None or now - self.rate_checked < 1:
+            return
+
+        self.rate_checked = now
+
+        try:
+            mtime = os.path.getmtime(self.rate_file)
+            if mtime == self.rate_mtime:
+                return
+
+            with open(self.rate_file) as f:
+                rate = f.read().strip()
+        except (IOError, OSError):
+            return
+
+        self.rate_mtime = mtime
+
+        try:
+            self.set_rate(rate or None)
+        except ValueError:
+            logger.warning(f"governor: bad rate '{rate}' in {self.rate_file}")
+
+    def throttle(self, size):
+        """ account for size bytes, sleeping when over the rate """
+
+        self.read_rate_file()
+
+        with self.lock:
+            now = time.monotonic()
+
+            if self.started is None:
+                self.started = now
+            self.bytes += size
+
+            if not self.rate:
+                return
+
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= size
+
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def copy(self, src, dst):
+        """ copy file object src to dst, throttled """
+
+        while True:
+            chunk = src.read(CHUNK)
+            if not chunk:
+                return
+
+            self.throttle(len(chunk))
+            dst.write(chunk)
+
+    def report(self):
+        """ bytes copied so far, elapsed secs, bytes/s and secs throttled """
+
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+
+        return {
+            "bytes": self.bytes,
+            "elapsed": elapsed,
+            "throughput": self.bytes / elapsed if elapsed else 0.0,
+            "throttled": self.waited,
+        }
+
+    def command(self, command):
+        """ command as a list, prefixed with systemd-run, nice and ionice """
+
+        if isinstance(command, str):
+            command = shlex.split(command)
+
+        prefix = []
+
+        if self.cpu_quota is not None:
+            if shutil.which("systemd-run"):
+                prefix += ["systemd-run", "--scope", "--quiet"]
+                if os.geteuid() != 0:
+                    prefix += ["--user"]
+                prefix += ["-p", f"CPUQuota={self.cpu_quota}%"]
+            else:
+                logger.warning("governor: no systemd-run, ignoring cpu quota")
+
+        if self.nice is not None:
+            prefix += ["nice", "-n", str(self.nice)]
+
+        if self.ionice is not None:
+            if shutil.which("ionice"):
+                ioclass, _, level = str(self.ionice).partition(":")
+                prefix += ["ionice", "-c", ioclass]
+                if level:
+                    prefix += ["-n", level]
+            else:
+                logger.warning("governor: no ionice, ignoring io priority")
+
+        return prefix + command
+
+
+def run_command(command, governor, source=None, sink=None):
+    """run command with governor priorities, feeding it file object source
+    on stdin or writing its stdout to file object sink, throttled, and raise
+    an exception when it fails"""
+
+    if isinstance(command, str):
+        command = shlex.split(command)
+
+    cmd = governor.command(command)
+    logger.info(cmd)
+
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if source is not None else None,
+        stdout=subprocess.PIPE if sink is not None else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+    # drain stderr aside, the pipe filling up would block the command
+    err = []
+    reader = threading.Thread(target=lambda: err.append(proc.stderr.read()))
+    reader.start()
+
+    try:
+        if source is not None:
+            try:
+                governor.copy(source, proc.stdin)
+                proc.stdin.close()
+            except BrokenPipeError:
+                # the command died, its exit code tells why
+                pass
+        else:
+            governor.copy(proc.stdout, sink)
+    except Exception:
+        proc.kill()
+        raise
+    finally:
+        reader.join()
+        proc.wait()
+
+    if proc.returncode != 0:
+        mesg = "Error [%d]: %s" % (proc.returncode, command)
+        mesg += "\nDetail: %s" % b"".join(err).decode("utf-8", "replace")
+        raise SubprocessException(mesg)
+
+    report = governor.report()
+    logger.info(
+        f"{os.path.basename(command[0])}: {report['bytes']} bytes at {report['throughput'] / 1024 / 1024:.1f}MB/s, "
+        f"throttled {report['throttled']:.1f}s"
+    )
+
+    return proc.returncode
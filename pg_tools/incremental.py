@@ -0,0 +1,138 @@
+""" incremental directory format dumps, skipping unchanged tables """
+import os
+import glob
+import json
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+PARTS = "parts"
+
+##
+# An incremental snapshot is a pg_dump -Fd directory archive, dumped with
+# --exclude-table-data for the tables that didn't change since the previous
+# snapshot. Data files of those tables are hard linked from the snapshot
+# that dumped them, along with its toc.dat, so that each snapshot is
+# complete on its own and older snapshots can be removed:
+#
+# 2021-03-02/toc.dat
+# 2021-03-02/6662.dat.gz                 changed since 2021-03-01
+# 2021-03-02/parts/2021-02-27/toc.dat
+# 2021-03-02/parts/2021-02-27/6663.dat.gz
+# 2021-03-02/manifest.json
+#
+# manifest.json records, for each table, the statistics used to detect
+# changes and where its data lives (origin snapshot and dumpId). The
+# statistics include a signature of the columns: DDL that doesn't rewrite
+# the table (ADD or DROP COLUMN) changes neither the relfilenode nor the
+# counters, and the old data wouldn't COPY into the new columns.
+#
+# The activity counters are flushed to the statistics asynchronously, a
+# table written just before the dump can look unchanged. So they only tell
+# that a table changed, a checksum of its rows confirms that it didn't.
+# Statistics and checksums are read in the transaction whose snapshot
+# pg_dump --snapshot uses, they describe the data that's dumped.
+
+TABLE_STATS_SQL = """
+SELECT n.nspname, c.relname, c.relfilenode,
+       s.n_tup_ins + s.n_tup_upd + s.n_tup_del AS n_mod,
+       (SELECT md5(string_agg(a.attname || ':' || format_type(a.atttypid, a.atttypmod),
+                              ',' ORDER BY a.attnum))
+          FROM pg_attribute a
+         WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped) AS columns
+  FROM pg_stat_user_tables s
+       JOIN pg_class c ON c.oid = s.relid
+       JOIN pg_namespace n ON n.oid = c.relnamespace
+ WHERE c.relkind IN ('r', 'm')
+"""
+
+# as in verify, a sum of hashes doesn't depend on the rows order nor grow
+TABLE_CHECKSUM_SQL = """
+SELECT count(*) || ':'
+       || coalesce(sum(('x' || substr(md5(t::text), 1, 16))::bit(64)::bigint::numeric), 0)
+  FROM {} t
+"""
+
+
+def read_manifest(snapshot):
+    """ return the manifest of given snapshot directory """
+
+    with open(os.path.join(snapshot, MANIFEST)) as f:
+        return json.load(f)
+
+
+def write_manifest(snapshot, manifest):
+    """ write the manifest, last, so that its presence means complete """
+
+    path = os.path.join(snapshot, MANIFEST)
+
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(f"{path}.tmp", path)
+
+
+def previous_snapshot(basedir, name):
+    """ return the most recent complete snapshot in basedir, or None """
+
+    if not os.path.isdir(basedir):
+        return None
+
+    names = sorted(
+        x
+        for x in os.listdir(basedir)
+        if x != name and os.path.exists(os.path.join(basedir, x, MANIFEST))
+    )
+
+    if not names:
+        return None
+
+    return os.path.join(basedir, names[-1])
+
+
+def table_changed(old, new):
+    """ compare two manifest entries of the same table """
+
+    if old is None:
+        return True
+
+    for key in ("relfilenode", "n_mod", "columns", "checksum"):
+        if old.get(key) != new.get(key):
+            return True
+
+    return False
+
+
+def data_dir(snapshot, table):
+    """ the directory archive holding the data of table in snapshot """
+
+    if table["origin"] == os.path.basename(snapshot):
+        return snapshot
+
+    return os.path.join(snapshot, PARTS, table["origin"])
+
+
+def link_data(src, dst, dump_id):
+    """hard link toc.dat and the data file of dump_id from archive src to
+    archive dst, copy when the filesystem won't link"""
+
+    os.makedirs(dst, exist_ok=True)
+
+    files = glob.glob(os.path.join(src, f"{dump_id}.dat*"))
+    files.append(os.path.join(src, "toc.dat"))
+
+    for path in files:
+        target = os.path.join(dst, os.path.basename(path))
+
+        if os.path.exists(target):
+            continue
+
+        try:
+            os.link(path, target)
+        except OSError:
+            logger.info(f"Notice: can't hard link {path}, copying it")
+            shutil.copy2(path, target)
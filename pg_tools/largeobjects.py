@@ -0,0 +1,130 @@
+""" concurrent loads of the large objects of an archive """
+import logging
+import threading
+
+from . import archive
+from .catalog import parse_catalog_line
+
+logger = logging.getLogger(__name__)
+
+##
+# Before pg_dump 17 the data of all the large objects is a single BLOBS
+# entry, that pg_restore loads one object after the other, even with -j. We
+# read the objects from the archive ourselves and write them in batches,
+# a transaction each, over several connections. The objects are created
+# empty by the BLOB entries of the pre-data section, as with pg_restore,
+# which archives older than 1.12 don't have.
+#
+# In catalogs, large objects have no schema: their ACL, COMMENT and
+# SECURITY LABEL entries are tagged "LARGE OBJECT 16385" and go with them.
+
+LO_DESCS = ("BLOB", "BLOBS", "BLOB METADATA", "LARGE OBJECT", "LARGE OBJECTS")
+DATA_DESCS = ("BLOBS", "LARGE OBJECTS")
+
+MIN_VERSION = archive.make_version(1, 12)
+
+BATCH = 1000
+BATCH_BYTES = 64 * 1024 * 1024
+
+
+def is_large_object(desc, tag):
+    """ does the catalog entry desc, tag belong to large objects """
+    return desc in LO_DESCS or (tag or "").startswith("LARGE OBJECT ")
+
+
+def drop(catalog):
+    """ comment out the large objects entries of catalog """
+
+    lines = []
+
+    for line in catalog.split("\n"):
+        e = parse_catalog_line(line)
+
+        if e is not None and is_large_object(e.desc, e.tag):
+            line = f";{line}"
+
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+def batches(filename, dump_ids, size=BATCH, max_bytes=BATCH_BYTES):
+    """iterate over lists of up to size (oid, data) from the large objects
+    data entries dump_ids, or up to max_bytes of data"""
+
+    batch, nbytes = [], 0
+
+    with archive.Archive(filename) as arch:
+        entries = [e for e in arch.entries() if e.dump_id in dump_ids]
+
+        for e in entries:
+            for oid, data in arch.blobs(e):
+                batch.append((oid, data))
+                nbytes += len(data)
+
+                if len(batch) >= size or nbytes >= max_bytes:
+                    yield batch
+                    batch, nbytes = [], 0
+
+    if batch:
+        yield batch
+
+
+def write(conn, batch):
+    """ write a batch of large objects in a transaction, return the bytes """
+
+    for oid, data in batch:
+        lo = conn.lobject(oid, "wb")
+        lo.write(data)
+        lo.close()
+
+    conn.commit()
+
+    return sum(len(data) for _, data in batch)
+
+
+def load(dsn, filename, dump_ids, jobs, size=BATCH):
+    """write the large objects of the dump_ids entries of filename over jobs
+    connections, return (objects, bytes)"""
+
+    import psycopg2
+    from concurrent.futures import ThreadPoolExecutor
+
+    local = threading.local()
+    conns = []
+    lock = threading.Lock()
+
+    def run(batch):
+        if not hasattr(local, "conn"):
+            local.conn = psycopg2.connect(dsn)
+            with lock:
+                conns.append(local.conn)
+
+        return len(batch), write(local.conn, batch)
+
+    # the archive is read ahead of the writers by at most two batches each
+    ahead = threading.BoundedSemaphore(2 * jobs)
+    futures = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for batch in batches(filename, dump_ids, size):
+                if any(f.done() and f.exception() for f in futures):
+                    break
+
+                ahead.acquire()
+                f = executor.submit(run, batch)
+                f.add_done_callback(lambda f: ahead.release())
+                futures.append(f)
+
+        results = [f.result() for f in futures]
+    finally:
+        for conn in conns:
+            conn.close()
+
+    objects = sum(n for n, _ in results)
+    nbytes = sum(b for _, b in results)
+
+    logger.info(f"large objects: {objects} objects, {nbytes} bytes, {jobs} jobs")
+
+    return objects, nbytes
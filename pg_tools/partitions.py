@@ -0,0 +1,80 @@
+""" partition hierarchies, from the archive TOC """
+import re
+
+##
+# pg_dump 14+ creates leaf partitions as plain tables and attaches them in a
+# TABLE ATTACH entry, tagged with the leaf name and depending on the leaf
+# and the parent. Older versions create them with CREATE TABLE ... PARTITION
+# OF parent, in a TABLE entry depending on the parent one. Either way the
+# hierarchy is in the dependencies, and sub-partitions make it a tree whose
+# roots are the partitioned tables that catalog rules are written against.
+#
+# The entries of a leaf, its data, indexes and constraints, follow the
+# rules of its root: a leaf in another schema comes along with its root, and
+# leaves out its data when the root data is left out.
+
+RE_PARTITION_OF = re.compile(r"\bPARTITION OF\b")
+
+# entries of a leaf partition that go with its root
+PARTITION_DESCS = (
+    "TABLE",
+    "TABLE DATA",
+    "TABLE ATTACH",
+    "INDEX",
+    "INDEX ATTACH",
+    "CONSTRAINT",
+    "CHECK CONSTRAINT",
+    "DEFAULT",
+)
+
+
+def parents(entries):
+    """ return {partition TABLE dump_id: parent TABLE dump_id} """
+
+    tables = {e.dump_id: e for e in entries if e.desc == "TABLE"}
+    names = {(e.namespace, e.tag): dump_id for dump_id, e in tables.items()}
+
+    parent = {}
+
+    for e in entries:
+        if e.desc == "TABLE ATTACH":
+            leaf = names.get((e.namespace, e.tag))
+
+            for d in e.dependencies:
+                if d in tables and d != leaf and leaf is not None:
+                    parent[leaf] = d
+
+        elif e.desc == "TABLE" and e.defn and RE_PARTITION_OF.search(e.defn):
+            for d in e.dependencies:
+                if d in tables:
+                    parent[e.dump_id] = d
+
+    return parent
+
+
+def roots(entries):
+    """return {dump_id: (schema, table)} of the root partitioned table of
+    the partitions, and of their entries in PARTITION_DESCS"""
+
+    entries = list(entries)
+    parent = parents(entries)
+    names = {e.dump_id: (e.namespace, e.tag) for e in entries if e.desc == "TABLE"}
+
+    def root(dump_id):
+        seen = set()
+        while dump_id in parent and dump_id not in seen:
+            seen.add(dump_id)
+            dump_id = parent[dump_id]
+        return dump_id
+
+    leaves = {dump_id: names[root(dump_id)] for dump_id in parent}
+    result = dict(leaves)
+
+    for e in entries:
+        if e.desc in PARTITION_DESCS and e.dump_id not in result:
+            for d in e.dependencies:
+                if d in leaves:
+                    result[e.dump_id] = leaves[d]
+                    break
+
+    return result
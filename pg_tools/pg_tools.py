@@ -1,18 +1,58 @@
 import os
 import re
-import psycopg2
+import time
+import shutil
+import threading
+from contextlib import contextmanager
 import logging
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 from . import utils
+from . import archive
+from . import chunkstore
+from . import cluster
+from . import estimate
+from . import fanout
+from . import governor
+from . import incremental
+from . import largeobjects
+from . import partitions
+from . import profiler
+from . import schedule
+from . import sqlscript
+from . import subset
+from . import verify
+from .catalog import keep_entries
+from .catalog import parse_catalog
+from .catalog import parse_catalog_line
+from .checkpoint import RestoreCheckpoint
 from .utils import CouldNotConnectPostgreSQLException
+from .utils import CouldNotGetDumpException
 from .utils import CreatedbFailedException
 from .utils import ExportFileAlreadyExistsException
+from .utils import ParseDumpFileException
+from .utils import PGRestoreFailedException
 from .utils import UnknownCommandException
+from .utils import VerificationFailedException
 
 BUFSIZE = 8 * 1024 * 1024
 
-logging.basicConfig(level=logging.INFO)
+# template databases comment, followed by the dump fingerprint
+TEMPLATE_TAG = "pg_tools template of "
+
+# max identifier length is NAMEDATALEN - 1
+NAMEDATALEN = 64
+
+# above that, copying files beats WAL logging every block of the template
+FILE_COPY_SIZE = 1024 * 1024 * 1024
+
+TABLE_SIZES_SQL = """
+SELECT pg_table_size(c.oid)
+  FROM pg_class c
+       JOIN pg_namespace n ON n.oid = c.relnamespace
+ WHERE c.relkind IN ('r', 'm')
+   AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+"""
+
 logger = logging.getLogger(__name__)
 
 
@@ -51,8 +91,17 @@ class PGRestore:
         self.schemas = schemas or []
         self.schemas_nodata = schemas_nodata or []
         self.relname_nodata = relname_nodata or []
+        # large objects have no schema: None leaves them to the schemas
+        # filter as it always went, True keeps them whole, False drops them
+        self.large_objects = None
         self.connect_timeout = connect_timeout
         self.restore_jobs = 1
+        self.drop_threads = []
+        self.governor = None
+        self.profile = None
+        self.profile_interval = 1.0
+        # an estimate.History to record the durations in, when set
+        self.history = None
         self.mconn = None
 
         # check that the pg_restore binary do exists
@@ -66,6 +115,9 @@ class PGRestore:
         if not connect:
             return
 
+        # psycopg2 takes a while to import, only pay for it when connecting
+        import psycopg2
+
         try:
             self.mconn = psycopg2.connect(self.dsn)
         except Exception as exp:
@@ -84,27 +136,35 @@ class PGRestore:
             self.mconn = None
 
     def source_sql_file(self, filename):
-        """ load the given SQL file into the maintenance connection """
+        """load the given SQL file into the maintenance database, return
+        None when all went fine, the number of errors otherwise"""
+
+        result = self.run_sql_file(filename, dbname=self.maintdb)
+
+        return result.errors or None
+
+    def run_sql_file(self, filename, dbname=None, batch=100, on_error_stop=False):
+        """run the given SQL file in process, sending statements in batches,
+        psql is only used for backslash meta-commands"""
 
-        # we use the psql console in order to support extended commands
-        cmd = "psql -U %s -h %s -p %s -f %s %s " % (
+        if dbname is None:
+            dbname = self.dbname
+
+        psql = sqlscript.psql_command(
+            self.restore_cmd.replace("pg_restore", "psql"),
             self.user,
             self.host,
             self.port,
-            filename,
-            self.maintdb,
+            dbname,
         )
 
-        logger.info(cmd)
-
-        out = os.popen(cmd)
-        line = "stupid init value"
-        while line != "":
-            line = out.readline()
-            logger.info(line[:-1])
+        logger.info(f"{filename} > {dbname}")
 
-        returncode = out.close()
-        return returncode
+        conn = self.connect(dbname)
+        try:
+            return sqlscript.run_script(conn, filename, psql, batch, on_error_stop)
+        finally:
+            conn.close()
 
     def createdb(self, encoding):
         """ connect to remote PostgreSQL server to create the new database"""
@@ -113,7 +173,7 @@ class PGRestore:
 
         try:
             # create database can't run from within a transaction
-            self.mconn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            self.mconn.autocommit = True
             curs = self.mconn.cursor()
             curs.execute(
                 f'CREATE DATABASE "{self.dbname}" '
@@ -135,7 +195,7 @@ class PGRestore:
 
         try:
             # drop database can't run from within a transaction
-            self.mconn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            self.mconn.autocommit = True
             curs = self.mconn.cursor()
             curs.execute(f'DROP DATABASE "{self.dbname}"')
             curs.close()
@@ -149,46 +209,210 @@ class PGRestore:
 
         logger.info(f"vacuumdb analyze {self.dbname}")
 
+        # VACUUM only processes the database we're connected to
+        conn = self.connect()
+
         try:
             # vacuum database can't run from within a transaction
-            self.mconn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-            curs = self.mconn.cursor()
+            conn.autocommit = True
+            curs = conn.cursor()
 
             # mesure pg_restore timing
             import time
 
             start_time = time.time()
 
-            curs.execute("VACUUM ANALYZE")
+            with self.profiling("vacuumdb"):
+                curs.execute("VACUUM ANALYZE")
 
             end_time = time.time()
 
+            curs.execute("SELECT pg_database_size(current_database())")
+            size = curs.fetchone()[0]
+
             curs.close()
-        except Exception:
-            raise
+        finally:
+            conn.close()
+
+        self.learn("vacuum", size, size, end_time - start_time)
 
         return end_time - start_time
 
+    def table_sizes(self):
+        """ sizes of the tables of the target database, in bytes """
+
+        conn = self.connect()
+        try:
+            curs = conn.cursor()
+            curs.execute(TABLE_SIZES_SQL)
+            return [int(size) for size, in curs.fetchall()]
+        finally:
+            conn.close()
+
+    def learn(self, phase, nbytes, work, secs, jobs=1):
+        """ add a run to the durations history, never failing the run """
+
+        if self.history is None:
+            return
+
+        try:
+            self.history.record(phase, nbytes, work, secs, jobs)
+        except Exception as exp:
+            logger.warning(f"Could not record {phase} duration: {exp}")
+
+    def learn_restore(self, filename, timings):
+        """ add the restore phases timings to the durations history """
+
+        if self.history is None:
+            return
+
+        try:
+            work = estimate.restore_work(
+                filename, self.restore_jobs, scheduled="restore" not in timings
+            )
+        except Exception as exp:
+            logger.warning(f"Could not record restore duration: {exp}")
+            return
+
+        # the small pre and post data phases go with the big ones
+        phases = {
+            "restore": timings.get("restore", 0),
+            "data": timings.get("pre", 0)
+            + timings.get("data", 0)
+            + timings.get("blobs", 0),
+            "index": timings.get("index", 0) + timings.get("post", 0),
+        }
+
+        for phase, (nbytes, phase_work) in (work or {}).items():
+            self.learn(phase, nbytes, phase_work, phases[phase], self.restore_jobs)
+
+    def estimate_dump(self, jobs=1):
+        """return dump duration Estimates, from the tables sizes, pg_dump
+        -j dumping the largest tables first"""
+
+        sizes = self.table_sizes()
+        work = max(schedule.lpt([(size, None) for size in sizes], jobs)[1] or [0])
+
+        estimates = [estimate.predict("dump", sum(sizes), work, jobs, self.history)]
+
+        for line in estimate.report(estimates):
+            logger.info(line)
+
+        return estimates
+
+    def estimate_restore(self, filename, scheduled=False, vacuum=True):
+        """return restore duration Estimates per phase, from the archive
+        data sizes, restore_jobs and the history of past runs"""
+
+        jobs = self.restore_jobs
+        work = estimate.restore_work(filename, jobs, scheduled)
+
+        if work is None:
+            # no data sizes, the whole archive on a single worker
+            size = os.path.getsize(archive.toc_path(filename))
+            work = {"restore": (size, size)}
+
+        estimates = [
+            estimate.predict(phase, nbytes, w, jobs, self.history)
+            for phase, (nbytes, w) in work.items()
+        ]
+
+        if vacuum:
+            # a refresh replaces a database of about the same size
+            if self.mconn is not None and self.database_exists(self.dbname):
+                size = self.dbsize()[0]
+            else:
+                size = sum(nbytes for nbytes, _ in work.values())
+                size *= estimate.DEFAULT_EXPANSION
+
+            estimates.append(estimate.predict("vacuum", size, size, 1, self.history))
+
+        for line in estimate.report(estimates):
+            logger.info(line)
+
+        return estimates
+
+    @contextmanager
+    def profiling(self, step):
+        """sample the server activity during step, when self.profile is set
+        to an output filename, which may contain {dbname} and {step}"""
+
+        if self.profile is None:
+            yield None
+            return
+
+        output = self.profile.format(dbname=self.dbname, step=step)
+
+        with profiler.Profiler(self.db_dsn(), output, self.profile_interval) as p:
+            yield p
+
+    def governed(self, cmd):
+        """ cmd with the governor process priorities, if any """
+
+        if self.governor is None:
+            return cmd
+
+        return self.governor.command(cmd)
+
     def try_connection(self, timeout=None):
         """try to connect to target database and raise Exception after
         timeout, this helps preventing pgbouncer pause issues and waiting
         before a non running pg_restore"""
 
-        if timeout is None:
-            timeout = self.connect_timeout
-
-        dsn = f"dbname='{self.dbname}' user='{self.user}' host='{self.host}' port={self.port} connect_timeout={timeout}"
+        dsn = self.db_dsn(timeout)
 
         logger.info(f"Trying to connect to: {dsn}")
 
+        import psycopg2
+
         try:
             mconn = psycopg2.connect(dsn)
             mconn.close()
         except Exception:
             raise
 
-    def pg_restore(self, filename, excluding_tables=None):
-        """ restore dump file to new database """
+    def connect(self, dbname=None, timeout=None, options=None):
+        """return a new connection to the target database, or dbname, with
+        the given libpq options, e.g. session settings"""
+
+        import psycopg2
+
+        kwargs = {}
+        if options:
+            kwargs["options"] = options
+
+        return psycopg2.connect(self.db_dsn(timeout, dbname), **kwargs)
+
+    def db_dsn(self, timeout=None, dbname=None):
+        """ return the connection string to the target database """
+
+        if timeout is None:
+            timeout = self.connect_timeout
+
+        if dbname is None:
+            dbname = self.dbname
+
+        return f"dbname='{dbname}' user='{self.user}' host='{self.host}' port={self.port} connect_timeout={timeout}"
+
+    def truncate_table(self, schema, table):
+        """ TRUNCATE ONLY schema.table in the target database """
+
+        sql = f'TRUNCATE ONLY "{schema}"."{table}"'
+
+        logger.info(sql)
+
+        conn = self.connect()
+        try:
+            curs = conn.cursor()
+            curs.execute(sql)
+            conn.commit()
+            curs.close()
+        finally:
+            conn.close()
+
+    def pg_restore(self, filename, excluding_tables=None, checkpoint=None):
+        """restore dump file to new database, when given a checkpoint
+        filename, the restore resumes where a previous run failed"""
 
         if not excluding_tables:
             excluding_tables = []
@@ -221,15 +445,35 @@ class PGRestore:
         if self.restore_jobs > 1:
             cmd += ["-j", str(self.restore_jobs)]
 
+        if checkpoint and self.st:
+            logger.info("Notice: single transaction restore, ignoring checkpoint")
+            checkpoint = None
+
         # Exclude some schemas at restore time?
         catalog = ""
-        if self.schemas or self.schemas_nodata:
+        ckpt = None
+        if checkpoint:
+            # try to connect with a safe timeout, we might have to truncate
+            self.try_connection()
+
+            ckpt, catalog = self.resume_catalog(
+                filename, excluding_tables, checkpoint
+            )
+
+            cmd += ["-L", catalog, "--verbose", "--exit-on-error"]
+
+        elif self.schemas or self.schemas_nodata:
             catalog = str(
                 self.get_catalog(filename, excluding_tables, out_to_file=True)
             )
 
             cmd += ["-L", catalog]
 
+        elif self.large_objects is False:
+            catalog = self.catalog_to_file(largeobjects.drop(self.list_catalog(filename)))
+
+            cmd += ["-L", catalog]
+
         cmd += [filename]
 
         # now filter out empty array elements in order to prepare a command
@@ -248,18 +492,226 @@ class PGRestore:
 
         # utils.run_command will raise a SubprocessException if pg_restore
         # returns an error code (non zero)
-        out = utils.run_command(cmd, returning=utils.RET_OUT)
+        with self.profiling("pg_restore"):
+            if ckpt is None and self.governor is not None:
+                if self.restore_jobs > 1 or os.path.isdir(filename):
+                    # pg_restore needs to seek in the archive itself
+                    logger.info("Notice: pg_restore input can't be throttled")
+                    utils.run_command(self.governed(cmd), returning=utils.RET_OUT)
+                else:
+                    with open(filename, "rb") as source:
+                        governor.run_command(cmd[:-1], self.governor, source=source)
+            elif ckpt is None:
+                utils.run_command(cmd, returning=utils.RET_OUT)
+            else:
+                ckpt.open()
+                try:
+                    utils.stream_command(self.governed(cmd), ckpt.feed)
+                finally:
+                    ckpt.close()
+
+                # we made it, next run will be a complete restore again
+                ckpt.remove()
 
         end_time = time.time()
 
+        # partial restores would skew the history
+        if not catalog:
+            self.learn_restore(filename, {"restore": end_time - start_time})
+
         # time elapsed, in secs
         return end_time - start_time
 
+    def pg_restore_scheduled(self, filename, excluding_tables=None):
+        """restore dump file with restore_jobs pg_restore workers, spreading
+        the data and index entries across them by size, largest first"""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self.st or self.restore_jobs < 2 or not archive.readable(filename):
+            logger.info("Notice: nothing to schedule, using pg_restore")
+            return self.pg_restore(filename, excluding_tables)
+
+        if self.schemas or self.schemas_nodata:
+            catalog = self.get_catalog(filename, excluding_tables).getvalue()
+        elif self.large_objects is False:
+            catalog = largeobjects.drop(self.list_catalog(filename))
+        else:
+            catalog = self.list_catalog(filename)
+
+        steps = schedule.plan(filename, catalog, self.restore_jobs)
+
+        if steps is None:
+            logger.info(f"Notice: no data sizes in '{filename}', using pg_restore")
+            return self.pg_restore(filename, excluding_tables)
+
+        cmd = [
+            self.restore_cmd,
+            "-h",
+            self.host,
+            "-p",
+            str(self.port),
+            "-U",
+            self.user,
+            "-d",
+            self.dbname,
+        ]
+
+        self.try_connection()
+
+        start_time = time.time()
+        timings = {}
+
+        with self.profiling("pg_restore"):
+            for phase, catalogs, loads in steps:
+                step_time = time.time()
+
+                if phase == schedule.BLOBS:
+                    dump_ids = set(e.dump_id for e in parse_catalog(catalogs[0]))
+                    self.load_large_objects(filename, dump_ids)
+
+                    logger.info(f"{phase}: done in {time.time() - step_time:.1f}s")
+                    timings[phase] = time.time() - step_time
+                    continue
+
+                logger.info(f"{phase}: {len(catalogs)} pg_restore, loads {loads} bytes")
+
+                lists = [self.catalog_to_file(c) for c in catalogs]
+
+                try:
+                    with ThreadPoolExecutor(max_workers=len(lists)) as executor:
+                        futures = [
+                            executor.submit(
+                                utils.run_command, self.governed(cmd + ["-L", listing, filename])
+                            )
+                            for listing in lists
+                        ]
+
+                        # wait for all the workers before raising
+                        errors = [f.exception() for f in futures]
+                finally:
+                    for listing in lists:
+                        os.unlink(listing)
+
+                for exp in errors:
+                    if exp is not None:
+                        raise exp
+
+                logger.info(f"{phase}: done in {time.time() - step_time:.1f}s")
+                timings[phase] = time.time() - step_time
+
+        if not (self.schemas or self.schemas_nodata):
+            self.learn_restore(filename, timings)
+
+        return time.time() - start_time
+
+    def load_large_objects(self, filename, dump_ids, jobs=None):
+        """write the large objects data of the dump_ids entries of filename,
+        in batches over jobs connections, restore_jobs by default, and
+        return the elapsed secs"""
+
+        jobs = jobs or self.restore_jobs
+
+        start_time = time.time()
+
+        largeobjects.load(self.db_dsn(), filename, dump_ids, jobs)
+
+        return time.time() - start_time
+
+    def pg_restore_subset(self, filename, source, samples):
+        """restore dump file with only a sample of the rows of some tables,
+        samples being {schema.table: rule}, a rule being a percentage, a
+        TABLESAMPLE or WHERE clause, copied from the source database dsn
+        along with the rows their foreign keys need"""
+
+        import psycopg2
+
+        if self.schemas or self.schemas_nodata:
+            catalog = self.get_catalog(filename, None).getvalue()
+        else:
+            catalog = self.list_catalog(filename)
+
+        catalog = self.catalog_to_file(subset.drop_data(catalog, samples))
+
+        cmd = self.governed(
+            [
+                self.restore_cmd,
+                "-h",
+                self.host,
+                "-p",
+                str(self.port),
+                "-U",
+                self.user,
+                "-d",
+                self.dbname,
+            ]
+        )
+
+        if self.restore_jobs > 1:
+            cmd += ["-j", str(self.restore_jobs)]
+
+        cmd += ["-L", catalog]
+
+        self.try_connection()
+
+        start_time = time.time()
+
+        try:
+            with self.profiling("pg_restore"):
+                utils.run_command(cmd + ["--section=pre-data", "--section=data", filename])
+
+                src = psycopg2.connect(source)
+                dst = self.connect()
+                try:
+                    counts = subset.load(src, dst, samples)
+                finally:
+                    src.close()
+                    dst.close()
+
+                # foreign keys get checked here
+                utils.run_command(cmd + ["--section=post-data", filename])
+        finally:
+            os.unlink(catalog)
+
+        for name, rows in sorted(counts.items()):
+            logger.info(f"{name}: {rows} rows")
+
+        return time.time() - start_time
+
+    def resume_catalog(self, filename, excluding_tables, checkpoint):
+        """return the checkpoint and a catalog file containing only the
+        entries that a previous run didn't restore yet"""
+
+        if self.schemas or self.schemas_nodata:
+            listing = self.get_catalog(filename, excluding_tables).getvalue()
+        else:
+            listing = self.list_catalog(filename)
+
+        ckpt = RestoreCheckpoint(checkpoint, filename, listing)
+
+        # entries in progress when the previous run failed might be partly
+        # there already (--inserts dumps, COPY done but not yet reported),
+        # restart them from an empty table
+        for entry in ckpt.in_progress():
+            if entry.desc == "TABLE DATA":
+                self.truncate_table(entry.schema, entry.tag)
+
+        return ckpt, self.catalog_to_file(ckpt.filter_catalog(listing))
+
+    def list_catalog(self, filename):
+        """return the backup catalog as pg_restore -l does, reading the
+        archive TOC ourselves when we know its format"""
+
+        if archive.readable(filename):
+            return archive.listing(filename)
+
+        cmd = [self.restore_cmd, "-l", filename]
+        return utils.run_command(cmd, returning=utils.RET_OUT, universal_newlines=True)
+
     def get_catalog(self, filename, tables, out_to_file=False):
         """ return the backup catalog, pg_restore -l, commenting table data """
 
-        cmd = [self.restore_cmd, "-l", filename]
-        out = utils.run_command(cmd, returning=utils.RET_OUT)
+        out = self.list_catalog(filename)
 
         from io import StringIO
 
@@ -303,7 +755,7 @@ class PGRestore:
         if schemas is None:
             schemas = []
 
-        md_schemas = schemas
+        md_schemas = list(schemas)
         if self.schemas_nodata:
             md_schemas += self.schemas_nodata
 
@@ -315,13 +767,64 @@ class PGRestore:
         # which triggers calls which function (schema qualified) cache
         triggers = self.get_trigger_funcs(filename)
 
+        # partitions entries follow the rules of their root partitioned table
+        roots = {}
+        if archive.readable(filename):
+            with archive.Archive(filename) as arch:
+                roots = partitions.roots(arch.entries())
+
+        # schemas of the partitions of the tables we restore
+        partition_schemas = set()
+        for line in out.split("\n"):
+            e = parse_catalog_line(line)
+            if e is not None and e.dump_id in roots and roots[e.dump_id][0] in md_schemas:
+                partition_schemas.add(e.schema)
+
+        def data_filtered_out(schema, table):
+            """ is the data of schema.table left out """
+
+            if self.schemas_nodata and schema in self.schemas_nodata:
+                return True
+
+            if (schema, table) in splitted_tables:
+                return True
+
+            return any(re.search(r, f"{schema}.{table}") for r in self.relname_nodata)
+
         for line in out.split("\n"):
             if line.strip() == "":
                 continue
 
             filter_out = False
+            e = parse_catalog_line(line)
+
+            if e is not None and largeobjects.is_large_object(e.desc, e.tag):
+                # large objects are data, without a schema: by default the
+                # objects and their data stay and, as the schema rules
+                # always had it, their ACL and COMMENT entries go
+                if self.large_objects is None:
+                    filter_out = e.desc in ("ACL", "COMMENT")
+                else:
+                    filter_out = not self.large_objects
+
+            elif e is not None and e.dump_id in roots:
+                schema, table = roots[e.dump_id]
+                filter_out = schema not in md_schemas
+
+                if not filter_out and e.desc == "TABLE DATA":
+                    filter_out = data_filtered_out(schema, table) or data_filtered_out(
+                        e.schema, e.tag
+                    )
+
+            elif (
+                e is not None
+                and e.desc in ("SCHEMA", "ACL")
+                and e.schema == "-"
+                and e.tag in partition_schemas
+            ):
+                filter_out = False
 
-            if (
+            elif (
                 line.find("SCHEMA") > -1
                 or line.find("ACL") > -1
                 or line.find("TABLE") > -1
@@ -428,24 +931,24 @@ class PGRestore:
             else:
                 catalog.write(f"{line}\n")
 
-        # chop last \n
-        if "SEEK_CUR" in os.__dict__:
-            whence = os.SEEK_CUR
-        else:
-            whence = 1
-
-        catalog.seek(-1, whence)
+        # chop last \n, text streams only seek to tell() positions
+        catalog.seek(catalog.tell() - 1)
         catalog.truncate()
 
         if not out_to_file:
             return catalog
 
+        return self.catalog_to_file(catalog.getvalue())
+
+    def catalog_to_file(self, catalog):
+        """ write catalog to a temporary file, for pg_restore -L """
+
         import tempfile
 
         fd, realname = tempfile.mkstemp(prefix="/tmp/staging.", suffix=".catalog")
 
-        temp = os.fdopen(fd, "wb")
-        temp.write(catalog.getvalue())
+        temp = os.fdopen(fd, "w")
+        temp.write(catalog)
         temp.close()
 
         return realname
@@ -470,8 +973,12 @@ class PGRestore:
     def get_trigger_funcs(self, filename):
         """ return the backup catalog, pg_restore -l, commenting table data """
 
+        # no need to render the whole schema when we can read the TOC
+        if archive.readable(filename):
+            return archive.trigger_funcs(filename)
+
         cmd = [self.restore_cmd, "-s", filename]
-        out = utils.run_command(cmd, returning=utils.RET_OUT)
+        out = utils.run_command(cmd, returning=utils.RET_OUT, universal_newlines=True)
 
         # expressions we're searching
         set_search_path = "SET search_path = "
@@ -605,16 +1112,14 @@ class PGRestore:
             raise
 
     def psql_source_file(self, filename=None):
-        """ launch psql and connect to given database """
+        """launch psql and connect to given database, or run the given SQL
+        file there and return a sqlscript.ScriptResult"""
 
         if filename:
-            dash_f = f" -f {filename} "
-        else:
-            dash_f = ""
+            return self.run_sql_file(filename)
 
-        cmd = "%s %s -U %s -h %s -p %d %s" % (
+        cmd = "%s -U %s -h %s -p %d %s" % (
             self.restore_cmd.replace("pg_restore", "psql"),
-            dash_f,
             self.user,
             self.host,
             self.port,
@@ -623,10 +1128,7 @@ class PGRestore:
 
         logger.info(cmd)
 
-        if filename is None:
-            return os.system(cmd)
-        else:
-            return utils.run_command(cmd, returning=utils.RET_OUT)
+        return os.system(cmd)
 
     def pg_dump(self, filename, fmt="-Fc", force=False):
         """ pg_dump to filename, formating to -Fc by default """
@@ -648,6 +1150,9 @@ class PGRestore:
         if not force and os.path.exists(filename):
             raise ExportFileAlreadyExistsException
 
+        # the sizes are only for the history, don't query them otherwise
+        sizes = self.table_sizes() if self.history is not None else []
+
         f = open(filename, "wb", BUFSIZE)
 
         # mesure pg_dump timing
@@ -657,10 +1162,971 @@ class PGRestore:
 
         # utils.run_command will raise a SubprocessException if pg_restore
         # returns an error code (non zero)
-        out = utils.run_command(cmd, stdout=f)
-        f.close()
+        try:
+            if self.governor is not None:
+                governor.run_command(cmd, self.governor, sink=f)
+            else:
+                utils.run_command(cmd, stdout=f)
+        finally:
+            f.close()
+
+        end_time = time.time()
+
+        self.learn("dump", sum(sizes), sum(sizes), end_time - start_time)
+
+        # time elapsed, in secs
+        return end_time - start_time
+
+    def extract_table(self, filename, table, csvfile=None):
+        """load the data of schema.table from a custom or directory archive
+        into the same table of the target database, or to a CSV file, going
+        straight to the table data instead of reading the whole archive"""
+
+        schema, relname = table.split(".", 1)
+
+        if not archive.readable(filename):
+            mesg = f"Error: can't read the TOC of '{filename}'"
+            mesg += "\nHint: only custom and directory archives are supported"
+            raise ParseDumpFileException(mesg)
+
+        # mesure extraction timing
+        import time
+
+        start_time = time.time()
+
+        with archive.Archive(filename) as a:
+            encoding = a.encoding()
+            entry = a.find("TABLE DATA", schema, relname)
+
+            if entry is None:
+                mesg = f"Error: no data for table '{table}' in '{filename}'"
+                raise ParseDumpFileException(mesg)
+
+            reader = archive.DataReader(a.data(entry))
+
+            if csvfile:
+                logger.info(f"{entry.copy_stmt.strip()} > {csvfile}")
+
+                pyenc = archive.python_encoding(encoding)
+                with open(csvfile, "w", encoding=pyenc, newline="") as out:
+                    rows = archive.copy_to_csv(reader, out, pyenc)
+
+                logger.info(f"{table}: {rows} rows written to {csvfile}")
+
+            else:
+                logger.info(entry.copy_stmt.strip())
+
+                # try to connect with a safe timeout, raise an exception when failing
+                self.try_connection()
+
+                conn = self.connect()
+                try:
+                    conn.set_client_encoding(encoding)
+                    curs = conn.cursor()
+                    curs.copy_expert(entry.copy_stmt, reader, size=BUFSIZE)
+                    conn.commit()
+                    curs.close()
+                finally:
+                    conn.close()
+
+            logger.info(f"{table}: {reader.size} bytes of COPY data")
+
+        end_time = time.time()
+
+        # time elapsed, in secs
+        return end_time - start_time
+
+    def table_checks(self, exact=True, checksum=False, ranges=1, jobs=4):
+        """return the row counts, and checksums, of the target database
+        tables, to be saved at dump time with verify.write_stats"""
+
+        return verify.collect(self.db_dsn(), exact, checksum, ranges, jobs)
+
+    def verify(
+        self,
+        source=None,
+        stats=None,
+        exact=True,
+        checksum=False,
+        ranges=1,
+        jobs=4,
+        tolerance=0.1,
+    ):
+        """compare the restored tables to the source database, given as a
+        dsn, or to stats captured at dump time (a dict or a filename), and
+        return a per table report"""
+
+        logger.info(f"Verifying {self.dbname} with {jobs} connections")
+
+        start_time = time.time()
+
+        if source:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # both sides at the same time, each with its own pool
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                expected = executor.submit(
+                    verify.collect, source, exact, checksum, ranges, jobs
+                )
+                found = executor.submit(
+                    verify.collect, self.db_dsn(), exact, checksum, ranges, jobs
+                )
+                expected, found = expected.result(), found.result()
+        else:
+            if isinstance(stats, str):
+                stats = verify.read_stats(stats)
+            expected = stats
+            found = self.table_checks(exact, checksum, ranges, jobs)
+
+        report = verify.compare(expected, found, exact, tolerance)
+
+        for check in report:
+            if check.status != "pass":
+                logger.error(
+                    f"{check.table}: {check.status}, "
+                    f"{check.rows} rows, expected {check.expected_rows}"
+                )
+
+        failed = len([c for c in report if c.status != "pass"])
+        logger.info(
+            f"Verified {len(report)} tables in {time.time() - start_time:.1f}s, "
+            f"{failed} failed"
+        )
+
+        return report
+
+    @contextmanager
+    def exported_snapshot(self):
+        """a read only repeatable read transaction on the target database,
+        yielding its connection and its snapshot for pg_dump --snapshot"""
+
+        # checksums hash the rows text output, that depends on settings
+        conn = self.connect(options=verify.session_options())
+        try:
+            conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+
+            curs = conn.cursor()
+            curs.execute("SELECT pg_export_snapshot()")
+            snapshot_id = curs.fetchone()[0]
+            curs.close()
+
+            yield conn, snapshot_id
+        finally:
+            conn.close()
+
+    def table_stats(self, checksum=False, conn=None):
+        """return {schema.table: stats} for the target database tables, as
+        used to detect which tables changed between two dumps, reading them
+        on conn when given"""
+
+        logger.info(incremental.TABLE_STATS_SQL)
+
+        stats = {}
+        own = conn is None
+        if own:
+            conn = self.connect(options=verify.session_options())
+        try:
+            curs = conn.cursor()
+            curs.execute(incremental.TABLE_STATS_SQL)
+
+            for schema, table, relfilenode, n_mod, columns in curs.fetchall():
+                stats[f"{schema}.{table}"] = {
+                    "schema": schema,
+                    "table": table,
+                    "relfilenode": int(relfilenode),
+                    "n_mod": int(n_mod),
+                    "columns": columns,
+                    "checksum": None,
+                }
+
+            # reading every table is expensive, but catches changes that
+            # statistics miss (stats reset, lost stats after a crash)
+            if checksum:
+                for t in stats.values():
+                    relname = verify.relname(t["schema"], t["table"])
+                    curs.execute(incremental.TABLE_CHECKSUM_SQL.format(relname))
+                    t["checksum"] = curs.fetchone()[0]
+
+            curs.close()
+        finally:
+            if own:
+                conn.close()
+
+        return stats
+
+    def pg_dump_incremental(self, basedir, name, checksum=True, force=False):
+        """pg_dump -Fd to basedir/name, only dumping the data of tables that
+        changed since the previous snapshot found in basedir; without
+        checksum, the statistics counters alone decide and may miss the
+        latest writes"""
+
+        snapshot = os.path.join(basedir, name)
+
+        # try to connect with a safe timeout, raise an exception when failing
+        self.try_connection()
+
+        if os.path.exists(snapshot):
+            if not force:
+                raise ExportFileAlreadyExistsException
+            shutil.rmtree(snapshot)
+
+        # mesure pg_dump timing
+        import time
+
+        start_time = time.time()
+
+        previous = incremental.previous_snapshot(basedir, name)
+        old = {}
+        if previous:
+            old = incremental.read_manifest(previous)["tables"]
+
+        if not checksum:
+            logger.info("Notice: no checksum, tables written lately may look unchanged")
+
+        # pg_dump sees the data the statistics and checksums were read from
+        with self.exported_snapshot() as (conn, snapshot_id):
+            tables = self.table_stats(checksum, conn)
+            unchanged = set(
+                k for k, t in tables.items() if not incremental.table_changed(old.get(k), t)
+            )
+
+            logger.info(
+                f"{len(tables) - len(unchanged)} of {len(tables)} tables changed since {previous}"
+            )
+
+            cmd = [
+                self.restore_cmd.replace("pg_restore", "pg_dump"),
+                "-Fd",
+                "-f",
+                snapshot,
+                f"--snapshot={snapshot_id}",
+                "-U",
+                self.user,
+                "-h",
+                self.host,
+                "-p",
+                str(self.port),
+            ]
+
+            if self.restore_jobs > 1:
+                cmd += ["-j", str(self.restore_jobs)]
+
+            for key in sorted(unchanged):
+                t = tables[key]
+                cmd.append('--exclude-table-data="%s"."%s"' % (t["schema"], t["table"]))
+
+            cmd.append(self.dbname)
+
+            utils.run_command(self.governed(cmd))
+
+        # now find out where the data of each table lives
+        listing = self.list_catalog(snapshot)
+        dump_ids = {
+            (e.schema, e.tag): e.dump_id
+            for e in parse_catalog(listing)
+            if e.desc == "TABLE DATA"
+        }
+
+        for key, t in tables.items():
+            if key in unchanged:
+                t["origin"] = old[key]["origin"]
+                t["dump_id"] = old[key]["dump_id"]
+
+                if t["dump_id"] is not None:
+                    src = incremental.data_dir(previous, old[key])
+                    dst = os.path.join(snapshot, incremental.PARTS, t["origin"])
+                    incremental.link_data(src, dst, t["dump_id"])
+            else:
+                t["origin"] = name
+                t["dump_id"] = dump_ids.get((t["schema"], t["table"]))
+
+        manifest = {
+            "dbname": self.dbname,
+            "name": name,
+            "previous": previous and os.path.basename(previous),
+            "tables": tables,
+        }
+        incremental.write_manifest(snapshot, manifest)
 
         end_time = time.time()
 
         # time elapsed, in secs
         return end_time - start_time
+
+    def pg_restore_incremental(self, snapshot):
+        """restore an incremental snapshot: pre-data, data dumped in the
+        snapshot, data linked from older snapshots, then post-data, each
+        filtered by the schemas rules as pg_restore does"""
+
+        manifest = incremental.read_manifest(snapshot)
+
+        cmd = self.governed(
+            [
+                self.restore_cmd,
+                "-h",
+                self.host,
+                "-p",
+                str(self.port),
+                "-U",
+                self.user,
+                "-d",
+                self.dbname,
+            ]
+        )
+
+        if self.restore_jobs > 1:
+            cmd += ["-j", str(self.restore_jobs)]
+
+        # try to connect with a safe timeout, raise an exception when failing
+        self.try_connection()
+
+        # mesure pg_restore timing
+        import time
+
+        start_time = time.time()
+
+        filtered = self.schemas or self.schemas_nodata
+
+        def listing(archive_dir):
+            """ the catalog of archive_dir, filtered as get_catalog does """
+
+            if filtered:
+                return self.get_catalog(archive_dir, []).getvalue()
+            return self.list_catalog(archive_dir)
+
+        main = cmd
+        if filtered:
+            main = cmd + ["-L", self.catalog_to_file(listing(snapshot))]
+
+        with self.profiling("pg_restore"):
+            utils.run_command(main + ["--section=pre-data", snapshot])
+            utils.run_command(main + ["--section=data", snapshot])
+
+            # {origin: [dump_id, ...]}
+            parts = {}
+            for t in manifest["tables"].values():
+                if t["origin"] != manifest["name"] and t["dump_id"] is not None:
+                    parts.setdefault(t["origin"], set()).add(t["dump_id"])
+
+            for origin, dump_ids in sorted(parts.items()):
+                part = os.path.join(snapshot, incremental.PARTS, origin)
+                catalog = self.catalog_to_file(keep_entries(listing(part), dump_ids))
+
+                utils.run_command(cmd + ["--data-only", "-L", catalog, part])
+
+            utils.run_command(main + ["--section=post-data", snapshot])
+
+        end_time = time.time()
+
+        # time elapsed, in secs
+        return end_time - start_time
+
+    def pg_restore_fanout(
+        self, filename, targets, buffer_size=fanout.BUFFER_SIZE, spill_dir=None
+    ):
+        """restore filename into self and targets, PGRestore instances for
+        other hosts or databases, reading the archive once; return
+        {host:port/dbname: elapsed secs}, None for the targets that failed"""
+
+        targets = [self] + list(targets)
+        names = [f"{t.host}:{t.port}/{t.dbname}" for t in targets]
+
+        commands = []
+        results = {}
+
+        for name, t in zip(names, targets):
+            cmd = [
+                t.restore_cmd,
+                "-h",
+                t.host,
+                "-p",
+                str(t.port),
+                "-U",
+                t.user,
+                "-d",
+                t.dbname,
+            ]
+
+            if t.st:
+                cmd.append("-1")
+
+            try:
+                t.try_connection()
+
+                if t.schemas or t.schemas_nodata:
+                    cmd += ["-L", str(t.get_catalog(filename, [], out_to_file=True))]
+            except Exception as exp:
+                # a target we can't reach doesn't hold the others back
+                logger.error(f"{name}: {exp}")
+                results[name] = None
+                continue
+
+            # only the priorities of the target governor, the rate applies
+            # to the single read of the archive
+            g = t.governor or governor.Governor()
+            gov = governor.Governor(nice=g.nice, ionice=g.ionice, cpu_quota=g.cpu_quota)
+
+            commands.append((name, cmd, gov))
+
+        if os.path.isdir(filename):
+            # pg_restore can't read a directory archive on stdin, run them
+            # side by side and let them share the page cache instead
+            from concurrent.futures import ThreadPoolExecutor
+
+            logger.info("Notice: directory archive, each target reads it")
+
+            def restore(name, cmd, gov):
+                t0 = time.time()
+                try:
+                    utils.run_command(gov.command(cmd + [filename]))
+                except Exception as exp:
+                    logger.error(f"{name}: {exp}")
+                    return None, exp
+
+                return time.time() - t0, None
+
+            with ThreadPoolExecutor(max_workers=len(commands) or 1) as executor:
+                done = list(executor.map(lambda c: restore(*c), commands))
+        else:
+            done = fanout.run(
+                filename,
+                [(cmd, gov) for _, cmd, gov in commands],
+                self.governor or governor.Governor(),
+                buffer_size,
+                spill_dir,
+            )
+
+        for (name, _, _), (elapsed, _) in zip(commands, done):
+            results[name] = elapsed
+
+        return {name: results[name] for name in names}
+
+    def pg_dump_store(self, store_dir, name, fmt="-Fc", force=False):
+        """pg_dump into the chunk store at store_dir as dump name, return
+        (elapsed secs, manifest); directory format dumps go through a
+        temporary directory"""
+
+        store = chunkstore.ChunkStore(store_dir)
+
+        # try to connect with a safe timeout, raise an exception when failing
+        self.try_connection()
+
+        if not force and os.path.exists(store.manifest_path(name)):
+            raise ExportFileAlreadyExistsException
+
+        if "-Z" not in fmt:
+            # compressed dumps don't deduplicate
+            fmt += " -Z0"
+
+        # mesure pg_dump timing
+        import time
+
+        start_time = time.time()
+
+        if fmt.startswith("-Fd"):
+            import tempfile
+
+            tmpdir = tempfile.mkdtemp(prefix="pg_tools_store_")
+            directory = os.path.join(tmpdir, "dump")
+
+            cmd = [self.restore_cmd.replace("pg_restore", "pg_dump")] + fmt.split()
+            cmd += [
+                "-f",
+                directory,
+                "-U",
+                self.user,
+                "-h",
+                self.host,
+                "-p",
+                str(self.port),
+            ]
+
+            if self.restore_jobs > 1:
+                cmd += ["-j", str(self.restore_jobs)]
+
+            cmd.append(self.dbname)
+
+            try:
+                utils.run_command(self.governed(cmd))
+                manifest = store.put_directory(name, directory)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        else:
+            cmd = "%s %s -U %s -h %s -p %d %s" % (
+                self.restore_cmd.replace("pg_restore", "pg_dump"),
+                fmt,
+                self.user,
+                self.host,
+                self.port,
+                self.dbname,
+            )
+
+            writer = store.writer(name)
+            governor.run_command(cmd, self.governor or governor.Governor(), sink=writer)
+            manifest = writer.close()
+
+        end_time = time.time()
+
+        logger.info(
+            f"{name}: {manifest['size']} bytes dumped, {manifest['written']} bytes stored"
+        )
+
+        # time elapsed, in secs
+        return end_time - start_time, manifest
+
+    def pg_restore_store(self, store_dir, name, tmpdir=None):
+        """restore dump name from the chunk store at store_dir, streaming it
+        to pg_restore. pg_restore can't read a directory format dump from a
+        pipe: those are first written back whole to a temporary directory
+        in tmpdir, which needs as much free space as the dump"""
+
+        store = chunkstore.ChunkStore(store_dir)
+        manifest = store.read_manifest(name)
+
+        if "files" in manifest:
+            import tempfile
+
+            size = sum(
+                n for chunks in manifest["files"].values() for _, n in chunks
+            )
+            tmpdir = tempfile.mkdtemp(prefix="pg_tools_store_", dir=tmpdir)
+            logger.info(f"Notice: writing {name} to {tmpdir}, {size} bytes")
+            try:
+                store.get_directory(name, os.path.join(tmpdir, "dump"))
+                return self.pg_restore(os.path.join(tmpdir, "dump"))
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        cmd = [
+            self.restore_cmd,
+            "-h",
+            self.host,
+            "-p",
+            str(self.port),
+            "-U",
+            self.user,
+            "-d",
+            self.dbname,
+        ]
+
+        if self.st:
+            cmd.append("-1")
+
+        if self.restore_jobs > 1:
+            # pg_restore -j needs to seek in the archive
+            logger.info("Notice: restoring from the store with a single job")
+
+        logger.info(" ".join(cmd) + f" < {store_dir}:{name}")
+
+        # try to connect with a safe timeout, raise an exception when failing
+        self.try_connection()
+
+        # mesure pg_restore timing
+        import time
+
+        start_time = time.time()
+
+        with self.profiling("pg_restore"):
+            governor.run_command(
+                cmd, self.governor or governor.Governor(), source=store.reader(name)
+            )
+
+        end_time = time.time()
+
+        # time elapsed, in secs
+        return end_time - start_time
+
+    def for_database(self, dbname):
+        """a copy of self targeting dbname, sharing the governor and
+        history, without the maintenance connection"""
+
+        import copy
+
+        pg = copy.copy(self)
+        pg.dbname = dbname
+        pg.mconn = None
+        pg.drop_threads = []
+
+        return pg
+
+    def pg_dump_cluster(self, directory, jobs=4, force=False):
+        """dump the globals then all the databases of the server, jobs at a
+        time, largest first, into directory, and return the elapsed secs"""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not force and os.path.exists(os.path.join(directory, cluster.MANIFEST)):
+            raise ExportFileAlreadyExistsException
+
+        os.makedirs(directory, exist_ok=True)
+
+        databases = self.maint_execute(cluster.DATABASES_SQL)
+
+        start_time = time.time()
+
+        cmd = [
+            self.restore_cmd.replace("pg_restore", "pg_dumpall"),
+            "--globals-only",
+            "-U",
+            self.user,
+            "-h",
+            self.host,
+            "-p",
+            str(self.port),
+            "-f",
+            os.path.join(directory, cluster.GLOBALS),
+        ]
+        utils.run_command(self.governed(cmd))
+
+        def dump(dbname, size):
+            """ dump a database, returning its manifest entry """
+
+            entry = {"dbname": dbname, "size": size, "file": cluster.dump_filename(dbname)}
+            try:
+                pg = self.for_database(dbname)
+                entry["elapsed"] = pg.pg_dump(
+                    os.path.join(directory, entry["file"]), force=True
+                )
+                entry["status"] = "ok"
+            except Exception as exp:
+                logger.error(f"{dbname}: {exp}")
+                entry["status"] = "error"
+                entry["error"] = str(exp)
+
+            return entry
+
+        # the executor hands out the databases in order, largest first
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            entries = list(executor.map(lambda x: dump(*x), databases))
+
+        elapsed = time.time() - start_time
+
+        cluster.write_manifest(
+            directory,
+            {
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "host": self.host,
+                "port": self.port,
+                "server_version": self.show("server_version"),
+                "globals": cluster.GLOBALS,
+                "databases": entries,
+                "elapsed": elapsed,
+            },
+        )
+
+        failed = [e["dbname"] for e in entries if e["status"] != "ok"]
+        if failed:
+            raise CouldNotGetDumpException(
+                f"Error: could not dump databases: {', '.join(failed)}"
+            )
+
+        return elapsed
+
+    def pg_restore_cluster(self, directory, jobs=4, databases=None):
+        """restore a pg_dump_cluster directory: globals, then each database,
+        or only the given ones, jobs at a time, largest first, return
+        {dbname: elapsed secs}"""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        manifest = cluster.read_manifest(directory)
+
+        entries = [
+            e
+            for e in manifest["databases"]
+            if e["status"] == "ok" and (databases is None or e["dbname"] in databases)
+        ]
+
+        # existing roles make for errors we don't care about
+        self.run_sql_file(os.path.join(directory, manifest["globals"]), dbname=self.maintdb)
+
+        cmd = self.governed(
+            [
+                self.restore_cmd,
+                "-h",
+                self.host,
+                "-p",
+                str(self.port),
+                "-U",
+                self.user,
+            ]
+        )
+
+        if self.restore_jobs > 1:
+            cmd += ["-j", str(self.restore_jobs)]
+
+        def restore(entry):
+            """ restore a database, returning (dbname, elapsed, error) """
+
+            if entry["dbname"] in cluster.EXISTING:
+                target = ["-d", entry["dbname"]]
+            else:
+                target = ["--create", "-d", self.maintdb]
+
+            t0 = time.time()
+            try:
+                utils.run_command(cmd + target + [os.path.join(directory, entry["file"])])
+            except Exception as exp:
+                logger.error(f"{entry['dbname']}: {exp}")
+                return entry["dbname"], None, exp
+
+            return entry["dbname"], time.time() - t0, None
+
+        entries.sort(key=lambda e: e["size"], reverse=True)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(restore, entries))
+
+        failed = [dbname for dbname, _, exp in results if exp is not None]
+        if failed:
+            raise PGRestoreFailedException(
+                f"Error: could not restore databases: {', '.join(failed)}"
+            )
+
+        return {dbname: elapsed for dbname, elapsed, _ in results}
+
+    @contextmanager
+    def using_database(self, dbname):
+        """ temporarily target another database, e.g. a template """
+
+        saved = self.dbname
+        self.dbname = dbname
+        try:
+            yield self
+        finally:
+            self.dbname = saved
+
+    def maint_execute(self, sql, params=None):
+        """run sql in autocommit on the maintenance connection, return all
+        the rows when there are some"""
+
+        logger.info(sql)
+
+        self.mconn.autocommit = True
+        curs = self.mconn.cursor()
+        try:
+            curs.execute(sql, params)
+            if curs.description is not None:
+                return curs.fetchall()
+        finally:
+            curs.close()
+
+    def database_exists(self, dbname):
+        """ is there a database named dbname? """
+
+        rows = self.maint_execute(
+            "SELECT 1 FROM pg_database WHERE datname = %s", (dbname,)
+        )
+        return len(rows) > 0
+
+    def terminate_backends(self, dbname):
+        """ kill the connections to dbname, return how many there were """
+
+        rows = self.maint_execute(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+            + "WHERE datname = %s AND pid <> pg_backend_pid()",
+            (dbname,),
+        )
+        return len(rows)
+
+    def template_fingerprint(self, template):
+        """ the dump fingerprint a template was restored from, or None """
+
+        rows = self.maint_execute(
+            "SELECT shobj_description(oid, 'pg_database') "
+            + "FROM pg_database WHERE datname = %s",
+            (template,),
+        )
+
+        if not rows or not rows[0][0] or not rows[0][0].startswith(TEMPLATE_TAG):
+            return None
+
+        return rows[0][0][len(TEMPLATE_TAG):]
+
+    def refresh_template(self, filename, template, encoding="UTF8"):
+        """restore filename into the template database unless it's already
+        been restored from the same dump, return the timings"""
+
+        fingerprint = utils.fingerprint(filename)
+        timings = {}
+
+        if self.template_fingerprint(template) == fingerprint:
+            logger.info(f"Template {template} is up to date with {filename}")
+            return timings
+
+        with self.using_database(template):
+            if self.database_exists(template):
+                self.maint_execute(
+                    f'ALTER DATABASE "{template}" WITH IS_TEMPLATE false'
+                )
+                self.terminate_backends(template)
+                self.dropdb()
+
+            self.createdb(encoding)
+            timings["restore"] = self.pg_restore(filename)
+            timings["vacuum"] = self.vacuumdb()
+
+        # nobody should connect to the template, that would block cloning
+        self.maint_execute(
+            f'COMMENT ON DATABASE "{template}" IS %s', (TEMPLATE_TAG + fingerprint,)
+        )
+        self.maint_execute(
+            f'ALTER DATABASE "{template}" WITH IS_TEMPLATE true ALLOW_CONNECTIONS false'
+        )
+
+        return timings
+
+    def clone_database(self, template, dbname, strategy=None):
+        """CREATE DATABASE dbname TEMPLATE template, with given STRATEGY on
+        PostgreSQL 15 and later: FILE_COPY, WAL_LOG, or picked by template
+        size when None"""
+
+        sql = f'CREATE DATABASE "{dbname}" WITH TEMPLATE "{template}" OWNER "{self.owner}"'
+
+        if int(self.show("server_version_num")) >= 150000:
+            if strategy is None:
+                size = self.maint_execute(
+                    "SELECT pg_database_size(%s)", (template,)
+                )[0][0]
+                strategy = "FILE_COPY" if size > FILE_COPY_SIZE else "WAL_LOG"
+
+            sql += f" STRATEGY {strategy}"
+
+        # CREATE DATABASE fails when someone is connected to the template
+        self.terminate_backends(template)
+
+        start_time = time.time()
+
+        try:
+            self.maint_execute(sql)
+        except Exception as exp:
+            mesg = f"Error: createdb: {exp}"
+            raise CreatedbFailedException(mesg)
+
+        return time.time() - start_time
+
+    def provision(self, filename, template, dbnames, encoding="UTF8", strategy=None):
+        """restore filename once into template, when it changed, then create
+        each of dbnames as a copy of the template, return the timings"""
+
+        timings = self.refresh_template(filename, template, encoding)
+
+        for dbname in dbnames:
+            timings[dbname] = self.clone_database(template, dbname, strategy)
+
+        return timings
+
+    def drop_database_async(self, dbname):
+        """DROP DATABASE dbname in a background thread, on its own
+        connection, return the thread"""
+
+        def drop():
+            conn = self.connect(self.maintdb)
+            try:
+                conn.autocommit = True
+                curs = conn.cursor()
+                curs.execute(f'DROP DATABASE IF EXISTS "{dbname}"')
+                curs.close()
+                logger.info(f'dropped database "{dbname}"')
+            except Exception as exp:
+                logger.error(f"Error: dropdb {dbname}: {exp}")
+            finally:
+                conn.close()
+
+        logger.info(f"dropdb {dbname} (background)")
+
+        thread = threading.Thread(target=drop, name=f"dropdb {dbname}")
+        thread.start()
+        self.drop_threads.append(thread)
+
+        return thread
+
+    def swap_databases(self, side, old, pgbouncer=None):
+        """rename self.dbname to old and side to self.dbname, while clients
+        going through pgbouncer are paused, return the pause duration"""
+
+        if self.database_exists(old):
+            self.terminate_backends(old)
+            self.maint_execute(f'DROP DATABASE "{old}"')
+
+        start_time = time.time()
+
+        if pgbouncer is not None:
+            pgbouncer.pause(self.dbname)
+
+        try:
+            live = self.database_exists(self.dbname)
+
+            if live:
+                # no new connections, then kill pgbouncer's idle ones, and
+                # the others
+                self.maint_execute(
+                    f'ALTER DATABASE "{self.dbname}" WITH ALLOW_CONNECTIONS false'
+                )
+                self.terminate_backends(self.dbname)
+                self.maint_execute(f'ALTER DATABASE "{self.dbname}" RENAME TO "{old}"')
+
+            self.terminate_backends(side)
+
+            try:
+                self.maint_execute(f'ALTER DATABASE "{side}" RENAME TO "{self.dbname}"')
+            except Exception:
+                # put the live database back
+                if live:
+                    self.maint_execute(f'ALTER DATABASE "{old}" RENAME TO "{self.dbname}"')
+                    self.maint_execute(
+                        f'ALTER DATABASE "{self.dbname}" WITH ALLOW_CONNECTIONS true'
+                    )
+                raise
+        finally:
+            if pgbouncer is not None:
+                pgbouncer.resume(self.dbname)
+
+        pause = time.time() - start_time
+        logger.info(f"Swapped {side} and {self.dbname} in {pause:.3f}s")
+
+        return pause
+
+    def refresh(
+        self,
+        filename,
+        encoding="UTF8",
+        pgbouncer=None,
+        verify_source=None,
+        verify_stats=None,
+    ):
+        """restore filename into a side database, vacuum and verify it,
+        then swap it with self.dbname and drop the previous copy in the
+        background. pgbouncer is a PgBouncer console, clients are paused
+        only for the swap. Return the timings"""
+
+        side = f"{self.dbname[:NAMEDATALEN - 5]}_new"
+        old = f"{self.dbname[:NAMEDATALEN - 5]}_old"
+
+        timings = {}
+
+        with self.using_database(side):
+            if self.database_exists(side):
+                self.terminate_backends(side)
+                self.dropdb()
+
+            self.createdb(encoding)
+            timings["restore"] = self.pg_restore(filename)
+            timings["vacuum"] = self.vacuumdb()
+
+            if verify_source or verify_stats:
+                start_time = time.time()
+                report = self.verify(source=verify_source, stats=verify_stats)
+                timings["verify"] = time.time() - start_time
+
+                failed = [c.table for c in report if c.status != "pass"]
+                if failed:
+                    mesg = f"Error: {side} failed verification, {self.dbname} left as is"
+                    mesg += f"\nDetail: {', '.join(failed)}"
+                    raise VerificationFailedException(mesg)
+
+        timings["swap"] = self.swap_databases(side, old, pgbouncer)
+
+        self.drop_database_async(old)
+
+        return timings
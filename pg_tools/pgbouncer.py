@@ -0,0 +1,66 @@
+""" pgbouncer admin console, to pause clients while we swap databases """
+import logging
+
+from .utils import CouldNotGetPgBouncerConfigException
+from .verify import ident
+
+logger = logging.getLogger(__name__)
+
+
+class PgBouncer:
+    """Connection to the pgbouncer console, user must be listed in
+    admin_users"""
+
+    def __init__(self, host, port, user, dbname="pgbouncer", connect_timeout=3):
+        """ connect to the console """
+
+        import psycopg2
+
+        self.dsn = f"dbname='{dbname}' user='{user}' host='{host}' port={int(port)} connect_timeout={connect_timeout}"
+
+        try:
+            self.conn = psycopg2.connect(self.dsn)
+        except Exception as exp:
+            mesg = f"Error: could not connect to pgbouncer '{host}:{port}'"
+            mesg += f"\nDetail: {exp}"
+            raise CouldNotGetPgBouncerConfigException(mesg)
+
+        # the console doesn't do transactions
+        self.conn.autocommit = True
+
+    def __del__(self):
+        """ destructor, close the console connection """
+        self.close()
+
+    def close(self):
+        """ close the console connection """
+
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+            self.conn = None
+
+    def command(self, command):
+        """ run an admin command, return its rows if any """
+
+        logger.info(f"pgbouncer: {command}")
+
+        curs = self.conn.cursor()
+        try:
+            curs.execute(command)
+            if curs.description is not None:
+                return curs.fetchall()
+        finally:
+            curs.close()
+
+    def pause(self, dbname):
+        """wait until the server connections to dbname are released, and
+        hold new client queries until resume"""
+        self.command(f"PAUSE {ident(dbname)}")
+
+    def resume(self, dbname):
+        """ let client queries through again """
+        self.command(f"RESUME {ident(dbname)}")
+
+    def show(self, what):
+        """ SHOW POOLS, SHOW DATABASES, etc """
+        return self.command(f"SHOW {what}")
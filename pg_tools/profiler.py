@@ -0,0 +1,238 @@
+""" server side profiling of restores, sampling activity and progress views """
+import re
+import csv
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+##
+# While a restore runs, a background thread polls pg_stat_activity and the
+# progress views of the target database every interval seconds. Each
+# sample of each backend is attributed to the object it works on, from the
+# progress views or else from its query, and to its wait event, "CPU" when
+# active and not waiting. Time between two samples goes to what was seen
+# in the later one.
+#
+# The progress views depend on the server version: pg_stat_progress_copy
+# is 14+, pg_stat_progress_create_index 12+, pg_stat_progress_vacuum 9.6+
+
+ACTIVITY_SQL = """
+SELECT pid, state, wait_event_type, wait_event, query
+  FROM pg_stat_activity
+ WHERE datname = current_database()
+   AND pid <> pg_backend_pid()
+   AND state IS DISTINCT FROM 'idle'
+   AND backend_type = 'client backend'
+"""
+
+PROGRESS_SQL = {
+    "copy": (
+        140000,
+        """
+SELECT pid, relid::regclass::text, command,
+       bytes_processed, nullif(bytes_total, 0)
+  FROM pg_stat_progress_copy
+ WHERE datname = current_database()
+""",
+    ),
+    "index": (
+        120000,
+        """
+SELECT pid, index_relid::regclass::text, phase,
+       blocks_done, nullif(blocks_total, 0)
+  FROM pg_stat_progress_create_index
+ WHERE datname = current_database()
+""",
+    ),
+    "vacuum": (
+        90600,
+        """
+SELECT pid, relid::regclass::text, phase,
+       heap_blks_scanned, nullif(heap_blks_total, 0)
+  FROM pg_stat_progress_vacuum
+ WHERE datname = current_database()
+""",
+    ),
+}
+
+# what a backend works on, from its query when no progress view tells
+RE_OBJECTS = [
+    ("copy", re.compile(r"^\s*COPY\s+([\w.\"]+)", re.I)),
+    ("index", re.compile(r"^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?([\w\"]+)", re.I)),
+    ("constraint", re.compile(r"^\s*ALTER\s+TABLE\s+(?:ONLY\s+)?([\w.\"]+)\s+ADD\s+CONSTRAINT", re.I)),
+    ("vacuum", re.compile(r"^\s*(?:VACUUM|ANALYZE)\b", re.I)),
+]
+
+TIMELINE_FIELDS = ["time", "pid", "activity", "object", "phase", "wait", "progress"]
+
+
+def attribute(query):
+    """ return (activity, object) for a query """
+
+    for activity, regexp in RE_OBJECTS:
+        m = regexp.match(query or "")
+        if m:
+            return activity, m.group(1).replace('"', "") if m.groups() else None
+
+    return "query", None
+
+
+class Profiler:
+    """Background sampler of the activity of a database, use as a context
+    manager around the commands to profile"""
+
+    def __init__(self, dsn, output=None, interval=1.0):
+        self.dsn = dsn
+        self.output = output
+        self.interval = interval
+
+        self.timeline = []
+        self.objects = {}
+        self.waits = {}
+        self.samples = 0
+
+        self.stopped = threading.Event()
+        self.thread = None
+        self.conn = None
+        self.queries = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+        if self.output is not None:
+            self.write(self.output)
+
+    def start(self):
+        """ connect and start sampling in a background thread """
+
+        import psycopg2
+
+        try:
+            self.conn = psycopg2.connect(self.dsn)
+            self.conn.autocommit = True
+        except Exception as exp:
+            # profiling must never get in the way of the restore
+            logger.warning(f"profiler: could not connect: {exp}")
+            return
+
+        version = self.conn.server_version
+        self.queries = [
+            (activity, sql)
+            for activity, (min_version, sql) in PROGRESS_SQL.items()
+            if version >= min_version
+        ]
+
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ stop sampling and disconnect """
+
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def run(self):
+        """ the sampling loop """
+
+        last = time.time()
+
+        while True:
+            now = time.time()
+            try:
+                self.sample(now, now - last)
+            except Exception as exp:
+                logger.warning(f"profiler: stopped sampling: {exp}")
+                return
+            last = now
+
+            if self.stopped.wait(self.interval):
+                return
+
+    def fetch(self, sql):
+        """ all the rows of sql """
+
+        curs = self.conn.cursor()
+        try:
+            curs.execute(sql)
+            return curs.fetchall()
+        finally:
+            curs.close()
+
+    def sample(self, now, elapsed):
+        """ take a sample, elapsed secs since the previous one """
+
+        progress = {}
+        for activity, sql in self.queries:
+            for pid, obj, phase, done, total in self.fetch(sql):
+                pct = round(100.0 * done / total, 1) if total else None
+                progress[pid] = (activity, obj, phase, pct)
+
+        self.samples += 1
+
+        for pid, state, wait_type, wait_event, query in self.fetch(ACTIVITY_SQL):
+            if pid in progress:
+                activity, obj, phase, pct = progress[pid]
+            else:
+                activity, obj = attribute(query)
+                phase, pct = state, None
+
+            wait = f"{wait_type}:{wait_event}" if wait_type else "CPU"
+            obj = obj or "-"
+
+            self.timeline.append(
+                {
+                    "time": round(now, 3),
+                    "pid": pid,
+                    "activity": activity,
+                    "object": obj,
+                    "phase": phase,
+                    "wait": wait,
+                    "progress": pct,
+                }
+            )
+
+            o = self.objects.setdefault(obj, {"activity": activity, "secs": 0.0, "waits": {}})
+            o["secs"] += elapsed
+            o["waits"][wait] = o["waits"].get(wait, 0.0) + elapsed
+            self.waits[wait] = self.waits.get(wait, 0.0) + elapsed
+
+    def report(self):
+        """ time per object and per wait event, largest first """
+
+        objects = sorted(self.objects.items(), key=lambda x: x[1]["secs"], reverse=True)
+        waits = sorted(self.waits.items(), key=lambda x: x[1], reverse=True)
+
+        return {
+            "samples": self.samples,
+            "interval": self.interval,
+            "objects": [dict(o, object=name) for name, o in objects],
+            "waits": [{"wait": w, "secs": secs} for w, secs in waits],
+        }
+
+    def write(self, path):
+        """ the timeline as CSV, or the timeline and report as JSON """
+
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, TIMELINE_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.timeline)
+        else:
+            with open(path, "w") as f:
+                json.dump({"report": self.report(), "timeline": self.timeline}, f, indent=2)
+
+        logger.info(f"profiler: {self.samples} samples written to {path}")
@@ -0,0 +1,208 @@
+""" size aware parallel restore, each pg_restore worker with its own -L list """
+import os
+import heapq
+import logging
+
+from . import archive
+from . import largeobjects
+from .catalog import parse_catalog_line
+
+logger = logging.getLogger(__name__)
+
+##
+# pg_restore -j hands out the entries in archive order, so that a big table
+# coming last keeps a single worker busy long after the others are done. We
+# restore in phases instead:
+#
+#   pre    one pg_restore for the schema definitions
+#   data   TABLE DATA and the like, split across the workers
+#   blobs  large objects data, written in batches over several connections
+#   index  INDEX and CONSTRAINT entries, split across the workers
+#   post   one pg_restore for the rest: FK constraints, triggers, ...
+#
+# Within a parallel phase the entries are sorted by decreasing cost and each
+# one goes to the least loaded worker, the Longest Processing Time first
+# rule, which is within 4/3 of the optimal makespan. The cost of a data
+# entry is the size of its data in the archive, an index costs as much as
+# the data of its table. Ties go to the worker with the fewest entries, so
+# that the thousands of empty or tiny leaf partitions of a partitioned table
+# are spread evenly too.
+#
+# Entries of no section (ACL, COMMENT, ...) go with what they depend on, or
+# to the post phase when that's a parallel one: a COMMENT on an INDEX must
+# wait for the index.
+
+PRE = "pre"
+DATA = "data"
+BLOBS = "blobs"
+INDEX = "index"
+POST = "post"
+
+PHASES = (PRE, DATA, BLOBS, INDEX, POST)
+PARALLEL_PHASES = (DATA, INDEX)
+INDEX_DESCS = ("INDEX", "CONSTRAINT")
+
+
+def data_sizes(arch, entries):
+    """ return {dump_id: bytes} of the entries data, empty when unknown """
+
+    sizes = {}
+
+    if arch.format == archive.FMT_CUSTOM:
+        # blocks follow each other, a block ends where the next one starts
+        offsets = sorted(
+            (e.data_offset, e.dump_id)
+            for e in entries
+            if e.data_state == archive.K_OFFSET_POS_SET
+        )
+        ends = [offset for offset, _ in offsets[1:]] + [len(arch.buf)]
+
+        for (offset, dump_id), end in zip(offsets, ends):
+            sizes[dump_id] = end - offset
+    else:
+        for e in entries:
+            if e.filename:
+                sizes[e.dump_id] = os.path.getsize(arch.data_file(e))
+
+    return sizes
+
+
+def entry_phases(entries):
+    """ return {dump_id: phase}, entries being in archive order """
+
+    phases = {}
+
+    for e in entries:
+        if e.section == "PRE-DATA":
+            phase = PRE
+        elif e.section == "DATA":
+            phase = DATA
+        elif e.section == "POST-DATA":
+            phase = INDEX if e.desc in INDEX_DESCS else POST
+        else:
+            phase = max(
+                (phases.get(d, PRE) for d in e.dependencies),
+                key=PHASES.index,
+                default=PRE,
+            )
+            if phase in PARALLEL_PHASES:
+                phase = POST
+
+        # an index depending on another one, partitioned tables
+        if phase == INDEX and any(phases.get(d) == INDEX for d in e.dependencies):
+            phase = POST
+
+        phases[e.dump_id] = phase
+
+    return phases
+
+
+def entry_costs(entries, sizes):
+    """ return {dump_id: cost} for data and index entries """
+
+    costs = {}
+    tables = {}
+
+    for e in entries:
+        if e.section == "DATA":
+            costs[e.dump_id] = sizes.get(e.dump_id, 0)
+
+            # TABLE DATA depends on its TABLE
+            for d in e.dependencies:
+                tables[d] = tables.get(d, 0) + costs[e.dump_id]
+
+    for e in entries:
+        if e.desc in INDEX_DESCS:
+            costs[e.dump_id] = sum(tables.get(d, 0) for d in e.dependencies)
+
+    return costs
+
+
+def lpt(items, workers):
+    """split (cost, item) pairs across workers, largest first to the least
+    loaded one, and return (items per worker, load per worker)"""
+
+    heap = [(0, 0, i) for i in range(workers)]
+    assigned = [[] for _ in range(workers)]
+    loads = [0] * workers
+
+    for cost, item in sorted(items, key=lambda x: x[0], reverse=True):
+        load, count, i = heapq.heappop(heap)
+        assigned[i].append(item)
+        loads[i] = load + cost
+        heapq.heappush(heap, (loads[i], count + 1, i))
+
+    return assigned, loads
+
+
+def makespan(costs, workers):
+    """makespan of handing out costs in the given order to the first free
+    worker, as pg_restore -j does with the archive order"""
+
+    free = [0] * workers
+
+    for cost in costs:
+        heapq.heapreplace(free, free[0] + cost)
+
+    return max(free)
+
+
+def plan(filename, catalog, workers):
+    """return a list of (phase, [catalog, ...], [load, ...]) steps, with a
+    catalog per worker, for the entries of catalog, a pg_restore -l listing
+    of filename, or None when the archive doesn't tell the data sizes"""
+
+    with archive.Archive(filename) as arch:
+        entries = list(arch.entries())
+        sizes = data_sizes(arch, entries)
+        blobs = arch.version >= largeobjects.MIN_VERSION
+
+    if not sizes:
+        return None
+
+    phases = entry_phases(entries)
+    costs = entry_costs(entries, sizes)
+
+    groups = {phase: [] for phase in PHASES}
+
+    for line in catalog.split("\n"):
+        e = parse_catalog_line(line)
+
+        # comments are entries filtered out
+        if e is None:
+            continue
+
+        phase = phases.get(e.dump_id, POST)
+
+        if phase == DATA and blobs and e.desc in largeobjects.DATA_DESCS:
+            phase = BLOBS
+
+        groups[phase].append((costs.get(e.dump_id, 0), line))
+
+    steps = []
+
+    for phase in PHASES:
+        items = groups[phase]
+
+        if not items:
+            continue
+
+        if phase in PARALLEL_PHASES:
+            assigned, loads = lpt(items, workers)
+            steps.append(
+                (
+                    phase,
+                    ["\n".join(lines) + "\n" for lines in assigned if lines],
+                    [load for lines, load in zip(assigned, loads) if lines],
+                )
+            )
+        else:
+            steps.append(
+                (
+                    phase,
+                    ["\n".join(line for _, line in items) + "\n"],
+                    [sum(cost for cost, _ in items)],
+                )
+            )
+
+    return steps
@@ -0,0 +1,492 @@
+""" in process execution of SQL scripts, without psql """
+import os
+import re
+import time
+import heapq
+import shlex
+import logging
+import subprocess
+from collections import namedtuple
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+##
+# The script is split into statements the way psql does, reading it one
+# line at a time: a semicolon ends a statement unless it's in a quoted
+# literal or identifier, a dollar quoted body, a comment, parentheses (as in
+# CREATE RULE ... DO (INSERT ...; UPDATE ...)) or the BEGIN ATOMIC ... END
+# body of a CREATE FUNCTION or PROCEDURE. A COPY ... FROM stdin statement is
+# followed by its data, up to a line containing \. only. Lines starting
+# with a backslash, between statements, are psql meta-commands.
+#
+# Meta-commands changing the session state (\set, \i, \c, ...) can't be
+# run on their own: scripts using them are run by psql as a whole, except
+# for \set ON_ERROR_STOP. As psql, we read the script in the client
+# encoding of the connection.
+#
+# Consecutive statements are sent together in a single query, saving round
+# trips, except statements that can't run in a transaction block,
+# transaction control statements, and CALL or DO, whose code may COMMIT.
+# A batch runs in a transaction of its own: when it fails, it's rolled back
+# and then replayed one statement at a time, to report the failing one.
+
+Statement = namedtuple("Statement", ["kind", "sql", "lineno", "data"])
+
+SQL = "sql"
+COPY = "copy"
+META = "meta"
+
+# what might change the lexer state, in normal state
+RE_TOKEN = re.compile(r"""[;'"()]|--|/\*|\$(?:[^\W\d]\w*)?\$|[^\W\d][\w$]*""")
+RE_IDENT_CHAR = re.compile(r"[\w$]")
+RE_WORD_START = re.compile(r"[^\W\d]")
+RE_BLOCK_COMMENT = re.compile(r"/\*|\*/")
+RE_E_STRING_END = re.compile(r"\\.|''|'")
+
+RE_COPY_STDIN = re.compile(r"^\s*COPY\b.*\bFROM\s+STDIN\b", re.I | re.S)
+
+# statements we don't batch with others
+RE_ALONE = re.compile(
+    r"""^\s*(
+        BEGIN | START | COMMIT | END | ROLLBACK | ABORT | SAVEPOINT | RELEASE
+      | PREPARE\s+TRANSACTION
+      | CALL | DO | DISCARD
+      | VACUUM | CLUSTER | REINDEX | ALTER\s+SYSTEM
+      | (CREATE|ALTER|DROP)\s+SUBSCRIPTION
+      | (CREATE|DROP)\s+(DATABASE|TABLESPACE)
+      | (CREATE|DROP)\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY
+    )\b""",
+    re.I | re.X,
+)
+
+# meta-commands we can't run with psql -c, they change the session state
+RE_SESSION_META = re.compile(
+    r"\\(c|connect|encoding|set|unset|i|ir|include|include_relative|gset"
+    r"|if|elif|else|endif)\b"
+)
+RE_ON_ERROR_STOP = re.compile(r"\\set\s+ON_ERROR_STOP(?:\s+(\S+))?\s*$")
+
+ScriptResult = namedtuple("ScriptResult", ["statements", "errors", "elapsed", "slowest"])
+
+
+class CopyData:
+    """file like object reading COPY data lines from the script, up to the
+    \\. end marker, for cursor.copy_expert"""
+
+    def __init__(self, script):
+        self.script = script
+        self.done = False
+        self.buf = ""
+
+    def readline(self, size=-1):
+        """ next data line, '' at the end marker """
+
+        if self.done:
+            return ""
+
+        line = self.script.readline()
+        self.script.lineno += 1
+
+        if line == "" or line.rstrip("\r\n") == "\\.":
+            self.done = True
+            return ""
+
+        return line
+
+    def read(self, size=-1):
+        """ whole lines, about size bytes """
+
+        while not self.done and (size < 0 or len(self.buf) < size):
+            self.buf += self.readline()
+
+        out, self.buf = self.buf, ""
+        return out
+
+    def skip(self):
+        """ consume the remaining lines, when the COPY failed """
+
+        while self.readline():
+            pass
+
+
+class Script:
+    """Iterate over the statements of an SQL script file, streaming"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lineno = 0
+
+    def readline(self):
+        """ raw line, for COPY data """
+        return self.fd.readline()
+
+    def __iter__(self):
+        buf = []
+        start = None
+
+        # lexer state: None, "'", "E'", '"', "/*" or a dollar quote tag
+        state = None
+        depth = 0
+        content = False
+
+        # parentheses, BEGIN ATOMIC / CASE ... END nesting, and the first
+        # letters of the first words of the statement, as psqlscan.l does
+        parens = 0
+        begins = 0
+        words = []
+
+        while True:
+            line = self.fd.readline()
+            if line == "":
+                break
+
+            self.lineno += 1
+
+            # meta-commands, only between statements
+            if state is None and not content and line.lstrip().startswith("\\"):
+                yield Statement(META, line.strip(), self.lineno, None)
+                buf, start = [], None
+                continue
+
+            if start is None:
+                start = self.lineno
+
+            pos = 0
+            while pos < len(line):
+                if state is None:
+                    m = RE_TOKEN.search(line, pos)
+
+                    if m is None:
+                        if line[pos:].strip():
+                            content = True
+                        buf.append(line[pos:])
+                        break
+
+                    if line[pos: m.start()].strip():
+                        content = True
+
+                    token = m.group(0)
+                    end = m.end()
+
+                    if token == ";" and (parens or begins):
+                        buf.append(line[pos:end])
+                        pos = end
+                        continue
+
+                    if token == ";":
+                        buf.append(line[pos:end])
+                        pos = end
+
+                        if content:
+                            sql = "".join(buf).strip()
+                            data = None
+                            if RE_COPY_STDIN.match(sql):
+                                data = CopyData(self)
+                            yield Statement(COPY if data else SQL, sql, start, data)
+
+                            # don't parse the data lines as SQL
+                            if data is not None:
+                                data.skip()
+
+                        buf, start, content = [], None, False
+                        parens, begins, words = 0, 0, []
+                        continue
+
+                    buf.append(line[pos:end])
+                    pos = end
+
+                    if token == "(":
+                        parens += 1
+                    elif token == ")":
+                        parens = max(parens - 1, 0)
+                    elif RE_WORD_START.match(token):
+                        content = True
+                        word = token.lower()
+
+                        if word in ("begin", "case"):
+                            # CREATE [OR REPLACE] FUNCTION|PROCEDURE
+                            w = "".join(words[:4])
+                            if len(words) > 1 and (
+                                w[:2] in ("cf", "cp") or w[:4] in ("corf", "corp")
+                            ):
+                                begins += 1
+                        elif word == "end" and begins:
+                            begins -= 1
+
+                        words.append(word[0])
+                    elif token == "--":
+                        buf.append(line[end:])
+                        break
+                    elif token == "/*":
+                        state, depth = "/*", 1
+                    elif token == "'":
+                        content = True
+                        # E'...' strings have backslash escapes
+                        before = line[max(m.start() - 2, 0): m.start()]
+                        if before.endswith(("E", "e")) and not (
+                            len(before) == 2 and RE_IDENT_CHAR.match(before[0])
+                        ):
+                            state = "E'"
+                        else:
+                            state = "'"
+                    elif token == '"':
+                        content = True
+                        state = '"'
+                    elif token.startswith("$"):
+                        content = True
+                        before = line[m.start() - 1: m.start()]
+                        if before and RE_IDENT_CHAR.match(before):
+                            # foo$bar$ is an identifier, not a dollar quote
+                            continue
+                        state = token
+
+                elif state == "/*":
+                    m = RE_BLOCK_COMMENT.search(line, pos)
+                    if m is None:
+                        buf.append(line[pos:])
+                        break
+                    depth += 1 if m.group(0) == "/*" else -1
+                    if depth == 0:
+                        state = None
+                    buf.append(line[pos: m.end()])
+                    pos = m.end()
+
+                elif state in ("'", '"'):
+                    end = line.find(state, pos)
+                    if end == -1:
+                        buf.append(line[pos:])
+                        break
+                    buf.append(line[pos: end + 1])
+                    pos = end + 1
+                    # doubled quote is an escaped quote, stay in the literal
+                    if line[pos: pos + 1] == state:
+                        buf.append(state)
+                        pos += 1
+                    else:
+                        state = None
+
+                elif state == "E'":
+                    m = RE_E_STRING_END.search(line, pos)
+                    if m is None:
+                        buf.append(line[pos:])
+                        break
+                    buf.append(line[pos: m.end()])
+                    pos = m.end()
+                    if m.group(0) == "'":
+                        state = None
+
+                else:
+                    # dollar quoted, state is the tag
+                    end = line.find(state, pos)
+                    if end == -1:
+                        buf.append(line[pos:])
+                        break
+                    buf.append(line[pos: end + len(state)])
+                    pos = end + len(state)
+                    state = None
+
+        # last statement, without a trailing semicolon
+        if content:
+            yield Statement(SQL, "".join(buf).strip(), start, None)
+
+
+def on_error_stop_value(command):
+    """ True or False for \\set ON_ERROR_STOP, None for other commands """
+
+    m = RE_ON_ERROR_STOP.match(command)
+    if m is None:
+        return None
+
+    return (m.group(1) or "on").lower() in ("on", "true", "yes", "1", "t", "y")
+
+
+def client_encoding(conn):
+    """ the Python codec for the client encoding of conn """
+
+    from psycopg2.extensions import encodings
+
+    return encodings.get(conn.encoding, conn.encoding)
+
+
+def session_meta(filename, encoding=None):
+    """(lineno, command) of the first meta-command of filename that changes
+    the session state, None when there's none"""
+
+    with open(filename, encoding=encoding) as fd:
+        for lineno, line in enumerate(fd, 1):
+            command = line.strip()
+
+            if RE_SESSION_META.match(command) and on_error_stop_value(command) is None:
+                return lineno, command
+
+    return None
+
+
+def run_psql(filename, psql_cmd, on_error_stop=False):
+    """ run the whole script with psql, return a ScriptResult """
+
+    start_time = time.time()
+
+    options = ["-X", "-f", filename]
+    if on_error_stop:
+        options += ["-v", "ON_ERROR_STOP=1"]
+
+    # psql_cmd ends with the dbname
+    err = utils.run_command(
+        psql_cmd[:-1] + options + psql_cmd[-1:],
+        returning=utils.RET_ERR,
+        stdout=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    errors = sum(1 for line in err.splitlines() if "ERROR:" in line)
+
+    return ScriptResult(None, errors, time.time() - start_time, [])
+
+
+def run_meta(command, psql_cmd):
+    """ run a psql meta-command with psql, as psql -c would do """
+
+    if command.startswith("\\echo "):
+        logger.info(command[6:])
+        return
+
+    if RE_SESSION_META.match(command):
+        mesg = f"Error: meta-command '{command}' changes the session state"
+        mesg += "\nHint: run the script with psql"
+        raise utils.NotYetImplementedException(mesg)
+
+    utils.run_command(psql_cmd + ["-X", "-c", command])
+
+
+def run_script(
+    conn, filename, psql_cmd, batch=100, on_error_stop=False, progress=10
+):
+    """run the SQL script filename on connection conn, psql_cmd being the
+    psql command line to fall back to for meta-commands, and return a
+    ScriptResult, its statements None when psql ran the script"""
+
+    encoding = client_encoding(conn)
+
+    # before running anything, we can't stop half way
+    meta = session_meta(filename, encoding)
+    if meta is not None:
+        logger.info(f"{filename}:{meta[0]}: {meta[1]}, running the script with psql")
+        return run_psql(filename, psql_cmd, on_error_stop)
+
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+    conn.autocommit = True
+    curs = conn.cursor()
+
+    size = os.path.getsize(filename)
+    start_time = last_report = time.time()
+    statements = errors = 0
+    slowest = []
+    pending = []
+
+    def execute(sql, lineno, count, data=None, retry=False):
+        """run sql, COPY data, and keep track of timings and errors; with
+        retry, sql runs in a transaction that's rolled back on errors, and
+        we return False for the caller to replay it"""
+        nonlocal statements, errors
+
+        t0 = time.time()
+        try:
+            if data is not None:
+                curs.copy_expert(sql, data)
+            else:
+                curs.execute(sql)
+        except Exception as exp:
+            if data is not None:
+                data.skip()
+
+            if retry:
+                curs.execute("ROLLBACK")
+                return False
+
+            errors += 1
+            logger.error(f"{filename}:{lineno}: {str(exp).strip()}")
+
+            if on_error_stop:
+                raise
+
+        elapsed = time.time() - t0
+        statements += count
+        logger.debug(f"{filename}:{lineno}: {elapsed:.3f}s")
+
+        item = (elapsed, lineno, sql[:80])
+        if len(slowest) < 10:
+            heapq.heappush(slowest, item)
+        else:
+            heapq.heappushpop(slowest, item)
+
+        return True
+
+    def flush():
+        """ send pending statements, together """
+
+        if not pending:
+            return
+
+        sql = "\n".join(s.sql for s in pending)
+
+        # unless the script opened a transaction, the batch runs in its own
+        # one, that we can roll back before a replay; in the script one, a
+        # failure aborts the script transaction anyway
+        retry = len(pending) > 1 and conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        if retry:
+            sql = f"BEGIN;\n{sql};\nCOMMIT;"
+
+        if not execute(sql, pending[0].lineno, len(pending), retry=retry):
+            for s in pending:
+                execute(s.sql, s.lineno, 1)
+
+        del pending[:]
+
+    with open(filename, encoding=encoding) as fd:
+        script = Script(fd)
+
+        for stmt in script:
+            if stmt.kind == SQL and not RE_ALONE.match(stmt.sql):
+                pending.append(stmt)
+                if len(pending) >= batch:
+                    flush()
+            else:
+                flush()
+
+                if stmt.kind == META:
+                    stop = on_error_stop_value(stmt.sql)
+                    if stop is not None:
+                        on_error_stop = stop
+                    else:
+                        run_meta(stmt.sql, psql_cmd)
+                    statements += 1
+                else:
+                    execute(stmt.sql, stmt.lineno, 1, stmt.data)
+
+            now = time.time()
+            if now - last_report >= progress:
+                last_report = now
+                pct = 100.0 * fd.tell() / size if size else 100.0
+                logger.info(
+                    f"{filename}: {statements} statements, line {script.lineno}, {pct:.0f}%"
+                )
+
+        flush()
+
+    curs.close()
+
+    elapsed = time.time() - start_time
+    logger.info(
+        f"{filename}: {statements} statements in {elapsed:.1f}s, {errors} errors"
+    )
+
+    return ScriptResult(statements, errors, elapsed, sorted(slowest, reverse=True))
+
+
+def psql_command(psql, user, host, port, dbname):
+    """ psql command line as a list """
+
+    return shlex.split(psql) + ["-U", user, "-h", host, "-p", str(port), dbname]
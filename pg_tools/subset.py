@@ -0,0 +1,248 @@
+""" subset restores: a sample of the big tables rows, closed under foreign keys """
+import logging
+import tempfile
+from collections import namedtuple
+
+from .catalog import parse_catalog_line
+from .verify import relname
+
+logger = logging.getLogger(__name__)
+
+##
+# The schema and the data of the other tables come from the archive. The
+# sampled tables data is left out of the archive restore and copied from a
+# source database instead, with COPY (SELECT ... TABLESAMPLE or WHERE ...)
+# before the post-data section creates the foreign keys.
+#
+# Those foreign keys must hold: for each foreign key whose parent is
+# sampled, or whose child got sampled rows, the keys missing from the
+# parent are fetched from the source, until nothing is missing. All source
+# reads happen in a single repeatable read transaction, so that the sample
+# and its parents are consistent.
+
+FOREIGN_KEYS_SQL = """
+SELECT cn.nspname, c.relname, pn.nspname, p.relname,
+       array(SELECT a.attname
+               FROM unnest(k.conkey) WITH ORDINALITY AS u(attnum, i)
+                    JOIN pg_attribute a
+                      ON a.attrelid = k.conrelid AND a.attnum = u.attnum
+              ORDER BY u.i),
+       array(SELECT a.attname
+               FROM unnest(k.confkey) WITH ORDINALITY AS u(attnum, i)
+                    JOIN pg_attribute a
+                      ON a.attrelid = k.confrelid AND a.attnum = u.attnum
+              ORDER BY u.i),
+       array(SELECT format_type(a.atttypid, a.atttypmod)
+               FROM unnest(k.confkey) WITH ORDINALITY AS u(attnum, i)
+                    JOIN pg_attribute a
+                      ON a.attrelid = k.confrelid AND a.attnum = u.attnum
+              ORDER BY u.i)
+  FROM pg_constraint k
+       JOIN pg_class c ON c.oid = k.conrelid
+       JOIN pg_namespace cn ON cn.oid = c.relnamespace
+       JOIN pg_class p ON p.oid = k.confrelid
+       JOIN pg_namespace pn ON pn.oid = p.relnamespace
+ WHERE k.contype = 'f'
+"""
+
+COLUMNS_SQL = """
+SELECT attname
+  FROM pg_attribute
+ WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+ ORDER BY attnum
+"""
+
+# generated columns can't be copied into
+COLUMNS_GENERATED_SQL = COLUMNS_SQL.replace(
+    "NOT attisdropped", "NOT attisdropped AND attgenerated = ''"
+)
+
+ForeignKey = namedtuple(
+    "ForeignKey", ["child", "parent", "columns", "ref_columns", "ref_types"]
+)
+
+BATCH = 1000
+
+
+def sample_clause(rule):
+    """ FROM clause suffix for a sample rule: 1.5 is a percentage """
+
+    if isinstance(rule, (int, float)):
+        return f"TABLESAMPLE SYSTEM ({rule})"
+
+    rule = str(rule).strip()
+
+    try:
+        return f"TABLESAMPLE SYSTEM ({float(rule)})"
+    except ValueError:
+        pass
+
+    if rule.upper().startswith(("TABLESAMPLE", "WHERE")):
+        return rule
+
+    return f"WHERE {rule}"
+
+
+def drop_data(catalog, tables):
+    """ comment out the TABLE DATA entries of tables, schema.table names """
+
+    lines = []
+
+    for line in catalog.split("\n"):
+        e = parse_catalog_line(line)
+
+        if e is not None and e.desc == "TABLE DATA" and f"{e.schema}.{e.tag}" in tables:
+            line = f";{line}"
+
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+def quote(name):
+    """ quoted schema.table """
+    return relname(*name.split(".", 1))
+
+
+def column_list(columns):
+    """ quoted, comma separated column names """
+    return ", ".join('"%s"' % c for c in columns)
+
+
+def missing_keys_sql(fk):
+    """ the distinct child keys missing from the parent table """
+
+    cols = ", ".join('c."%s"::text' % c for c in fk.columns)
+    not_null = " AND ".join('c."%s" IS NOT NULL' % c for c in fk.columns)
+    join = " AND ".join(
+        'p."%s" = c."%s"' % (r, c) for c, r in zip(fk.columns, fk.ref_columns)
+    )
+
+    return (
+        f"SELECT DISTINCT {cols} FROM {quote(fk.child)} c "
+        f"WHERE {not_null} "
+        f"AND NOT EXISTS (SELECT 1 FROM {quote(fk.parent)} p WHERE {join})"
+    )
+
+
+def parent_rows_sql(fk, columns):
+    """the parent rows for keys given as one text array per column, the
+    keys cast back to the column types"""
+
+    keys = ", ".join("%s::text[]" for _ in fk.ref_columns)
+    names = ", ".join("k%d" % i for i in range(len(fk.ref_columns)))
+    casts = ", ".join(
+        "k%d::%s" % (i, t) for i, t in enumerate(fk.ref_types)
+    )
+
+    return (
+        f"SELECT {column_list(columns)} FROM {quote(fk.parent)} "
+        f"WHERE ({column_list(fk.ref_columns)}) IN "
+        f"(SELECT {casts} FROM unnest({keys}) AS k({names}))"
+    )
+
+
+def fetch(conn, sql, params=None):
+    """ all the rows of sql """
+
+    curs = conn.cursor()
+    try:
+        curs.execute(sql, params)
+        return curs.fetchall()
+    finally:
+        curs.close()
+
+
+def foreign_keys(conn):
+    """ the foreign keys of the database """
+
+    return [
+        ForeignKey(f"{cs}.{ct}", f"{ps}.{pt}", cols, ref_cols, ref_types)
+        for cs, ct, ps, pt, cols, ref_cols, ref_types in fetch(conn, FOREIGN_KEYS_SQL)
+    ]
+
+
+def columns(conn, name):
+    """ the columns of table name we can COPY into """
+
+    sql = COLUMNS_GENERATED_SQL if conn.server_version >= 120000 else COLUMNS_SQL
+    return [c for c, in fetch(conn, sql, (quote(name),))]
+
+
+def copy_rows(src, dst, name, cols, select, params=None):
+    """ copy the rows of select on src into table name on dst, return the count """
+
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, mode="w+") as buf:
+        curs = src.cursor()
+        query = curs.mogrify(select, params).decode() if params else select
+        curs.copy_expert(f"COPY ({query}) TO STDOUT", buf)
+        curs.close()
+
+        buf.seek(0)
+
+        curs = dst.cursor()
+        curs.copy_expert(f"COPY {quote(name)} ({column_list(cols)}) FROM STDIN", buf)
+        count = curs.rowcount
+        curs.close()
+
+    return count
+
+
+def load(src, dst, samples, batch=BATCH):
+    """copy samples, {schema.table: rule}, from src to dst then the parent
+    rows they need, return {schema.table: rows}"""
+
+    src.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    dst.autocommit = True
+
+    fks = foreign_keys(src)
+    cols = {}
+    counts = {}
+
+    def table_columns(name):
+        if name not in cols:
+            cols[name] = columns(dst, name)
+        return cols[name]
+
+    for name, rule in samples.items():
+        c = table_columns(name)
+        select = f"SELECT {column_list(c)} FROM {quote(name)} {sample_clause(rule)}"
+
+        logger.info(select)
+        counts[name] = copy_rows(src, dst, name, c, select)
+
+    # tables that don't have all their source rows
+    partial = set(samples)
+
+    while True:
+        copied = 0
+
+        for fk in fks:
+            if fk.child not in partial and fk.parent not in samples:
+                continue
+
+            keys = fetch(dst, missing_keys_sql(fk))
+            if not keys:
+                continue
+
+            logger.info(f"{fk.parent}: {len(keys)} keys needed by {fk.child}")
+
+            c = table_columns(fk.parent)
+            select = parent_rows_sql(fk, c)
+
+            for i in range(0, len(keys), batch):
+                params = [list(k) for k in zip(*keys[i: i + batch])]
+                n = copy_rows(src, dst, fk.parent, c, select, params)
+
+                counts[fk.parent] = counts.get(fk.parent, 0) + n
+                copied += n
+
+            partial.add(fk.parent)
+
+        # keys missing in the source too won't ever be found
+        if copied == 0:
+            break
+
+    src.rollback()
+
+    return counts
@@ -1,5 +1,8 @@
 # Exceptions and utilities
+import os
 import shlex
+import hashlib
+import logging
 import subprocess
 
 RET_CODE = 0
@@ -10,11 +13,14 @@ RET_BOTH = 4
 PRE_SQL = -1
 POST_SQL = 1
 
+logger = logging.getLogger(__name__)
+
 
 def run_command(command,
                 expected_retcodes=0, returning=RET_CODE,
-                stdin=None, stdout=subprocess.PIPE):
-    """run a command and raise an exception if retcode not in expected_retcode"""
+                stdin=None, stdout=subprocess.PIPE, universal_newlines=False):
+    """run a command and raise an exception if retcode not in expected_retcode,
+    its output being bytes unless universal_newlines"""
     logger.info(command)
 
     # we want expected_retcode to be a tuple but will manage integers
@@ -29,7 +35,8 @@ def run_command(command,
     proc = subprocess.Popen(cmd,
                             stdin=stdin,
                             stdout=stdout,
-                            stderr=subprocess.PIPE)
+                            stderr=subprocess.PIPE,
+                            universal_newlines=universal_newlines)
 
     out, err = proc.communicate()
 
@@ -57,6 +64,69 @@ def run_command(command,
         return proc.returncode
 
 
+def stream_command(command, callback,
+                   expected_retcodes=0, stdin=None, stdout=subprocess.DEVNULL):
+    """run a command and call callback(line) for each line it writes to
+    stderr, as soon as it's written, then raise an exception if retcode not
+    in expected_retcode"""
+    logger.info(command)
+
+    if isinstance(expected_retcodes, int):
+        expected_retcodes = (expected_retcodes,)
+
+    cmd = command
+    if isinstance(cmd, str):
+        cmd = shlex.split(command)
+
+    proc = subprocess.Popen(cmd,
+                            stdin=stdin,
+                            stdout=stdout,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+
+    # keep the tail of stderr for the error message
+    tail = []
+    for line in proc.stderr:
+        line = line.rstrip("\n")
+        logger.debug(line)
+        callback(line)
+
+        tail.append(line)
+        if len(tail) > 20:
+            tail.pop(0)
+
+    proc.wait()
+
+    if proc.returncode not in expected_retcodes:
+        mesg = 'Error [%d]: %s' % (proc.returncode, command)
+        mesg += '\nDetail: %s' % "\n".join(tail)
+        raise SubprocessException(mesg)
+
+    return proc.returncode
+
+
+def fingerprint(filename, sample=1024 * 1024):
+    """identify a dump file from its size and the first and last sample
+    bytes, which hold the TOC and the end of the data, without reading
+    all of it"""
+
+    # directory archives: toc.dat has the dump creation time
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, "toc.dat")
+
+    size = os.path.getsize(filename)
+    h = hashlib.sha1(str(size).encode())
+
+    with open(filename, "rb") as f:
+        h.update(f.read(sample))
+
+        if size > sample:
+            f.seek(max(size - sample, sample))
+            h.update(f.read(sample))
+
+    return h.hexdigest()
+
+
 def scp(host, src, dst):
     """ scp src host:dst """
     command = "scp %s %s:/tmp" % (src, host)
@@ -152,3 +222,13 @@ class ExportFileAlreadyExistsException(Exception):
 class NoActiveDatabaseException(Exception):
     """ please specify a valid database choice """
     pass
+
+
+class CheckpointMismatchException(Exception):
+    """ the restore checkpoint file was written for another archive """
+    pass
+
+
+class VerificationFailedException(Exception):
+    """ restored tables don't match the source """
+    pass
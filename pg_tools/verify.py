@@ -0,0 +1,226 @@
+""" post restore verification of tables row counts and content """
+import json
+import time
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+##
+# Each table gets a row count, either exact or the planner estimate, and
+# optionally a content checksum: the sum of the first 64 bits of md5(row)
+# over all the rows. A sum doesn't depend on the rows order, and sums of
+# key ranges add up to the sum of the table, so that big tables with an
+# integer primary key can be split in ranges checked in parallel.
+#
+# md5(row) hashes the text output of the row, which depends on the session
+# settings: every connection pins them, so that servers configured apart
+# still agree on the same data.
+
+TABLES_SQL = """
+SELECT n.nspname, c.relname, c.reltuples::bigint,
+       (SELECT a.attname
+          FROM pg_index i
+               JOIN pg_attribute a
+                 ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+         WHERE i.indrelid = c.oid AND i.indisprimary AND i.indnatts = 1
+           AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype))
+  FROM pg_class c
+       JOIN pg_namespace n ON n.oid = c.relnamespace
+ WHERE c.relkind = 'r'
+   AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+   AND n.nspname !~ '^pg_toast'
+"""
+
+KEY_RANGE_SQL = "SELECT min({key}), max({key}) FROM {relname}"
+
+COUNT_SQL = "SELECT count(*), NULL FROM {relname} t"
+
+CHECKSUM_SQL = """
+SELECT count(*),
+       coalesce(sum(('x' || substr(md5(t::text), 1, 16))::bit(64)::bigint::numeric), 0)
+  FROM {relname} t
+"""
+
+RANGE_SQL = " WHERE {key} >= {lo} AND {key} < {hi}"
+
+# the settings the text output of values depends on
+SETTINGS = (
+    ("DateStyle", "ISO,YMD"),
+    ("IntervalStyle", "postgres"),
+    ("TimeZone", "UTC"),
+    ("extra_float_digits", "3"),
+    ("bytea_output", "hex"),
+)
+
+TableCheck = namedtuple(
+    "TableCheck",
+    ["table", "expected_rows", "rows", "expected_checksum", "checksum", "status", "elapsed"],
+)
+
+
+def ident(name):
+    """ quoted identifier """
+    return '"%s"' % name.replace('"', '""')
+
+
+def relname(schema, table):
+    """ quoted schema.table """
+    return "%s.%s" % (ident(schema), ident(table))
+
+
+def session_options():
+    """ libpq options pinning SETTINGS """
+    return " ".join(f"-c {name}={value}" for name, value in SETTINGS)
+
+
+def query(pool, sql):
+    """ run sql on a pooled connection and return the first row """
+
+    conn = pool.getconn()
+    try:
+        curs = conn.cursor()
+        curs.execute(sql)
+        row = curs.fetchone()
+        curs.close()
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
+
+    return row
+
+
+def check_range(pool, table, sql):
+    """ return (table, rows, checksum, elapsed) for a table or key range """
+
+    start_time = time.time()
+
+    logger.debug(sql)
+    rows, checksum = query(pool, sql)
+
+    if checksum is not None:
+        checksum = int(checksum)
+
+    return table, rows, checksum, time.time() - start_time
+
+
+def collect(dsn, exact=True, checksum=False, ranges=1, jobs=4):
+    """return {schema.table: {"rows": n, "checksum": sum, "elapsed": secs}}
+    for the tables of the database at dsn, using jobs connections"""
+
+    from concurrent.futures import ThreadPoolExecutor
+    from psycopg2.pool import ThreadedConnectionPool
+
+    pool = ThreadedConnectionPool(1, jobs, dsn, options=session_options())
+
+    try:
+        conn = pool.getconn()
+        curs = conn.cursor()
+        curs.execute(TABLES_SQL)
+        tables = curs.fetchall()
+        curs.close()
+        conn.rollback()
+        pool.putconn(conn)
+
+        stats = {}
+        tasks = []
+
+        for schema, table, reltuples, key in tables:
+            name = f"{schema}.{table}"
+            stats[name] = {"rows": 0, "checksum": None, "elapsed": 0.0}
+
+            if not exact:
+                stats[name]["rows"] = max(int(reltuples), 0)
+
+                if not checksum:
+                    continue
+
+            rel = relname(schema, table)
+            key = key and ident(key)
+            sql = (CHECKSUM_SQL if checksum else COUNT_SQL).format(relname=rel)
+
+            if ranges > 1 and key is not None:
+                lo, hi = query(pool, KEY_RANGE_SQL.format(key=key, relname=rel))
+
+                if lo is not None:
+                    step = max((hi - lo + 1) // ranges, 1)
+                    for start in range(lo, hi + 1, step):
+                        where = RANGE_SQL.format(key=key, lo=start, hi=start + step)
+                        tasks.append((name, sql + where))
+                    continue
+
+            tasks.append((name, sql))
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(check_range, pool, t, sql) for t, sql in tasks]
+
+            for future in futures:
+                name, rows, sum_, elapsed = future.result()
+                s = stats[name]
+
+                if exact:
+                    s["rows"] += rows
+                if sum_ is not None:
+                    s["checksum"] = (s["checksum"] or 0) + sum_
+                s["elapsed"] += elapsed
+
+        # checksums overflow JSON numbers
+        for s in stats.values():
+            if s["checksum"] is not None:
+                s["checksum"] = str(s["checksum"])
+
+        return stats
+    finally:
+        pool.closeall()
+
+
+def write_stats(path, stats):
+    """ save stats from collect, e.g. at dump time """
+
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+
+
+def read_stats(path):
+    """ load stats written by write_stats """
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(expected, found, exact=True, tolerance=0.1):
+    """ return a list of TableCheck, one per expected table """
+
+    report = []
+
+    for name in sorted(expected):
+        e = expected[name]
+        f = found.get(name)
+
+        if f is None:
+            report.append(
+                TableCheck(name, e["rows"], None, e["checksum"], None, "missing", 0.0)
+            )
+            continue
+
+        if exact:
+            ok = e["rows"] == f["rows"]
+        else:
+            ok = abs(e["rows"] - f["rows"]) <= tolerance * max(e["rows"], 1)
+
+        if e["checksum"] is not None and f["checksum"] is not None:
+            ok = ok and e["checksum"] == f["checksum"]
+
+        report.append(
+            TableCheck(
+                name,
+                e["rows"],
+                f["rows"],
+                e["checksum"],
+                f["checksum"],
+                "pass" if ok else "fail",
+                f["elapsed"],
+            )
+        )
+
+    return report
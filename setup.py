@@ -16,6 +16,13 @@ setup_requirements = ['psycopg2-binary', ]
 
 test_requirements = ['pytest>=3', ]
 
+# optional features, pip install pg_tools[yaml]
+extras_requirements = {
+    'yaml': ['PyYAML'],
+    'lz4': ['lz4'],
+    'zstd': ['zstandard'],
+}
+
 setup(
     author="Vikram Arsid",
     author_email='vikramarsid@gmail.com',
@@ -38,6 +45,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
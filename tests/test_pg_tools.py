@@ -2,6 +2,7 @@
 
 """Tests for `pg_tools` package."""
 
+import os
 import pytest
 
 
@@ -22,3 +23,1327 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+def test_vacuumdb_target(tmp_path, monkeypatch):
+    """vacuumdb connects to the restored database, not the maintenance one"""
+    import psycopg2
+
+    dsns, sqls = [], []
+
+    class Cursor:
+        def execute(self, sql):
+            sqls.append(sql)
+
+        def fetchone(self):
+            return (0,)
+
+        def close(self):
+            pass
+
+    class Conn:
+        def set_isolation_level(self, level):
+            pass
+
+        def cursor(self):
+            return Cursor()
+
+        def close(self):
+            pass
+
+    def connect(dsn):
+        dsns.append(dsn)
+        return Conn()
+
+    monkeypatch.setattr(psycopg2, "connect", connect)
+
+    restore = make_restore(tmp_path)
+    restore.vacuumdb()
+
+    assert dsns == [restore.db_dsn()]
+    assert "dbname='db'" in dsns[0]
+    assert sqls[0] == "VACUUM ANALYZE"
+
+
+def test_run_command_output(tmp_path):
+    """output is bytes unless asked for text, as the catalog readers do"""
+    from pg_tools import utils
+
+    assert utils.run_command(["echo", "hi"], returning=utils.RET_OUT) == b"hi\n"
+    assert utils.run_command(
+        ["echo", "hi"], returning=utils.RET_OUT, universal_newlines=True
+    ) == "hi\n"
+
+    restore_cmd = tmp_path / "pg_restore"
+    restore_cmd.write_text("#!/bin/sh\necho '1; 0 0 TABLE public t postgres'\n")
+    restore_cmd.chmod(0o755)
+
+    restore = make_restore(tmp_path)
+    assert restore.list_catalog(str(tmp_path / "not_an_archive")) == (
+        "1; 0 0 TABLE public t postgres\n"
+    )
+
+
+def test_provision(tmp_path):
+    """the template is restored when the dump changed, then cloned, with a
+    STRATEGY picked by size on PostgreSQL 15"""
+    from pg_tools import pg_tools, utils
+
+    sqls = []
+    server = {"version": "150004", "comment": None, "size": 10}
+
+    class Cursor:
+        def execute(self, sql, params=None):
+            sqls.append((sql, params))
+            self.description = None
+            if sql.startswith("SHOW"):
+                self.row = (server["version"],)
+            elif "shobj_description" in sql:
+                self.description, self.rows = (), [(server["comment"],)]
+            elif "pg_database_size" in sql:
+                self.description, self.rows = (), [(server["size"],)]
+            elif "FROM pg_database" in sql or "pg_terminate_backend" in sql:
+                self.description, self.rows = (), [(1,)]
+
+        def fetchone(self):
+            return self.row
+
+        def fetchall(self):
+            return self.rows
+
+        def close(self):
+            pass
+
+    class Conn:
+        autocommit = False
+
+        def cursor(self):
+            return Cursor()
+
+        def close(self):
+            pass
+
+    dump = tmp_path / "db.dump"
+    dump.write_bytes(b"PGDMP dump")
+
+    restore = make_restore(tmp_path)
+    restore.mconn = Conn()
+    restore.pg_restore = lambda filename: 1.0
+    restore.vacuumdb = lambda: 2.0
+
+    timings = restore.provision(str(dump), "tpl", ["a", "b"])
+    assert (timings["restore"], timings["vacuum"]) == (1.0, 2.0)
+    assert set(timings) == {"restore", "vacuum", "a", "b"}
+
+    ddl = [sql for sql, _ in sqls if not sql.startswith(("SELECT", "SHOW"))]
+    assert ddl == [
+        'ALTER DATABASE "tpl" WITH IS_TEMPLATE false',
+        'DROP DATABASE "tpl"',
+        'CREATE DATABASE "tpl" WITH OWNER "postgres" ENCODING \'UTF8\'',
+        'COMMENT ON DATABASE "tpl" IS %s',
+        'ALTER DATABASE "tpl" WITH IS_TEMPLATE true ALLOW_CONNECTIONS false',
+        'CREATE DATABASE "a" WITH TEMPLATE "tpl" OWNER "postgres" STRATEGY WAL_LOG',
+        'CREATE DATABASE "b" WITH TEMPLATE "tpl" OWNER "postgres" STRATEGY WAL_LOG',
+    ]
+    tag = [p for sql, p in sqls if sql.startswith("COMMENT")][0][0]
+    assert tag == pg_tools.TEMPLATE_TAG + utils.fingerprint(str(dump))
+
+    # the template is up to date: only the clones, big ones copied
+    sqls.clear()
+    server.update(comment=tag, size=pg_tools.FILE_COPY_SIZE + 1)
+    timings = restore.provision(str(dump), "tpl", ["c"])
+    assert set(timings) == {"c"}
+    assert [sql for sql, _ in sqls if sql.startswith("CREATE")] == [
+        'CREATE DATABASE "c" WITH TEMPLATE "tpl" OWNER "postgres" STRATEGY FILE_COPY'
+    ]
+
+    # no STRATEGY before PostgreSQL 15, given ones are kept
+    sqls.clear()
+    server["version"] = "140010"
+    restore.clone_database("tpl", "d", strategy="WAL_LOG")
+    assert sqls[-1][0] == 'CREATE DATABASE "d" WITH TEMPLATE "tpl" OWNER "postgres"'
+
+
+def test_swap_databases(tmp_path):
+    """clients are paused for the renames only, and resumed when they fail"""
+    from pg_tools import pgbouncer
+
+    events = []
+
+    class Cursor:
+        description = None
+
+        def execute(self, sql):
+            events.append(sql)
+
+        def close(self):
+            pass
+
+    class Conn:
+        def cursor(self):
+            return Cursor()
+
+        def close(self):
+            pass
+
+    console = pgbouncer.PgBouncer.__new__(pgbouncer.PgBouncer)
+    console.conn = Conn()
+
+    restore = make_restore(tmp_path, dbname="My-db")
+    existing = {"My-db", "My-db_new", "My-db_old"}
+    fail = []
+
+    def maint_execute(sql, params=None):
+        events.append(sql)
+        if any(f in sql for f in fail):
+            raise Exception("ERROR:  boom")
+
+    restore.maint_execute = maint_execute
+    restore.database_exists = lambda dbname: dbname in existing
+    restore.terminate_backends = lambda dbname: events.append(f"terminate {dbname}")
+
+    console.pause('a"b')
+    assert events.pop() == 'PAUSE "a""b"'
+
+    restore.swap_databases("My-db_new", "My-db_old", console)
+    assert events == [
+        "terminate My-db_old",
+        'DROP DATABASE "My-db_old"',
+        'PAUSE "My-db"',
+        'ALTER DATABASE "My-db" WITH ALLOW_CONNECTIONS false',
+        "terminate My-db",
+        'ALTER DATABASE "My-db" RENAME TO "My-db_old"',
+        "terminate My-db_new",
+        'ALTER DATABASE "My-db_new" RENAME TO "My-db"',
+        'RESUME "My-db"',
+    ]
+
+    # the live database is put back, and clients resumed, on errors
+    events.clear()
+    existing.discard("My-db_old")
+    fail.append('"My-db_new" RENAME')
+    with pytest.raises(Exception, match="boom"):
+        restore.swap_databases("My-db_new", "My-db_old", console)
+    assert events[-3:] == [
+        'ALTER DATABASE "My-db_old" RENAME TO "My-db"',
+        'ALTER DATABASE "My-db" WITH ALLOW_CONNECTIONS true',
+        'RESUME "My-db"',
+    ]
+    assert events[0] == 'PAUSE "My-db"'
+
+    # refresh restores the side database, then swaps and drops the old one
+    events.clear()
+    fail.clear()
+    restore.createdb = lambda encoding: events.append(f"createdb {restore.dbname}")
+    restore.dropdb = lambda: events.append(f"dropdb {restore.dbname}")
+    restore.pg_restore = lambda filename: events.append(f"restore {restore.dbname}")
+    restore.vacuumdb = lambda: events.append(f"vacuum {restore.dbname}")
+    restore.drop_database_async = lambda dbname: events.append(f"drop {dbname}")
+
+    timings = restore.refresh("db.dump", pgbouncer=console)
+    assert set(timings) == {"restore", "vacuum", "swap"}
+    assert events[:5] == [
+        "terminate My-db_new",
+        "dropdb My-db_new",
+        "createdb My-db_new",
+        "restore My-db_new",
+        "vacuum My-db_new",
+    ]
+    assert events[5] == 'PAUSE "My-db"'
+    assert events[-2:] == ['RESUME "My-db"', "drop My-db_old"]
+    assert restore.dbname == "My-db"
+
+
+CATALOG = """;
+; Archive created at 2021-02-25 10:00:00 UTC
+;
+3; 2615 122814 SCHEMA - pgq postgres
+142; 1255 122813 FUNCTION public txid_visible_in_snapshot(bigint, txid_snapshot) postgres
+3385; 1259 123008 TABLE londiste subscriber_table payment
+6662; 0 788811 TABLE DATA payment abocb_code payment
+6663; 0 788819 TABLE DATA payment abocb_renew payment
+6904; 0 0 SEQUENCE OWNED BY londiste provider_seq_nr_seq payment
+6014; 2606 56535 FK CONSTRAINT archives rev_2001_id_compte_fkey webadmin
+"""
+
+
+def test_parse_catalog():
+    """catalog lines are split into TOC entries"""
+    from pg_tools.catalog import parse_catalog
+
+    entries = {e.dump_id: e for e in parse_catalog(CATALOG)}
+
+    assert len(entries) == 7
+    assert entries[142].tag == "txid_visible_in_snapshot(bigint, txid_snapshot)"
+    assert entries[6662].desc == "TABLE DATA"
+    assert (entries[6662].schema, entries[6662].tag) == ("payment", "abocb_code")
+    assert entries[6904].desc == "SEQUENCE OWNED BY"
+    assert entries[6014].desc == "FK CONSTRAINT"
+    assert entries[6014].owner == "webadmin"
+
+
+def test_restore_checkpoint(tmp_path):
+    """a resumed restore skips done entries and knows what was in progress"""
+    from pg_tools.checkpoint import RestoreCheckpoint
+
+    archive = tmp_path / "db.dump"
+    archive.write_bytes(b"PGDMP")
+    path = str(tmp_path / "db.checkpoint")
+
+    ckpt = RestoreCheckpoint(path, str(archive), CATALOG)
+    ckpt.open()
+    ckpt.feed('pg_restore: creating SCHEMA "pgq"')
+    ckpt.feed('pg_restore: creating TABLE "londiste.subscriber_table"')
+    ckpt.feed('pg_restore: processing data for table "payment.abocb_code"')
+    ckpt.close()
+
+    ckpt = RestoreCheckpoint(path, str(archive), CATALOG)
+    assert ckpt.done == {3, 3385}
+    assert [e.dump_id for e in ckpt.in_progress()] == [6662]
+
+    catalog = ckpt.filter_catalog(CATALOG)
+    assert ";3385; 1259 123008 TABLE londiste" in catalog
+    assert "\n6662; 0 788811 TABLE DATA" in catalog
+
+
+def test_restore_checkpoint_error(tmp_path):
+    """an entry that failed is never recorded as done"""
+    from pg_tools.checkpoint import RestoreCheckpoint
+
+    archive = tmp_path / "db.dump"
+    archive.write_bytes(b"PGDMP")
+
+    # serial: the next item starting doesn't make the failed one done
+    ckpt = RestoreCheckpoint(str(tmp_path / "serial"), str(archive), CATALOG)
+    ckpt.feed("pg_restore: processing item 6662 TABLE DATA abocb_code")
+    ckpt.feed('pg_restore: error: COPY failed for table "abocb_code": ERROR:  boom')
+    ckpt.feed("pg_restore: processing item 6663 TABLE DATA abocb_renew")
+    assert 6662 not in ckpt.done
+    assert [e.dump_id for e in ckpt.in_progress()] == [6662, 6663]
+
+    # parallel: failed items are reported as finished
+    ckpt = RestoreCheckpoint(str(tmp_path / "parallel"), str(archive), CATALOG)
+    ckpt.feed("pg_restore: launching item 6662 TABLE DATA abocb_code")
+    ckpt.feed("pg_restore: launching item 6663 TABLE DATA abocb_renew")
+    ckpt.feed("pg_restore: from TOC entry 6662; 0 788811 TABLE DATA payment abocb_code payment")
+    ckpt.feed("pg_restore: finished item 6662 TABLE DATA abocb_code")
+    ckpt.feed("pg_restore: finished item 6663 TABLE DATA abocb_renew")
+    assert ckpt.done == {6663}
+
+
+def test_incremental_link_data(tmp_path):
+    """unchanged tables data is linked from the snapshot that dumped it"""
+    from pg_tools import incremental
+
+    old = {"relfilenode": 16384, "n_mod": 10, "columns": "5f3e", "checksum": None}
+    assert not incremental.table_changed(old, dict(old))
+    assert incremental.table_changed(old, dict(old, n_mod=11))
+    # ALTER TABLE ... ADD COLUMN, without a rewrite
+    assert incremental.table_changed(old, dict(old, columns="9a1c"))
+    assert incremental.table_changed(None, old)
+
+    src = tmp_path / "2021-03-01"
+    src.mkdir()
+    (src / "toc.dat").write_bytes(b"PGDMP")
+    (src / "6663.dat.gz").write_bytes(b"data")
+
+    table = {"origin": "2021-03-01", "dump_id": 6663}
+    assert incremental.data_dir(str(src), table) == str(src)
+
+    dst = tmp_path / "2021-03-02" / incremental.PARTS / "2021-03-01"
+    incremental.link_data(str(src), str(dst), 6663)
+
+    assert os.path.samefile(str(dst / "6663.dat.gz"), str(src / "6663.dat.gz"))
+    assert (dst / "toc.dat").exists()
+
+
+def make_restore(tmp_path, dbname="db", **kwargs):
+    """a PGRestore that doesn't connect, its pg_restore a script in tmp_path,
+    a no-op one unless the test wrote its own"""
+
+    restore_cmd = tmp_path / "pg_restore"
+    if not restore_cmd.exists():
+        restore_cmd.write_text("#!/bin/sh\n")
+
+    restore = pg_tools.PGRestore(
+        dbname, "postgres", "localhost", 5432, "postgres", "postgres", 13,
+        restore_cmd=str(restore_cmd), connect=False, **kwargs
+    )
+    restore.try_connection = lambda timeout=None: None
+
+    return restore
+
+
+def write_archive(path, entries, data=None, blobs=None):
+    """write a minimal custom format archive, version 1.14, with entries
+    given as (dump_id, desc, namespace, tag, defn[, dependencies]), optional
+    data blocks given as {dump_id: [chunk, ...]} and large objects blocks as
+    {dump_id: [(oid, compressed data), ...]}"""
+    blobs = blobs or {}
+    data = dict(data or {})
+    data.update(blobs)
+
+    def i(n):
+        return bytes([1 if n < 0 else 0]) + abs(n).to_bytes(4, "little")
+
+    def s(v):
+        if v is None:
+            return i(-1)
+        v = v.encode()
+        return i(len(v)) + v
+
+    head = b"PGDMP" + bytes([1, 14, 0, 4, 8, 1]) + i(-1)
+    head += b"".join(i(n) for n in (0, 0, 10, 25, 1, 121, 0))
+    head += s("db") + s("13.2") + s("13.2")
+
+    def toc(offsets):
+        out = i(len(entries))
+        for entry in entries:
+            dump_id, desc, namespace, tag, defn = entry[:5]
+            deps = entry[5] if len(entry) > 5 else [1]
+            out += i(dump_id) + i(1 if dump_id in data else 0)
+            out += s("1259") + s(str(dump_id * 10)) + s(tag) + s(desc)
+            out += i(3 if desc in ("TABLE DATA", "BLOBS") else 2)
+            copy = None
+            if desc == "TABLE DATA":
+                copy = "COPY %s.%s FROM stdin;\n" % (namespace, tag)
+            out += s(defn) + s("") + s(copy) + s(namespace) + s("") + s("")
+            out += s("postgres") + s("false")
+            out += b"".join(s(str(d)) for d in deps) + s(None)
+            if dump_id in offsets:
+                out += bytes([2]) + offsets[dump_id].to_bytes(8, "little")
+            else:
+                out += bytes([3]) + (0).to_bytes(8, "little")
+        return out
+
+    # data blocks go after the toc, whose size doesn't depend on offsets
+    pos = len(head) + len(toc({}))
+    offsets, blocks = {}, b""
+    for dump_id, chunks in data.items():
+        offsets[dump_id] = pos + len(blocks)
+        if dump_id in blobs:
+            blocks += bytes([3]) + i(dump_id)
+            blocks += b"".join(i(oid) + i(len(c)) + c + i(0) for oid, c in chunks) + i(0)
+        else:
+            blocks += bytes([1]) + i(dump_id)
+            blocks += b"".join(i(len(c)) + c for c in chunks) + i(0)
+
+    with open(path, "wb") as f:
+        f.write(head + toc(offsets) + blocks)
+
+
+def test_archive_reader(tmp_path):
+    """the TOC of a custom archive is read without pg_restore"""
+    from pg_tools import archive
+
+    path = str(tmp_path / "db.dump")
+    write_archive(path, [
+        (1, "ENCODING", None, "ENCODING", "SET client_encoding = 'UTF8';"),
+        (3, "SCHEMA", None, "jdb", "CREATE SCHEMA jdb;"),
+        (7, "TABLE DATA", "jdb", "daily_journal", ""),
+        (9, "TRIGGER", "jdb", "daily_journal www_to_reporting_logger",
+         "CREATE TRIGGER www_to_reporting_logger AFTER INSERT ON "
+         "jdb.daily_journal FOR EACH ROW EXECUTE FUNCTION "
+         "pgq.logtriga('www_to_reporting', 'kv');"),
+    ])
+
+    assert archive.readable(path)
+
+    with archive.Archive(path) as a:
+        assert a.compression == "gzip"
+        assert a.created == "2021-02-25 10:00:00"
+        entries = list(a.entries())
+
+    assert [e.dump_id for e in entries] == [1, 3, 7, 9]
+    assert entries[2].dependencies == [1]
+    assert entries[2].section == "DATA"
+
+    listing = archive.listing(path)
+    assert "7; 1259 70 TABLE DATA jdb daily_journal postgres" in listing
+    assert "ENCODING" not in listing
+
+    assert archive.trigger_funcs(path) == {
+        "jdb": {"www_to_reporting_logger": ["pgq.logtriga"]}
+    }
+
+
+def test_extract_table_csv(tmp_path):
+    """a single table data is extracted from its block in the archive"""
+    import zlib
+
+    rows = b"1\tfoo\\tbar\t\\N\n2\t\t\\\\x\n"
+    z = zlib.compressobj()
+    compressed = z.compress(rows) + z.flush()
+
+    path = str(tmp_path / "db.dump")
+    write_archive(
+        path,
+        [
+            (5, "TABLE DATA", "public", "other", ""),
+            (7, "TABLE DATA", "jdb", "daily_journal", ""),
+        ],
+        data={
+            5: [zlib.compress(b"junk\n")],
+            7: [compressed[:10], compressed[10:]],
+        },
+    )
+
+    restore = make_restore(tmp_path)
+    csvfile = str(tmp_path / "daily_journal.csv")
+    restore.extract_table(path, "jdb.daily_journal", csvfile=csvfile)
+
+    with open(csvfile) as f:
+        assert f.read() == '1,foo\tbar,\n2,"",\\x\n'
+
+
+def test_verify_compare():
+    """tables are compared on row counts and checksums"""
+    from pg_tools import verify
+
+    expected = {
+        "jdb.a": {"rows": 10, "checksum": "42", "elapsed": 0.1},
+        "jdb.b": {"rows": 100, "checksum": None, "elapsed": 0.1},
+        "jdb.c": {"rows": 1, "checksum": None, "elapsed": 0.1},
+    }
+    found = {
+        "jdb.a": {"rows": 10, "checksum": "43", "elapsed": 0.2},
+        "jdb.b": {"rows": 95, "checksum": None, "elapsed": 0.2},
+    }
+
+    status = {c.table: c.status for c in verify.compare(expected, found)}
+    assert status == {"jdb.a": "fail", "jdb.b": "fail", "jdb.c": "missing"}
+
+    status = {c.table: c.status for c in verify.compare(expected, found, exact=False)}
+    assert status["jdb.b"] == "pass"
+
+
+def test_sql_script_split():
+    """statements are split as psql does, COPY data is kept apart"""
+    import io
+    from pg_tools.sqlscript import Script
+
+    src = (
+        "SET client_min_messages = warning;\n"
+        "\\echo loading\n"
+        "CREATE FUNCTION f() RETURNS int AS $body$\n"
+        "  SELECT 1; -- not the end\n"
+        "$body$ LANGUAGE sql;\n"
+        "INSERT INTO t VALUES ('a;b', E'it\\'s;', 'x''y;', \"we;ird\");\n"
+        "/* a; /* nested; */ comment; */ SELECT 2;\n"
+        "COPY t (a) FROM stdin;\n"
+        "1;2\n"
+        "\\.\n"
+        "SELECT 3\n"
+    )
+
+    out = []
+    for stmt in Script(io.StringIO(src)):
+        out.append((stmt.kind, stmt.lineno))
+        if stmt.data:
+            assert stmt.data.read() == "1;2\n"
+
+    assert out == [
+        ("sql", 1), ("meta", 2), ("sql", 3), ("sql", 6), ("sql", 7),
+        ("copy", 8), ("sql", 11),
+    ]
+
+
+def test_sql_script_nesting():
+    """semicolons in parentheses and BEGIN ATOMIC bodies don't split"""
+    import io
+    from pg_tools.sqlscript import Script
+
+    src = (
+        "CREATE RULE r AS ON INSERT TO t DO ALSO (\n"
+        "  INSERT INTO log VALUES (new.id);\n"
+        "  UPDATE counts SET n = n + 1;\n"
+        ");\n"
+        "CREATE OR REPLACE FUNCTION f(x int) RETURNS int\n"
+        "LANGUAGE sql\n"
+        "BEGIN ATOMIC\n"
+        "  SELECT CASE WHEN x > 0 THEN 1 ELSE 0 END;\n"
+        "  SELECT x;\n"
+        "END;\n"
+        "BEGIN;\n"
+        "SELECT 1;\n"
+        "END;\n"
+    )
+
+    stmts = [stmt.sql for stmt in Script(io.StringIO(src))]
+
+    assert len(stmts) == 5
+    assert stmts[0].endswith("UPDATE counts SET n = n + 1;\n);")
+    assert stmts[1].startswith("CREATE OR REPLACE FUNCTION") and stmts[1].endswith("END;")
+    assert stmts[2:] == ["BEGIN;", "SELECT 1;", "END;"]
+
+
+def test_sql_script_session_meta(tmp_path):
+    """scripts with session meta-commands go to psql before running anything"""
+    from pg_tools import sqlscript
+
+    assert sqlscript.on_error_stop_value("\\set ON_ERROR_STOP on") is True
+    assert sqlscript.on_error_stop_value("\\set ON_ERROR_STOP off") is False
+    assert sqlscript.on_error_stop_value("\\set foo 1") is None
+
+    script = tmp_path / "script.sql"
+    script.write_text("\\set ON_ERROR_STOP on\nCREATE TABLE t();\n")
+    assert sqlscript.session_meta(str(script)) is None
+
+    script.write_text("CREATE TABLE t();\n\\set v 1\nSELECT :v;\n")
+    assert sqlscript.session_meta(str(script)) == (2, "\\set v 1")
+
+    log = tmp_path / "log"
+    psql = tmp_path / "psql"
+    psql.write_text('#!/bin/sh\necho "$@" > %s\necho "ERROR:  boom" >&2\n' % log)
+    psql.chmod(0o755)
+
+    # the connection isn't used at all, but for its encoding
+    conn = type("Conn", (), {"encoding": "UTF8"})()
+    result = sqlscript.run_script(conn, str(script), [str(psql), "db"], on_error_stop=True)
+
+    assert result.errors == 1 and result.statements is None
+    assert log.read_text().split() == [
+        "-X", "-f", str(script), "-v", "ON_ERROR_STOP=1", "db"
+    ]
+
+
+def test_sql_script_batches(tmp_path):
+    """batches run in their own transaction, rolled back before a replay,
+    CALL and DO run alone, the script is read in the client encoding"""
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+    from pg_tools import sqlscript
+
+    sent = []
+
+    class Cursor:
+        def execute(self, sql):
+            sent.append(sql)
+            if "boom" in sql:
+                raise Exception("ERROR:  boom")
+
+        def close(self):
+            pass
+
+    class Conn:
+        encoding = "LATIN1"
+        autocommit = False
+
+        def cursor(self):
+            return Cursor()
+
+        def get_transaction_status(self):
+            return TRANSACTION_STATUS_IDLE
+
+    script = tmp_path / "script.sql"
+    script.write_bytes(
+        "INSERT INTO t VALUES ('é');\n"
+        "SELECT boom;\n"
+        "CALL p();\n"
+        "DO $$ BEGIN COMMIT; END $$;\n".encode("latin-1")
+    )
+
+    result = sqlscript.run_script(Conn(), str(script), ["psql", "db"])
+
+    assert sent == [
+        "BEGIN;\nINSERT INTO t VALUES ('é');\nSELECT boom;;\nCOMMIT;",
+        "ROLLBACK",
+        "INSERT INTO t VALUES ('é');",
+        "SELECT boom;",
+        "CALL p();",
+        "DO $$ BEGIN COMMIT; END $$;",
+    ]
+    assert result.errors == 1 and result.statements == 4
+
+
+def test_cli_manifest(tmp_path, capsys):
+    """Manifest jobs get the defaults, failures make a non zero exit code"""
+    import json
+    from pg_tools import cli
+
+    manifest = tmp_path / "jobs.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "concurrency": 2,
+                "defaults": {"host": "db1", "pg_bin": str(tmp_path)},
+                "jobs": [
+                    {"command": "vacuum", "dbname": "billing"},
+                    {"name": "bogus", "command": "frobnicate", "dbname": "x"},
+                ],
+            }
+        )
+    )
+
+    concurrency, jobs = cli.load_manifest(str(manifest))
+    assert concurrency == 2
+    assert jobs[0]["name"] == "vacuum-1"
+    assert jobs[0]["host"] == "db1" and jobs[0]["port"] == 5432
+
+    # no pg_restore in pg_bin: both jobs fail, and are both reported
+    assert cli.main(["-q", "run", str(manifest)]) == 1
+    out = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r["job"] for r in out] == ["vacuum-1", "bogus"]
+    assert all(r["status"] == "error" for r in out)
+    assert "unknown command" in out[1]["error"]
+
+
+def test_missing_extras(tmp_path, monkeypatch):
+    """optional modules that aren't installed say which extra to install"""
+    import sys
+    from pg_tools import archive, cli, utils
+
+    for module in ("yaml", "lz4", "lz4.frame", "zstandard"):
+        monkeypatch.setitem(sys.modules, module, None)
+
+    manifest = tmp_path / "jobs.yml"
+    manifest.write_text("jobs: []\n")
+
+    with pytest.raises(utils.NotYetImplementedException, match=r"pg_tools\[yaml\]"):
+        cli.load_manifest(str(manifest))
+
+    for compression in ("lz4", "zstd"):
+        with pytest.raises(
+            utils.NotYetImplementedException, match=r"pg_tools\[%s\]" % compression
+        ):
+            archive.decompressor(compression)
+
+
+def test_schedule_lpt(tmp_path):
+    """largest entries first beats the archive order on skewed sizes"""
+    import random
+    from pg_tools import archive, schedule
+
+    # 30 small tables, then a big one last in the archive
+    costs = [10] * 30 + [100]
+    assigned, loads = schedule.lpt([(c, i) for i, c in enumerate(costs)], 4)
+
+    assert assigned[0][0] == 30
+    assert max(loads) == 100
+    assert schedule.makespan(costs, 4) == 170
+
+    # skewed sizes in random archive orders: LPT is no worse than the
+    # naive order overall, and at most 4/3 - 1/3m of it on any one, as the
+    # naive makespan is at least the optimal one
+    rnd = random.Random(4)
+    lpt_total = naive_total = 0
+    for _ in range(200):
+        costs = [int(rnd.paretovariate(1.2) * 1000) for _ in range(rnd.randint(1, 60))]
+        for workers in (2, 4, 8):
+            _, loads = schedule.lpt([(c, i) for i, c in enumerate(costs)], workers)
+            naive = schedule.makespan(costs, workers)
+            assert 3 * workers * max(loads) <= (4 * workers - 1) * naive
+            lpt_total += max(loads)
+            naive_total += naive
+
+    assert lpt_total <= naive_total
+
+    def entry(dump_id, desc, section, deps):
+        e = archive.ArchiveEntry(*[None] * len(archive.ArchiveEntry._fields))
+        return e._replace(
+            dump_id=dump_id, desc=desc, section=section, dependencies=deps
+        )
+
+    entries = [
+        entry(1, "TABLE", "PRE-DATA", []),
+        entry(2, "TABLE DATA", "DATA", [1]),
+        entry(3, "INDEX", "POST-DATA", [1]),
+        entry(4, "INDEX ATTACH", "POST-DATA", [3]),
+        entry(5, "COMMENT", "NONE", [3]),
+        entry(6, "ACL", "NONE", [1]),
+    ]
+    assert schedule.entry_phases(entries) == {
+        1: "pre", 2: "data", 3: "index", 4: "post", 5: "post", 6: "pre"
+    }
+    assert schedule.entry_costs(entries, {2: 1234}) == {2: 1234, 3: 1234}
+
+    # each worker gets its own -L list
+    path = str(tmp_path / "db.dump")
+    write_archive(
+        path,
+        [
+            (3, "SCHEMA", None, "jdb", "CREATE SCHEMA jdb;"),
+            (5, "TABLE DATA", "jdb", "small", ""),
+            (6, "TABLE DATA", "jdb", "medium", ""),
+            (7, "TABLE DATA", "jdb", "big", ""),
+        ],
+        data={5: [b"x" * 10], 6: [b"x" * 100], 7: [b"x" * 1000]},
+    )
+    steps = schedule.plan(path, archive.listing(path), 2)
+
+    assert [phase for phase, _, _ in steps] == ["pre", "data"]
+    big, rest = steps[1][1]
+    assert "jdb big" in big and "jdb medium" in rest and "jdb small" in rest
+
+
+def test_governor(tmp_path):
+    """data pipes are throttled to the rate, which can change at runtime"""
+    import io
+    from pg_tools import governor
+
+    assert governor.parse_rate("20M") == 20 * 1024 * 1024
+    assert governor.parse_rate("512kB") == 512 * 1024
+    assert governor.parse_rate(0) is None
+
+    g = governor.Governor(rate="2M", burst="256K", nice=10)
+    assert g.command("pg_dump db")[:3] == ["nice", "-n", "10"]
+
+    data = b"x" * 1024 * 1024
+    governor.run_command(["cat"], g, source=io.BytesIO(data))
+
+    report = g.report()
+    assert report["bytes"] == len(data)
+    assert report["throttled"] > 0.3
+
+    out = io.BytesIO()
+    rate_file = tmp_path / "rate"
+    rate_file.write_text("0")
+    g = governor.Governor(rate="1K", rate_file=str(rate_file))
+    governor.run_command("head -c 100000 /dev/zero", g, sink=out)
+
+    assert g.rate is None
+    assert len(out.getvalue()) == 100000
+
+
+def test_profiler_sample(tmp_path):
+    """backends time goes to the objects they work on and their waits"""
+    import csv
+    import json
+    from pg_tools import profiler
+
+    class Cursor:
+        def execute(self, sql):
+            self.sql = sql
+
+        def fetchall(self):
+            if "pg_stat_activity" in self.sql:
+                return [
+                    (11, "active", "IO", "DataFileRead", "COPY public.big (id) FROM stdin"),
+                    (12, "active", None, None, 'CREATE INDEX "big_idx" ON public.big'),
+                    (13, "active", "Lock", "relation", "ALTER TABLE ONLY public.small ADD CONSTRAINT"),
+                ]
+            return [(12, "big_idx", "building index", 50, 200)]
+
+        def close(self):
+            pass
+
+    class Conn:
+        def cursor(self):
+            return Cursor()
+
+    p = profiler.Profiler("dbname=x")
+    p.conn = Conn()
+    p.queries = [("index", profiler.PROGRESS_SQL["index"][1])]
+    p.sample(1000.0, 2.0)
+    p.sample(1001.0, 1.0)
+
+    report = p.report()
+    assert report["samples"] == 2
+    assert [o["object"] for o in report["objects"]][0] in ("public.big", "big_idx")
+    assert {w["wait"]: w["secs"] for w in report["waits"]} == {
+        "IO:DataFileRead": 3.0, "CPU": 3.0, "Lock:relation": 3.0
+    }
+    assert p.timeline[1]["progress"] == 25.0
+    assert p.timeline[2]["activity"] == "constraint"
+
+    p.write(str(tmp_path / "profile.csv"))
+    with open(str(tmp_path / "profile.csv")) as f:
+        assert len(list(csv.DictReader(f))) == 6
+
+    p.write(str(tmp_path / "profile.json"))
+    with open(str(tmp_path / "profile.json")) as f:
+        assert json.load(f)["report"]["samples"] == 2
+
+
+def test_estimate(tmp_path):
+    """durations come from the archive sizes and past throughputs"""
+    from pg_tools import estimate
+
+    history = estimate.History(str(tmp_path / "history.json"))
+
+    e = estimate.predict("data", 4000, 2000, 2, history)
+    assert e.samples == 0
+    assert e.low < e.expected < e.high
+
+    for rate in (100, 200, 300, 400, 500):
+        history.record("data", rate * 20, rate * 10, 10.0, jobs=2)
+
+    e = estimate.predict("data", 4000, 2000, 2, history)
+    assert e.samples == 5
+    assert (e.low, e.expected, e.high) == (4.0, 20 / 3, 20.0)
+
+    path = str(tmp_path / "db.dump")
+    write_archive(
+        path,
+        [(5, "TABLE DATA", "jdb", "small", ""), (7, "TABLE DATA", "jdb", "big", "")],
+        data={5: [b"x" * 100], 7: [b"x" * 1000]},
+    )
+    work = estimate.restore_work(path, 2, scheduled=True)
+    # sizes include the block headers: type, dump id, chunk size and end
+    assert work["data"][0] == 1100 + 2 * 16
+    assert work["data"][1] == 1000 + 16
+    assert work["index"] == (0, 0)
+
+    restore = make_restore(tmp_path)
+    restore.history = history
+    restore.restore_jobs = 2
+
+    estimates = restore.estimate_restore(path, scheduled=True)
+    assert [e.phase for e in estimates] == ["data", "index", "vacuum"]
+    assert estimates[0].samples == 5
+    assert estimates[2].bytes == 3 * work["data"][0]
+    assert estimate.report(estimates)[-1].startswith("total")
+
+
+def test_history_opt_in(tmp_path, monkeypatch):
+    """the library records no history unless given one, the cli does"""
+    import psycopg2
+    from pg_tools import cli, estimate
+
+    dump_cmd = tmp_path / "pg_dump"
+    dump_cmd.write_text("#!/bin/sh\necho dump\n")
+    dump_cmd.chmod(0o755)
+
+    restore = make_restore(tmp_path)
+    assert restore.history is None
+
+    def table_sizes():
+        raise AssertionError("table sizes without a history")
+
+    restore.table_sizes = table_sizes
+    restore.pg_dump(str(tmp_path / "a.dump"))
+
+    path = str(tmp_path / "history.json")
+    restore.history = estimate.History(path)
+    restore.table_sizes = lambda: [10, 20]
+    restore.pg_dump(str(tmp_path / "b.dump"))
+    assert [s["bytes"] for s in restore.history.load()["dump"]] == [30]
+
+    monkeypatch.setattr(psycopg2, "connect", lambda dsn: None)
+    job = dict(cli.DEFAULTS, dbname="db", pg_bin=str(tmp_path))
+
+    assert cli.pgrestore(dict(job, history=path)).history.path == path
+    assert cli.pgrestore(job).history.path == estimate.HISTORY
+    assert cli.pgrestore(dict(job, history=False)).history is None
+
+
+def test_restore_cluster(tmp_path):
+    """databases are restored largest first, a failure doesn't stop others"""
+    from pg_tools import cluster, utils
+
+    assert cluster.dump_filename("my db/1") == "my%20db%2F1.dump"
+
+    log = tmp_path / "log"
+    restore_cmd = tmp_path / "pg_restore"
+    restore_cmd.write_text(
+        '#!/bin/sh\necho "$@" >> %s\ncase "$*" in *bad*) exit 1;; esac\n' % log
+    )
+    restore_cmd.chmod(0o755)
+
+    cluster.write_manifest(
+        str(tmp_path),
+        {
+            "globals": cluster.GLOBALS,
+            "databases": [
+                {"dbname": "small", "size": 10, "file": "small.dump", "status": "ok"},
+                {"dbname": "bad", "size": 20, "file": "bad.dump", "status": "ok"},
+                {"dbname": "big", "size": 30, "file": "big.dump", "status": "ok"},
+                {"dbname": "lost", "size": 40, "file": "lost.dump", "status": "error"},
+                {"dbname": "postgres", "size": 5, "file": "postgres.dump", "status": "ok"},
+            ],
+        },
+    )
+
+    restore = make_restore(tmp_path, "postgres")
+    restore.run_sql_file = lambda filename, dbname=None: None
+
+    with pytest.raises(utils.PGRestoreFailedException, match="bad"):
+        restore.pg_restore_cluster(str(tmp_path), jobs=1)
+
+    lines = log.read_text().splitlines()
+    assert [line.split("/")[-1] for line in lines] == [
+        "big.dump", "bad.dump", "small.dump", "postgres.dump"
+    ]
+    # the postgres database exists already, it's restored into
+    assert all("--create -d postgres " in line for line in lines[:3])
+    assert "--create" not in lines[3] and "-d postgres " in lines[3]
+
+    assert restore.pg_restore_cluster(str(tmp_path), databases=["small"]).keys() == {"small"}
+
+
+def test_subset_sql():
+    """sampled tables data is left out, and parents fetched by key"""
+    from pg_tools import subset
+
+    assert subset.sample_clause(1) == "TABLESAMPLE SYSTEM (1)"
+    assert subset.sample_clause("0.5") == "TABLESAMPLE SYSTEM (0.5)"
+    assert subset.sample_clause("created > now() - '7 days'::interval") == (
+        "WHERE created > now() - '7 days'::interval"
+    )
+    assert subset.sample_clause("TABLESAMPLE BERNOULLI (2)") == "TABLESAMPLE BERNOULLI (2)"
+
+    catalog = subset.drop_data(CATALOG, {"payment.abocb_code": 1})
+    assert ";6662; 0 788811 TABLE DATA payment abocb_code payment" in catalog
+    assert "\n6663; 0 788819 TABLE DATA payment abocb_renew payment" in catalog
+
+    fk = subset.ForeignKey(
+        "public.orders", "public.customers", ["customer_id"], ["id"], ["bigint"]
+    )
+    assert subset.missing_keys_sql(fk) == (
+        'SELECT DISTINCT c."customer_id"::text FROM "public"."orders" c '
+        'WHERE c."customer_id" IS NOT NULL AND NOT EXISTS '
+        '(SELECT 1 FROM "public"."customers" p WHERE p."id" = c."customer_id")'
+    )
+    assert subset.parent_rows_sql(fk, ["id", "name"]) == (
+        'SELECT "id", "name" FROM "public"."customers" WHERE ("id") IN '
+        "(SELECT k0::bigint FROM unnest(%s::text[]) AS k(k0))"
+    )
+
+
+def test_chunk_store(tmp_path):
+    """similar dumps share their chunks, read back and gc"""
+    import random
+    from pg_tools import chunkstore
+
+    rnd = random.Random(42)
+    lines = [b"%d\t%x\tsome row data\n" % (i, rnd.getrandbits(64)) for i in range(200000)]
+    first = b"".join(lines)
+    lines.insert(100000, b"100000.5\tinserted row\n")
+    second = b"".join(lines)
+
+    store = chunkstore.ChunkStore(str(tmp_path / "store"))
+
+    stats = []
+    for name, data in (("monday", first), ("tuesday", second)):
+        writer = store.writer(name)
+        for i in range(0, len(data), 100000):
+            writer.write(data[i: i + 100000])
+        stats.append(writer.close())
+
+    assert stats[0]["count"] > 10
+    # the inserted row only changes the chunk around it
+    assert stats[1]["written"] < stats[0]["written"] / 5
+
+    reader = store.reader("tuesday")
+    assert reader.read(10) + reader.read() == second
+    assert [m["name"] for m in store.manifests()] == ["monday", "tuesday"]
+
+    # monday goes, the chunks only it used too once past the grace period
+    assert store.gc(keep=1)["chunks"] == 0
+    removed = store.gc(keep=1, grace=-1)
+    assert removed["chunks"] >= 1
+    assert store.reader("tuesday").read() == second
+
+
+def test_fanout(tmp_path):
+    """the dump is read once, a slow target spills, a failing one is alone"""
+    from pg_tools import fanout
+    from pg_tools.governor import Governor
+
+    dump = tmp_path / "db.dump"
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    dump.write_bytes(data)
+
+    fast, slow = tmp_path / "fast", tmp_path / "slow"
+    targets = [
+        (["sh", "-c", f"cat > {fast}"], Governor()),
+        (["sh", "-c", f"sleep 0.5; cat > {slow}"], Governor()),
+        (["sh", "-c", "head -c 10 > /dev/null; exit 3"], Governor()),
+    ]
+
+    governor = Governor()
+    results = fanout.run(
+        str(dump), targets, governor, max_bytes=256 * 1024, spill_dir=str(tmp_path)
+    )
+
+    assert fast.read_bytes() == data
+    assert slow.read_bytes() == data
+    assert results[0][1] is None and results[1][1] is None
+    assert results[1][0] >= 0.5
+    assert results[2][0] is None and "Error [3]" in str(results[2][1])
+    assert governor.report()["bytes"] == len(data)
+
+
+def test_partitions_large_objects(tmp_path):
+    """leaf partitions follow their root, large objects are read in batches"""
+    import zlib
+    from pg_tools import archive
+    from pg_tools import largeobjects
+    from pg_tools import partitions
+    from pg_tools import schedule
+    from pg_tools.catalog import parse_catalog
+
+    path = str(tmp_path / "db.dump")
+    write_archive(
+        path,
+        [
+            (1, "SCHEMA", None, "public", ""),
+            (2, "SCHEMA", None, "parts", ""),
+            (10, "TABLE", "public", "events", "CREATE TABLE public.events ..."),
+            (11, "TABLE", "parts", "events_2021", "CREATE TABLE parts.events_2021 ...", [2]),
+            (12, "TABLE ATTACH", "parts", "events_2021", "ALTER TABLE ...", [10, 11]),
+            (13, "TABLE", "parts", "events_2022",
+             "CREATE TABLE parts.events_2022 PARTITION OF public.events ...", [10]),
+            (14, "TABLE", "public", "other", "CREATE TABLE public.other ..."),
+            (15, "TABLE", "parts", "misc", "CREATE TABLE parts.misc ...", [2]),
+            (20, "TABLE DATA", "parts", "events_2021", "", [11]),
+            (21, "TABLE DATA", "parts", "events_2022", "", [13]),
+            (22, "TABLE DATA", "public", "other", "", [14]),
+            (23, "INDEX", "parts", "events_2021_idx", "CREATE INDEX ...", [11]),
+            (30, "BLOB", None, "16385", "SELECT pg_catalog.lo_create('16385');"),
+            (31, "BLOBS", None, "BLOBS", ""),
+            (32, "ACL", None, "LARGE OBJECT 16385", "GRANT ...", [30]),
+        ],
+        data={20: [zlib.compress(b"1\n")], 21: [zlib.compress(b"2\n")],
+              22: [zlib.compress(b"3\n")]},
+        blobs={31: [(16385, zlib.compress(b"hello")), (16386, zlib.compress(b"world"))]},
+    )
+
+    with archive.Archive(path) as arch:
+        entries = list(arch.entries())
+
+    assert partitions.parents(entries) == {11: 10, 13: 10}
+    roots = partitions.roots(entries)
+    assert roots[20] == roots[23] == roots[12] == ("public", "events")
+    assert 22 not in roots
+
+    restore = make_restore(
+        tmp_path, schemas=["public"], relname_nodata=[r"^public\.events$"]
+    )
+
+    def kept(catalog):
+        return set(e.dump_id for e in parse_catalog(catalog))
+
+    # by default large objects ACLs go with the schema filter, as they did
+    catalog = restore.get_catalog(path, []).getvalue()
+    assert kept(catalog) == {1, 2, 10, 11, 12, 13, 14, 22, 23, 30, 31}
+
+    restore.large_objects = True
+    catalog = restore.get_catalog(path, []).getvalue()
+    assert kept(catalog) == {1, 2, 10, 11, 12, 13, 14, 22, 23, 30, 31, 32}
+
+    restore.large_objects = False
+    catalog = restore.get_catalog(path, []).getvalue()
+    assert kept(catalog) == {1, 2, 10, 11, 12, 13, 14, 22, 23}
+
+    assert list(largeobjects.batches(path, {31}, size=1)) == [
+        [(16385, b"hello")], [(16386, b"world")]
+    ]
+
+    steps = schedule.plan(path, restore.list_catalog(path), 2)
+    assert [(phase, len(catalogs)) for phase, catalogs, _ in steps] == [
+        ("pre", 1), ("data", 2), ("blobs", 1)
+    ]
+
+    # empty leaves are spread across workers too
+    assert schedule.lpt([(0, i) for i in range(4)], 2)[0] == [[0, 2], [1, 3]]
+
+
+def test_chunk_store_directory(tmp_path, monkeypatch):
+    """directory dumps get an output directory, uncompressed, and reused
+    chunks are safe from a concurrent gc"""
+    from pg_tools import chunkstore
+
+    log = tmp_path / "log"
+    pg_dump = tmp_path / "pg_dump"
+    pg_dump.write_text(
+        "#!/bin/sh\n"
+        'echo "$@" > %s\n'
+        'while [ $# -gt 0 ]; do case "$1" in -f) dir=$2; shift;; esac; shift; done\n'
+        'mkdir -p "$dir"\n'
+        'printf toc > "$dir/toc.dat"\n'
+        'printf "1\\n2\\n" > "$dir/3001.dat"\n' % log
+    )
+    pg_dump.chmod(0o755)
+
+    restore = make_restore(tmp_path)
+
+    store_dir = str(tmp_path / "store")
+    _, manifest = restore.pg_dump_store(store_dir, "monday", fmt="-Fd")
+
+    args = log.read_text().split()
+    assert args[:2] == ["-Fd", "-Z0"] and args[args.index("-f") + 1].endswith("dump")
+    assert sorted(manifest["files"]) == ["3001.dat", "toc.dat"]
+
+    store = chunkstore.ChunkStore(store_dir)
+    store.get_directory("monday", str(tmp_path / "out"))
+    assert (tmp_path / "out" / "3001.dat").read_bytes() == b"1\n2\n"
+
+    # an old chunk stored again by a dump in progress isn't collected
+    digest, written = store.put_chunk(b"old chunk")
+    os.utime(store.chunk_path(digest), (0, 0))
+    assert store.put_chunk(b"old chunk") == (digest, 0)
+    store.gc()
+    assert store.get_chunk(digest) == b"old chunk"
+
+    # gc removing a chunk between the exists check and the touch
+    digest, _ = store.put_chunk(b"racy")
+    utime = os.utime
+
+    def gc_utime(path):
+        os.unlink(path)
+        utime(path)
+
+    monkeypatch.setattr(os, "utime", gc_utime)
+    assert store.put_chunk(b"racy")[1] > 0
+    monkeypatch.undo()
+    assert store.get_chunk(digest) == b"racy"
+
+    # pg_restore reads the directory written back under tmpdir
+    restored = []
+
+    def pg_restore(path):
+        restored.append(sorted(os.listdir(path)))
+        return 1.0
+
+    restore.pg_restore = pg_restore
+    os.mkdir(str(tmp_path / "tmp"))
+    assert restore.pg_restore_store(store_dir, "monday", tmpdir=str(tmp_path / "tmp")) == 1.0
+    assert restored == [["3001.dat", "toc.dat"]]
+    assert os.listdir(str(tmp_path / "tmp")) == []
+
+
+def test_incremental_schema_change(tmp_path):
+    """tables whose columns or rows changed are dumped again, stats alike,
+    all read in the snapshot pg_dump uses"""
+    from contextlib import contextmanager
+    from pg_tools import incremental
+
+    def table(name, relfilenode, columns, checksum):
+        return {"schema": "public", "table": name, "relfilenode": relfilenode,
+                "n_mod": 5, "columns": columns, "checksum": checksum}
+
+    stats = {
+        "public.a": table("a", 1, "old", "10:42"),
+        "public.b": table("b", 2, "same", "20:43"),
+        "public.c": table("c", 3, "same", "30:44"),
+    }
+
+    previous = tmp_path / "2021-03-01"
+    previous.mkdir()
+    (previous / "toc.dat").write_bytes(b"PGDMP")
+    (previous / "6663.dat.gz").write_bytes(b"data")
+    incremental.write_manifest(str(previous), {
+        "name": "2021-03-01",
+        "tables": {
+            k: dict(t, origin="2021-03-01", dump_id=6663 if k == "public.b" else None)
+            for k, t in stats.items()
+        },
+    })
+
+    log = tmp_path / "log"
+    for cmd, mkdir in (("pg_dump", 'mkdir -p "$3"\n'), ("pg_restore", "")):
+        script = tmp_path / cmd
+        script.write_text('#!/bin/sh\n%secho %s "$@" >> %s\n' % (mkdir, cmd, log))
+        script.chmod(0o755)
+
+    restore = make_restore(tmp_path)
+
+    @contextmanager
+    def exported_snapshot():
+        yield "conn", "00000003-0000001B-1"
+
+    restore.exported_snapshot = exported_snapshot
+    restore.list_catalog = lambda filename: (
+        "6662; 0 1 TABLE DATA public a postgres\n"
+        "6663; 0 2 TABLE DATA public b postgres\n"
+        "6664; 0 3 TABLE DATA public c postgres\n"
+        "6665; 0 4 TABLE DATA other d postgres\n"
+    )
+
+    # ALTER TABLE a ADD COLUMN: same relfilenode and counters; c written
+    # lately, its counters not flushed yet but its rows checksum differs
+    new = dict(stats)
+    new["public.a"] = dict(stats["public.a"], columns="new")
+    new["public.c"] = dict(stats["public.c"], checksum="31:45")
+
+    def table_stats(checksum=False, conn=None):
+        assert checksum and conn == "conn"
+        return {k: dict(t) for k, t in new.items()}
+
+    restore.table_stats = table_stats
+
+    restore.pg_dump_incremental(str(tmp_path), "2021-03-02")
+
+    args = log.read_text().split()
+    assert "--snapshot=00000003-0000001B-1" in args
+    assert '--exclude-table-data="public"."b"' in args
+    assert not any('"a"' in arg or '"c"' in arg for arg in args)
+
+    snapshot = str(tmp_path / "2021-03-02")
+    manifest = incremental.read_manifest(snapshot)
+    assert manifest["tables"]["public.a"]["dump_id"] == 6662
+    assert manifest["tables"]["public.c"]["dump_id"] == 6664
+    assert manifest["tables"]["public.b"]["origin"] == "2021-03-01"
+
+    # the restore follows the schemas rules, linked data included
+    log.write_text("")
+    restore.schemas = ["public"]
+    restore.get_trigger_funcs = lambda filename: {}
+
+    lists = []
+    restore.catalog_to_file = lambda catalog: lists.append(catalog) or "list%d" % len(lists)
+
+    restore.pg_restore_incremental(snapshot)
+
+    runs = log.read_text().splitlines()
+    assert all("pg_restore" in run and "-L list" in run for run in runs)
+    assert [line[0] != ";" for line in lists[0].splitlines()] == [True, True, True, False]
+    assert [line[0] != ";" for line in lists[1].splitlines()] == [False, True, False, False]
+
+
+def test_verify_collect_estimate(monkeypatch):
+    """checksums without exact counts keep the estimated row counts"""
+    import psycopg2.pool
+    from pg_tools import verify
+
+    class Cursor:
+        def execute(self, sql):
+            self.sql = sql
+
+        def fetchall(self):
+            return [("jdb", "a", 1000, None)]
+
+        def fetchone(self):
+            return (998, 42) if "md5" in self.sql else (998, None)
+
+        def close(self):
+            pass
+
+    class Conn:
+        def cursor(self):
+            return Cursor()
+
+        def rollback(self):
+            pass
+
+    options = []
+
+    class Pool:
+        def __init__(self, minconn, maxconn, dsn, **kwargs):
+            options.append(kwargs["options"])
+
+        def getconn(self):
+            return Conn()
+
+        def putconn(self, conn):
+            pass
+
+        def closeall(self):
+            pass
+
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", Pool)
+
+    stats = verify.collect("dbname=jdb", exact=False, checksum=True, jobs=1)
+    assert stats["jdb.a"]["rows"] == 1000
+    assert stats["jdb.a"]["checksum"] == "42"
+
+    stats = verify.collect("dbname=jdb", exact=True, checksum=True, jobs=1)
+    assert stats["jdb.a"]["rows"] == 998
+
+    stats = verify.collect("dbname=jdb", exact=False, jobs=1)
+    assert stats["jdb.a"] == {"rows": 1000, "checksum": None, "elapsed": 0.0}
+
+    # rows print the same whatever the servers settings
+    assert "-c TimeZone=UTC" in options[0] and "-c DateStyle=ISO,YMD" in options[0]
+
+    assert verify.relname("jdb", 'odd"name') == '"jdb"."odd""name"'